@@ -1,16 +1,31 @@
 from flask import send_from_directory
-from flask import Flask, request, redirect, url_for, jsonify, render_template, session
+from flask import Flask, request, redirect, url_for, jsonify, render_template, session, g, has_request_context, make_response
+from flask import Response, stream_with_context
 from flask import send_from_directory
+import base64
+import bisect
+import copy
+import hashlib
+import heapq
+import itertools
 import json
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, namedtuple
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 import os
 import calendar
 import random
 import requests
 from werkzeug.security import generate_password_hash, check_password_hash
-from pymongo import MongoClient
+from markupsafe import Markup
+from pymongo import MongoClient, UpdateOne, ReturnDocument, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from bson.int64 import Int64
+from bson.objectid import ObjectId
 from urllib.parse import quote_plus
 
 # 日本時間のタイムゾーン設定
@@ -28,6 +43,23 @@ MONGODB_URI = os.environ.get("MONGODB_URI")
 if not MONGODB_URI:
     raise ValueError("MONGODB_URI環境変数が設定されていません")
 
+# リクエストごとのMongoDB往復回数を表示するか（MONGO_DEBUG=1で有効）
+MONGO_DEBUG = os.environ.get("MONGO_DEBUG") == "1"
+
+class MongoRoundTripCounter(monitoring.CommandListener):
+    """MongoDBへのコマンド送信回数をリクエスト単位で数える（コマンド名と対象コレクションも記録）"""
+
+    def started(self, event):
+        if has_request_context():
+            g.mongo_round_trips = g.get("mongo_round_trips", 0) + 1
+            g.setdefault("mongo_commands", []).append((event.command_name, event.command.get(event.command_name)))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
 # MongoDBクライアントの初期化
 client = MongoClient(
     MONGODB_URI,
@@ -35,75 +67,650 @@ client = MongoClient(
     minPoolSize=2,       # 最低2つの接続を保持
     maxIdleTimeMS=45000, # 45秒間接続を保持
     connectTimeoutMS=5000,
-    serverSelectionTimeoutMS=5000
+    serverSelectionTimeoutMS=5000,
+    event_listeners=[MongoRoundTripCounter()]
 )
 db = client.furlife_db  # データベース名
 
 # コレクション定義
-events_collection = db.events
-pokedex_collection = db.pokedex
+# ユーザーごとのデータ（pet / pokedex / goals / locations / settings）はusersドキュメントに集約して保持する
 users_collection = db.users
+event_days_collection = db.event_days  # 日付ごとに分割した予定（username + date）
+recurring_events_collection = db.recurring_events  # 繰り返し予定のルール（表示する期間だけ展開する）
+
+# 旧形式のコレクション（移行処理でのみ使用）
+events_collection = db.events  # ユーザーごとに全期間の予定を1ドキュメントに保持
+pokedex_collection = db.pokedex
 goals_collection = db.goals
 locations_collection = db.locations
 pets_collection = db.pets
 
+# usersドキュメントのレイアウトバージョン（これが無いユーザーは旧コレクションから補完する）
+USER_LAYOUT_VERSION = 1
+
 # APIå®šç¾©
 WEATHER_API_KEY = os.environ.get("WEATHER_API_KEY", "YOUR_API_KEY_HERE")
+WEATHER_API_URL = os.environ.get("WEATHER_API_URL", "http://api.openweathermap.org/data/2.5/weather")
+
+# =============================================================================
+# リクエスト単位のデータキャッシュ（Unit of Work）
+# =============================================================================
+# ユーザーごとのデータはusersドキュメントのセクション（pet / pokedex / goals / locations / settings）
+# として保持する。1リクエスト中は各セクションを1回だけ取得し、save_user_*() は
+# 変更の記録のみ行う。変更されたフィールドはレスポンス返却前に1回のupdate_oneで
+# まとめて書き込む。
+# 予定・目標・場所を書き換えたリクエストでは、同じ更新でusers.data_versionも
+# 1増やす（描画済みHTMLのキャッシュはこのバージョンをキーに含める）。
+# ペット・図鑑の書き込みではusers.pet_versionを増やす（ETagは両方から作る）。
+
+USER_SECTIONS = ("pet", "pokedex", "goals", "locations", "settings")
+
+# ページごとに描画で使うセクション（1回のfind_oneでまとめて取得する）
+PAGE_PROJECTIONS = {
+    "calendar": ("pet", "goals", "locations", "settings"),
+    "shop": ("pet",),
+    "pet_detail": ("pet", "pokedex"),
+    "ranking": ("pet", "pokedex"),
+    "auction": ("pet",),
+}
+
+def load_user_aggregate(username, sections):
+    """usersドキュメントから指定セクションだけを取得（旧レイアウトのユーザーは先に補完）"""
+    projection = {"_id": 0, "layout_version": 1}
+    projection.update({section: 1 for section in sections})
+    
+    doc = users_collection.find_one({"username": username}, projection)
+    if doc is not None and "layout_version" not in doc:
+        backfill_user_aggregate(username)
+        doc = users_collection.find_one({"username": username}, projection)
+    return doc or {}
+
+def prefetch_user_sections(page):
+    """ページ表示に必要なセクションを1回のクエリで取得してキャッシュに載せる"""
+    username = session.get("username")
+    user_docs = g.get("user_docs", {})
+    sections = [section for section in PAGE_PROJECTIONS[page] if section not in user_docs]
+    if not username or not sections:
+        return
+    
+    doc = load_user_aggregate(username, sections + ["data_version", "pet_version"])
+    g.setdefault("user_versions", (doc.get("data_version", 0), doc.get("pet_version", 0)))
+    prefetched = g.setdefault("user_doc_prefetch", {})
+    for section in sections:
+        prefetched[section] = doc.get(section)
+
+def get_user_versions():
+    """(data_version, pet_version) を返す（リクエスト内では1回だけ取得）"""
+    if "user_versions" not in g:
+        doc = users_collection.find_one(
+            {"username": session.get("username")}, {"_id": 0, "data_version": 1, "pet_version": 1}
+        ) or {}
+        g.user_versions = (doc.get("data_version", 0), doc.get("pet_version", 0))
+    return g.user_versions
+
+def get_user_data_version():
+    """予定・目標・場所のデータバージョン（書き込みのたびに増える）"""
+    return get_user_versions()[0]
+
+def note_user_data_changed():
+    """予定・目標・場所を書き換えたことを記録（リクエスト終了時にdata_versionを増やす）"""
+    g.user_data_changed = True
+
+def get_user_doc_entry(name, build):
+    """リクエスト内でキャッシュしたユーザーデータのセクションを返す（初回のみDBから取得）
+    
+    build(doc) は取得したセクション（存在しなければNone）から作業用のデータを作る
+    """
+    user_docs = g.setdefault("user_docs", {})
+    if name not in user_docs:
+        prefetched = g.get("user_doc_prefetch", {})
+        if name in prefetched:
+            raw = prefetched.pop(name)
+        else:
+            raw = load_user_aggregate(session.get("username"), [name]).get(name)
+        snapshot = copy.deepcopy(raw) if raw else {}
+        user_docs[name] = {"doc": build(raw), "snapshot": snapshot, "dirty": False}
+    return user_docs[name]
+
+def mark_user_doc_dirty(name, doc):
+    """ユーザードキュメントを変更済みとして記録（書き込みはリクエスト終了時）"""
+    entry = get_user_doc_entry(name, lambda raw: raw or {})
+    entry["doc"] = doc
+    entry["dirty"] = True
+
+def is_safe_field_key(key):
+    """ドット区切りのフィールドパスにそのまま使えるキーか"""
+    return isinstance(key, str) and key != "" and "." not in key and not key.startswith("$")
+
+def diff_fields(old, new, prefix=""):
+    """2つのドキュメントを比較し、$set/$unset用のフィールドパスを返す"""
+    set_fields = {}
+    unset_fields = {}
+    
+    for key, value in new.items():
+        if key == "_id" or (key in old and old[key] == value):
+            continue
+        path = prefix + key
+        old_value = old.get(key)
+        if (isinstance(value, dict) and isinstance(old_value, dict)
+                and all(is_safe_field_key(k) for k in list(value) + list(old_value))):
+            child_set, child_unset = diff_fields(old_value, value, path + ".")
+            set_fields.update(child_set)
+            unset_fields.update(child_unset)
+        else:
+            set_fields[path] = value
+    
+    for key in old:
+        if key != "_id" and key not in new:
+            unset_fields[prefix + key] = ""
+    
+    return set_fields, unset_fields
+
+def flush_user_docs():
+    """変更されたセクションをまとめてusersドキュメントへ1回の更新で書き込む"""
+    username = session.get("username")
+    user_docs = g.pop("user_docs", {})
+    g.pop("user_doc_prefetch", None)
+    data_changed = g.pop("user_data_changed", False)
+    if not username:
+        return
+    
+    set_fields = {}
+    unset_fields = {}
+    for name, entry in user_docs.items():
+        if not entry["dirty"]:
+            continue
+        section_set, section_unset = diff_fields({name: entry["snapshot"]}, {name: entry["doc"]})
+        set_fields.update(section_set)
+        unset_fields.update(section_unset)
+    
+    update = {}
+    if set_fields:
+        update["$set"] = set_fields
+    if unset_fields:
+        update["$unset"] = unset_fields
+    versions = {}
+    if data_changed:
+        versions["data_version"] = 1
+    if any(path.split(".")[0] in ("pet", "pokedex") for path in list(set_fields) + list(unset_fields)):
+        versions["pet_version"] = 1
+    if versions:
+        update["$inc"] = versions
+    if update:
+        users_collection.update_one({"username": username}, update)
+
+def clear_user_events_cache():
+    """イベントを書き換える際、リクエスト内のイベントキャッシュを破棄"""
+    g.pop("user_events", None)
+    note_user_data_changed()
+
+@app.after_request
+def finish_request_unit_of_work(response):
+    """レスポンス返却前に変更をまとめて保存し、デバッグ時は往復回数を出力"""
+    if response.status_code < 500:
+        flush_user_docs()
+    elif g.pop("user_data_changed", False) and session.get("username"):
+        # 予定は直接書き込み済みのことがあるので、エラー時もバージョンだけは進める
+        users_collection.update_one({"username": session["username"]}, {"$inc": {"data_version": 1}})
+    
+    if MONGO_DEBUG:
+        round_trips = g.get("mongo_round_trips", 0)
+        response.headers["X-Mongo-Round-Trips"] = str(round_trips)
+        print(f"[DEBUG] {request.method} {request.path}: MongoDB round trips = {round_trips}")
+    
+    return response
 
 # =============================================================================
 # データ取得・保存関数（MongoDB版）
 # =============================================================================
 
-def get_user_events():
-    """現在のユーザーのイベントデータを取得"""
+# 予定の読み出しでは検索用のn-gram（search_grams）を返さない
+EVENT_DAY_PROJECTION = {"_id": 0, "username": 0, "events.search_grams": 0}
+# 1日分のevents配列は常にこの順（開始・終了の分の昇順）で保存する
+EVENT_DAY_ORDER = {"start_min": 1, "end_min": 1}
+
+def normalize_search_text(text):
+    """検索用に全角/半角・大文字/小文字の違いをそろえる"""
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+def event_search_grams(*texts):
+    """予定の本文・場所から検索用の1文字・2文字のn-gramを作る（空白をまたがない）"""
+    grams = set()
+    for text in texts:
+        for chunk in normalize_search_text(text).split():
+            grams.update(chunk)
+            grams.update(chunk[i:i + 2] for i in range(len(chunk) - 1))
+    return sorted(grams)
+
+def with_stored_fields(event):
+    """保存用に、検索用のn-gramと開始・終了の分（start_min / end_min）を付けた予定のコピーを返す"""
+    stored = dict(event)
+    if "event" in event:
+        stored["search_grams"] = event_search_grams(event["event"], event.get("location"))
+    if "start_time" in event and "end_time" in event:
+        stored["start_min"] = time_to_minutes(event["start_time"])
+        stored["end_min"] = time_to_minutes(event["end_time"])
+    return stored
+
+def get_user_events(start_date, end_date):
+    """現在のユーザーの指定期間（YYYY-MM-DD、両端含む）のイベントデータを取得"""
     username = session.get("username")
     if not username:
         return {}
     
-    doc = events_collection.find_one({"username": username})
-    return doc["events"] if doc else {}
+    events_cache = g.setdefault("user_events", {})
+    if (start_date, end_date) not in events_cache:
+        docs = event_days_collection.find(
+            {"username": username, "date": {"$gte": start_date, "$lte": end_date}},
+            EVENT_DAY_PROJECTION
+        )
+        events = {doc["date"]: doc["events"] for doc in docs if doc.get("events")}
+        merge_recurring_events(events, get_recurring_occurrences(username, start_date, end_date))
+        events_cache[(start_date, end_date)] = events
+    return events_cache[(start_date, end_date)]
 
-def save_user_events(events_data):
-    """ユーザーのイベントデータを保存"""
+def get_user_day_events(date_str):
+    """現在のユーザーの1日分のイベントを取得"""
     username = session.get("username")
     if not username:
-        return
+        return []
     
-    events_collection.update_one(
+    for (start_date, end_date), events in g.get("user_events", {}).items():
+        if start_date <= date_str <= end_date:
+            return events.get(date_str, [])
+    
+    doc = event_days_collection.find_one(
+        {"username": username, "date": date_str},
+        EVENT_DAY_PROJECTION
+    )
+    events = {date_str: doc["events"]} if doc else {}
+    merge_recurring_events(events, get_recurring_occurrences(username, date_str, date_str))
+    return events.get(date_str, [])
+
+def next_event_id():
+    """ユーザーごとの単調増加するイベントIDを発行（usersドキュメントのカウンタを原子的に加算）"""
+    return reserve_event_ids(1)
+
+def reserve_event_ids(count):
+    """イベントIDをcount個まとめて確保し、先頭のIDを返す（一括取り込み用）"""
+    username = session.get("username")
+    doc = users_collection.find_one_and_update(
         {"username": username},
-        {"$set": {"events": events_data}},
-        upsert=True
+        {"$inc": {"event_seq": count}},
+        projection={"_id": 0, "event_seq": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    return doc["event_seq"] - count + 1
+
+def push_user_event(date_str, event):
+    """1件のイベントをその日の配列に原子的に追加（同じIDが既にあれば追加せずFalse）"""
+    username = session.get("username")
+    clear_user_events_cache()
+    try:
+        event_days_collection.update_one(
+            {"username": username, "date": date_str, "events.id": {"$ne": event["id"]}},
+            {"$push": {"events": {"$each": [with_stored_fields(event)], "$sort": EVENT_DAY_ORDER}}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # 同じIDの予定が既にある日（カウンタ導入前のデータ）はupsertが一意制約に当たる
+        return False
+    return True
+
+def update_user_event(date_str, event_id, fields):
+    """IDで指定したイベントのフィールドを位置指定で原子的に更新（時刻が変われば開始順に並べ直す）"""
+    username = session.get("username")
+    clear_user_events_cache()
+    fields = with_stored_fields(fields)
+    result = event_days_collection.update_one(
+        {"username": username, "date": date_str, "events.id": event_id},
+        {"$set": {f"events.$.{key}": value for key, value in fields.items()}}
+    )
+    if result.matched_count and "start_min" in fields:
+        event_days_collection.update_one(
+            {"username": username, "date": date_str},
+            {"$push": {"events": {"$each": [], "$sort": EVENT_DAY_ORDER}}}
+        )
+    return result.matched_count > 0
+
+def pull_user_event(date_str, event_id):
+    """IDで指定したイベントを原子的に削除"""
+    username = session.get("username")
+    clear_user_events_cache()
+    result = event_days_collection.update_one(
+        {"username": username, "date": date_str, "events.id": event_id},
+        {"$pull": {"events": {"id": event_id}}}
     )
+    return result.matched_count > 0
+
+def mark_user_event_done(date_str, event_id, done):
+    """doneが未設定（null）の場合のみ達成/失敗を記録し、更新前のイベントを返す
+    
+    既に設定済みまたは存在しない場合はNoneを返す
+    """
+    username = session.get("username")
+    clear_user_events_cache()
+    doc = event_days_collection.find_one_and_update(
+        {"username": username, "date": date_str,
+         "events": {"$elemMatch": {"id": event_id, "done": None}}},
+        {"$set": {"events.$.done": done}},
+        projection={"_id": 0, "events": {"$elemMatch": {"id": event_id}}}
+    )
+    if doc is None:
+        return None
+    doc["events"][0].pop("search_grams", None)
+    return doc["events"][0]
+
+# =============================================================================
+# 繰り返し予定
+# =============================================================================
+# 繰り返し予定はルール（毎日/毎週/毎月・間隔・終了日または回数・除外日）として
+# 1件だけ保存し、表示や検索で必要な期間の分だけその場で展開する。
+# 発生ごとの達成/失敗は done.<日付> に記録した分だけ持つ。
+
+RECURRENCE_FREQS = {"daily": "毎日", "weekly": "毎週", "monthly": "毎月"}
+MAX_RECURRENCE_COUNT = 1000
+MAX_RECURRENCE_INTERVAL = 365
+
+def parse_ymd(date_str):
+    """YYYY-MM-DD文字列を日付に変換"""
+    return datetime.strptime(date_str, "%Y-%m-%d").date()
+
+def nth_occurrence(rule, index):
+    """ルールのindex番目（0始まり）の発生日（毎月で日が無い月は月末にそろえる）"""
+    start = parse_ymd(rule["start_date"])
+    interval = rule.get("interval", 1)
+    if rule["freq"] == "daily":
+        return start + timedelta(days=index * interval)
+    if rule["freq"] == "weekly":
+        return start + timedelta(weeks=index * interval)
+    months = start.month - 1 + index * interval
+    year, month = start.year + months // 12, months % 12 + 1
+    return start.replace(year=year, month=month, day=min(start.day, calendar.monthrange(year, month)[1]))
+
+def first_occurrence_index(rule, day):
+    """day以降で最初に発生する回の番号"""
+    start = parse_ymd(rule["start_date"])
+    if day <= start:
+        return 0
+    interval = rule.get("interval", 1)
+    if rule["freq"] in ("daily", "weekly"):
+        step = interval * (7 if rule["freq"] == "weekly" else 1)
+        return -(-(day - start).days // step)
+    index = ((day.year - start.year) * 12 + day.month - start.month) // interval
+    while nth_occurrence(rule, index) < day:
+        index += 1
+    return index
+
+def expand_recurrence(rule, start_date, end_date):
+    """[start_date, end_date] に含まれる発生日（YYYY-MM-DD）を順に返す"""
+    range_end = parse_ymd(end_date)
+    until = parse_ymd(rule["until"]) if rule.get("until") else None
+    count = rule.get("count")
+    exceptions = set(rule.get("exceptions", []))
+    
+    index = first_occurrence_index(rule, parse_ymd(start_date))
+    while count is None or index < count:
+        day = nth_occurrence(rule, index)
+        if day > range_end or (until and day > until):
+            break
+        if day.isoformat() not in exceptions:
+            yield day.isoformat()
+        index += 1
+
+def recurrence_last_date(rule):
+    """最後の発生日（終了日も回数も無ければNone）"""
+    candidates = []
+    if rule.get("until"):
+        candidates.append(rule["until"])
+    if rule.get("count"):
+        candidates.append(nth_occurrence(rule, rule["count"] - 1).isoformat())
+    return min(candidates) if candidates else None
+
+def recurring_occurrence(rule, date_str):
+    """ルールから1回分の予定を作る（通常の予定と同じ形）"""
+    return {
+        "id": rule["id"],
+        "start_time": rule["start_time"],
+        "end_time": rule["end_time"],
+        "event": rule["event"],
+        "location": rule.get("location", "その他"),
+        "done": rule.get("done", {}).get(date_str),
+        "recurrence": rule["freq"],
+        "start_min": rule["start_min"] if "start_min" in rule else time_to_minutes(rule["start_time"]),
+        "end_min": rule["end_min"] if "end_min" in rule else time_to_minutes(rule["end_time"]),
+    }
+
+def get_recurring_occurrences(username, start_date, end_date):
+    """期間内に発生する繰り返し予定を日付ごとに展開"""
+    rules = recurring_events_collection.find(
+        {"username": username, "start_date": {"$lte": end_date},
+         "$or": [{"last_date": None}, {"last_date": {"$gte": start_date}}]},
+        {"_id": 0, "search_grams": 0}
+    )
+    occurrences = {}
+    for rule in rules:
+        for date_str in expand_recurrence(rule, start_date, end_date):
+            occurrences.setdefault(date_str, []).append(recurring_occurrence(rule, date_str))
+    return occurrences
+
+def merge_recurring_events(events_by_date, occurrences):
+    """日付ごとの予定に繰り返し予定を加え、開始時刻順に並べる"""
+    for date_str, extra in occurrences.items():
+        events_by_date[date_str] = sorted(
+            events_by_date.get(date_str, []) + extra,
+            key=lambda ev: event_interval(ev)[:2]
+        )
+
+def validate_recurrence(start_date, freq, interval, until, count):
+    """繰り返しの指定をチェック（問題があればエラーメッセージを返す）"""
+    if freq not in RECURRENCE_FREQS:
+        return "繰り返しの種類が不正です"
+    if not isinstance(interval, int) or not 1 <= interval <= MAX_RECURRENCE_INTERVAL:
+        return f"繰り返しの間隔は1〜{MAX_RECURRENCE_INTERVAL}で指定してください"
+    if count is not None and (not isinstance(count, int) or not 1 <= count <= MAX_RECURRENCE_COUNT):
+        return f"繰り返し回数は1〜{MAX_RECURRENCE_COUNT}で指定してください"
+    if until:
+        try:
+            if parse_ymd(until) < parse_ymd(start_date):
+                return "終了日は開始日以降にしてください"
+        except ValueError:
+            return "終了日の形式が不正です"
+    return None
+
+def build_recurring_rule(event_id, start_date, start_time, end_time, event_text, location,
+                         freq, interval=1, until=None, count=None, exceptions=()):
+    """保存する形の繰り返し予定のルールを作る"""
+    rule = {
+        "username": session.get("username"), "id": event_id,
+        "start_date": start_date, "freq": freq, "interval": interval,
+        "until": until or None, "count": count, "exceptions": sorted(set(exceptions)),
+        "start_time": start_time, "end_time": end_time,
+        "event": event_text, "location": location, "done": {},
+    }
+    rule["last_date"] = recurrence_last_date(rule)
+    return rule
+
+def create_recurring_event(start_date, start_time, end_time, event_text, location,
+                           freq, interval=1, until=None, count=None, exceptions=()):
+    """繰り返し予定のルールを1件保存して返す"""
+    rule = build_recurring_rule(next_event_id(), start_date, start_time, end_time, event_text, location,
+                                freq, interval, until, count, exceptions)
+    clear_user_events_cache()
+    recurring_events_collection.insert_one(with_stored_fields(rule))
+    return rule
+
+def find_recurring_occurrence(date_str, event_id):
+    """その日に発生する繰り返し予定のルールを返す（発生しなければNone）"""
+    try:
+        parse_ymd(date_str)
+    except ValueError:
+        return None
+    rule = recurring_events_collection.find_one(
+        {"username": session.get("username"), "id": event_id}, {"_id": 0, "search_grams": 0}
+    )
+    if rule is None or next(expand_recurrence(rule, date_str, date_str), None) is None:
+        return None
+    return rule
+
+def mark_recurring_event_done(date_str, event_id, done):
+    """繰り返し予定のその日の回に達成/失敗を記録し、記録前の予定を返す
+    
+    既に設定済みまたはその日に発生しない場合はNoneを返す
+    """
+    rule = find_recurring_occurrence(date_str, event_id)
+    if rule is None:
+        return None
+    clear_user_events_cache()
+    result = recurring_events_collection.update_one(
+        {"username": session.get("username"), "id": event_id, f"done.{date_str}": {"$exists": False}},
+        {"$set": {f"done.{date_str}": done}}
+    )
+    if result.modified_count == 0:
+        return None
+    return recurring_occurrence(rule, date_str)
+
+def skip_recurring_occurrence(date_str, event_id):
+    """繰り返し予定のその日の回だけを除外日にする（発生しなければFalse）"""
+    if find_recurring_occurrence(date_str, event_id) is None:
+        return False
+    clear_user_events_cache()
+    recurring_events_collection.update_one(
+        {"username": session.get("username"), "id": event_id},
+        {"$addToSet": {"exceptions": date_str}}
+    )
+    return True
+
+def delete_recurring_event(event_id):
+    """繰り返し予定のルールごと削除"""
+    clear_user_events_cache()
+    result = recurring_events_collection.delete_one({"username": session.get("username"), "id": event_id})
+    return result.deleted_count > 0
+
+# =============================================================================
+# 予定の時間区間（重なりの検出・空き時間）
+# =============================================================================
+# 予定は保存時に開始・終了を0時からの分（start_min / end_min）でも持ち、1日分の
+# events配列を開始順（EVENT_DAY_ORDER）に並べて保存する。区間のリストは保存順のまま
+# 1回の走査で作り（O(n)。その日のドキュメントを読むのと同じ量で、並べ替えはしない）、
+# 各位置までの終了の最大値も同じ走査で求める。重なりの検出は二分探索で新しい予定の
+# 終了より前に始まる区間を求め、そこから終了の最大値が新しい予定の開始を超えている
+# 間だけさかのぼる（O(log n + 重なりの候補の数)）。
+
+EventInterval = namedtuple("EventInterval", ["start", "end", "id"])
+DayIntervals = namedtuple("DayIntervals", ["intervals", "max_ends"])
+DAY_MINUTES = 24 * 60
+OVERLAP_CHECK_DAYS = 366  # 繰り返し予定は最初の1年分の発生日で重なりを調べる
+
+def time_to_minutes(time_str):
+    """HH:MMを0時からの分に変換"""
+    hours, minutes = map(int, time_str.split(":"))
+    return hours * 60 + minutes
+
+def minutes_to_time(minutes):
+    """0時からの分をHH:MMに変換（1日の終わりは24:00）"""
+    return f"{minutes // 60:02}:{minutes % 60:02}"
+
+def event_interval(event):
+    """予定の区間（保存済みの分を優先し、無ければ時刻から求める）"""
+    if "start_min" in event and "end_min" in event:
+        return EventInterval(event["start_min"], event["end_min"], event.get("id"))
+    start_time = event.get("start_time", event.get("time", "00:00"))
+    return EventInterval(time_to_minutes(start_time), time_to_minutes(event.get("end_time", "23:59")), event.get("id"))
+
+def build_day_intervals(events):
+    """1日分の予定（開始順に保存済み）を区間にする（順序が崩れている古いデータだけ並べ直す）"""
+    intervals = [event_interval(ev) for ev in events]
+    if any(a[:2] > b[:2] for a, b in zip(intervals, intervals[1:])):
+        intervals.sort(key=lambda iv: (iv.start, iv.end))
+    return DayIntervals(intervals, list(itertools.accumulate((iv.end for iv in intervals), max)))
+
+def find_overlap(day, start, end, ignore_id=None):
+    """[start, end) と重なる区間を1つ返す（ignore_idの予定は除く、無ければNone）"""
+    index = bisect.bisect_left(day.intervals, end, key=lambda iv: iv.start) - 1
+    while index >= 0 and day.max_ends[index] > start:
+        interval = day.intervals[index]
+        if interval.end > start and (ignore_id is None or interval.id != ignore_id):
+            return interval
+        index -= 1
+    return None
+
+def find_free_slots(day, range_start=0, range_end=DAY_MINUTES, min_minutes=1):
+    """区間をつなげた残りの空き時間を [(開始, 終了)] で返す"""
+    slots = []
+    cursor = range_start
+    for interval in day.intervals:
+        if interval.start >= range_end:
+            break
+        if interval.start > cursor:
+            slots.append((cursor, interval.start))
+        cursor = max(cursor, interval.end)
+    if cursor < range_end:
+        slots.append((cursor, range_end))
+    return [(start, end) for start, end in slots if end - start >= min_minutes]
+
+def find_schedule_conflict(events_by_date, dates, start_time, end_time, ignore_id=None):
+    """指定した日々でstart_time〜end_timeと重なる最初の予定を (日付, 区間) で返す"""
+    start, end = time_to_minutes(start_time), time_to_minutes(end_time)
+    for date_str in dates:
+        overlap = find_overlap(build_day_intervals(events_by_date.get(date_str, [])), start, end, ignore_id)
+        if overlap:
+            return date_str, overlap
+    return None
+
+def overlap_check_dates(date_str, recurrence=None):
+    """重なりを調べる日付（繰り返し予定は最初の1年分の発生日）と、その期間の終わり"""
+    if not recurrence:
+        return [date_str], date_str
+    end_date = (parse_ymd(date_str) + timedelta(days=OVERLAP_CHECK_DAYS - 1)).isoformat()
+    rule = dict(recurrence, start_date=date_str)
+    return list(expand_recurrence(rule, date_str, end_date)), end_date
+
+def overlap_error(conflict):
+    """重なった予定を知らせるエラーメッセージ"""
+    date_str, interval = conflict
+    return (f"{date_str} {minutes_to_time(interval.start)}〜{minutes_to_time(interval.end)}"
+            "の予定と時間が重なっています")
+
+def check_event_overlap(date_str, start_time, end_time, recurrence=None, ignore_id=None):
+    """重なりを拒否する設定のユーザーなら、既存の予定と重なるかを調べる（重なればエラーメッセージ）"""
+    if not get_user_settings().get("reject_overlaps"):
+        return None
+    dates, end_date = overlap_check_dates(date_str, recurrence)
+    if recurrence:
+        events_by_date = get_user_events(date_str, end_date)
+    else:
+        events_by_date = {date_str: get_user_day_events(date_str)}
+    conflict = find_schedule_conflict(events_by_date, dates, start_time, end_time, ignore_id)
+    return overlap_error(conflict) if conflict else None
+
+def get_month_date_range(year, month):
+    """指定された年月の最初と最後の日付文字列を返す"""
+    last_day = calendar.monthrange(year, month)[1]
+    return f"{year:04}-{month:02}-01", f"{year:04}-{month:02}-{last_day:02}"
 
 def get_user_pokedex():
-    """現在のユーザーの図鑑データを取得（常に最新）"""
+    """現在のユーザーの図鑑データを取得（リクエスト内では同じdictを返す）"""
     username = session.get("username")
     if not username:
         return {"discovered": [], "育成_counts": {}}
     
-    # ★重要: データベースから直接取得（キャッシュなし）
-    doc = pokedex_collection.find_one({"username": username})
-    if not doc:
-        return {"discovered": [], "育成_counts": {}}
+    def build(doc):
+        doc = doc or {}
+        # 育成_countsフィールドがない場合は初期化
+        doc.setdefault("discovered", [])
+        doc.setdefault("育成_counts", {})
+        return doc
     
-    # 育成_countsフィールドがない場合は初期化
-    if "育成_counts" not in doc:
-        doc["育成_counts"] = {}
-    
-    return {"discovered": doc.get("discovered", []), "育成_counts": doc.get("育成_counts", {})}
+    return get_user_doc_entry("pokedex", build)["doc"]
 
 def save_user_pokedex(pokedex_data):
-    """ユーザーの図鑑データを保存（確実に保存）"""
+    """ユーザーの図鑑データを保存（リクエスト終了時に変更分のみ書き込み）"""
     username = session.get("username")
     if not username:
         return
     
-    # ★重要: write_concernを使って確実に書き込み完了を待つ
-    pokedex_collection.update_one(
-        {"username": username},
-        {"$set": pokedex_data},
-        upsert=True
-    )
+    mark_user_doc_dirty("pokedex", pokedex_data)
 
 def get_user_goals():
     """現在のユーザーの目標データを取得"""
@@ -111,8 +718,7 @@ def get_user_goals():
     if not username:
         return {}
     
-    doc = goals_collection.find_one({"username": username})
-    return doc["goals"] if doc else {}
+    return get_user_doc_entry("goals", lambda doc: doc or {})["doc"]
 
 def save_user_goals(goals_data):
     """ユーザーの目標データを保存"""
@@ -120,11 +726,8 @@ def save_user_goals(goals_data):
     if not username:
         return
     
-    goals_collection.update_one(
-        {"username": username},
-        {"$set": {"goals": goals_data}},
-        upsert=True
-    )
+    mark_user_doc_dirty("goals", goals_data)
+    note_user_data_changed()
 
 def get_user_locations():
     """現在のユーザーの場所設定を取得"""
@@ -140,8 +743,7 @@ def get_user_locations():
     if not username:
         return default_locations
     
-    doc = locations_collection.find_one({"username": username})
-    return doc["locations"] if doc else default_locations
+    return get_user_doc_entry("locations", lambda doc: default_locations if doc is None else doc)["doc"]
 
 def save_user_locations(locations_data):
     """ユーザーの場所データを保存"""
@@ -149,14 +751,30 @@ def save_user_locations(locations_data):
     if not username:
         return
     
-    locations_collection.update_one(
-        {"username": username},
-        {"$set": {"locations": locations_data}},
-        upsert=True
-    )
+    mark_user_doc_dirty("locations", locations_data)
+    note_user_data_changed()
+
+def get_user_settings():
+    """現在のユーザーの予定に関する設定を取得"""
+    username = session.get("username")
+    default_settings = {"reject_overlaps": False}
+    
+    if not username:
+        return default_settings
+    
+    return get_user_doc_entry("settings", lambda doc: dict(default_settings, **(doc or {})))["doc"]
+
+def save_user_settings(settings_data):
+    """ユーザーの予定に関する設定を保存"""
+    username = session.get("username")
+    if not username:
+        return
+    
+    mark_user_doc_dirty("settings", settings_data)
+    note_user_data_changed()
 
 def get_user_pet():
-    """現在のユーザーのペットデータを取得"""
+    """現在のユーザーのペットデータを取得（リクエスト内では同じdictを返す）"""
     username = session.get("username")
     default_pet = {
         "level": 0, "food": 0, "exp": 0, "coins": 0,
@@ -173,92 +791,261 @@ def get_user_pet():
     if not username:
         return default_pet
     
-    doc = pets_collection.find_one({"username": username})
-    if not doc:
-        return default_pet
-    
-    # 既存データに不足しているフィールドを追加
-    if "coins" not in doc:
-        doc["coins"] = 0
-    if "inventory" not in doc:
-        doc["inventory"] = {
-            '基本の餌': 0,
-            'おいしい餌': 0,
-            'プレミアム餌': 0,
-            'スペシャル餌': 0,
-        }
-    if "exp" not in doc:
-        doc["exp"] = 0
+    def build(doc):
+        if not doc:
+            return default_pet
+        
+        # 既存データに不足しているフィールドを追加
+        if "coins" not in doc:
+            doc["coins"] = 0
+        if "inventory" not in doc:
+            doc["inventory"] = {
+                '基本の餌': 0,
+                'おいしい餌': 0,
+                'プレミアム餌': 0,
+                'スペシャル餌': 0,
+            }
+        if "exp" not in doc:
+            doc["exp"] = 0
+        return doc
     
-    return doc
+    return get_user_doc_entry("pet", build)["doc"]
 
 def save_user_pet(pet_data):
-    """ユーザーのペットデータを保存"""
+    """ユーザーのペットデータを保存（リクエスト終了時に変更分のみ書き込み）"""
     username = session.get("username")
     if not username:
         return
     
-    pet_data["username"] = username
-    pets_collection.update_one(
-        {"username": username},
-        {"$set": pet_data},
-        upsert=True
-    )
+    mark_user_doc_dirty("pet", pet_data)
 
-def add_to_pokedex(image_name):
-    """図鑑に新しいペットを追加（重複チェック強化）"""
-    username = session.get("username")
-    if not username:
-        return
-    
-    # eggは図鑑に追加しない
-    if image_name.startswith("egg"):
+def sync_user_doc_cache(name, apply):
+    """DBへ直接書き込んだ変更をリクエスト内キャッシュ（作業用とスナップショットの両方）へ反映"""
+    entry = g.get("user_docs", {}).get(name)
+    if entry is None:
         return
-    
-    # ★重要: 最新のデータを取得
-    user_pokedex = get_user_pokedex()
-    
-    # 既に発見済みの場合はスキップ
-    if image_name in user_pokedex["discovered"]:
-        return
-    
-    # 新規発見として追加
-    user_pokedex["discovered"].append(image_name)
-    
-    # ★重要: すぐに保存
-    save_user_pokedex(user_pokedex)
+    apply(entry["doc"])
+    apply(entry["snapshot"])
 
-def increment_育成_count(image_name):
-    """ペットの育成回数をカウント（原子的に更新）"""
-    username = session.get("username")
-    if not username or image_name.startswith("egg"):
+# =============================================================================
+# コイン・在庫の原子操作
+# =============================================================================
+# コインと餌の在庫はペットの他のフィールドと違い、同時リクエストで増減が
+# 重なりやすい。読み込み→書き戻しではなく、残高・在庫が足りる場合のみ一致する
+# 条件付きの$incで1回で更新し、結果をリクエスト内キャッシュへ反映する。
+
+def update_user_economy(coins=0, items=None, set_fields=None, guard=None, username=None):
+    """コインと在庫を原子的に増減する（減らす分は足りる場合のみ）
+    
+    items は {餌の名前: 増減数}、set_fields は同時に書き込むペットのフィールド、
+    guard は追加の検索条件。成功したら更新後のペット、条件に合わなければNoneを返す
+    """
+    username = username or session.get("username")
+    is_current_user = has_request_context() and username == session.get("username")
+    items = items or {}
+    set_fields = set_fields or {}
+    
+    query = {"username": username, **(guard or {})}
+    inc = {}
+    if coins:
+        inc["pet.coins"] = coins
+        if coins < 0:
+            query["pet.coins"] = {"$gte": -coins}
+    for item, quantity in items.items():
+        if not quantity:
+            continue
+        inc[f"pet.inventory.{item}"] = quantity
+        if quantity < 0:
+            query[f"pet.inventory.{item}"] = {"$gte": -quantity}
+    
+    update = {}
+    if inc:
+        update["$inc"] = {**inc, "pet_version": 1}
+    if set_fields:
+        update["$set"] = {f"pet.{field}": value for field, value in set_fields.items()}
+        update.setdefault("$inc", {"pet_version": 1})
+    if update:
+        doc = users_collection.find_one_and_update(
+            query, update, projection={"_id": 0, "pet": 1}, return_document=ReturnDocument.AFTER
+        )
+    else:
+        doc = users_collection.find_one(query, {"_id": 0, "pet": 1})
+    if doc is None:
+        return None
+    after = doc.get("pet", {})
+    
+    if is_current_user:
+        def apply(cached):
+            cached.update(set_fields)
+            if coins:
+                cached["coins"] = after.get("coins", 0)
+            inventory = cached.setdefault("inventory", {})
+            for item in items:
+                inventory[item] = after.get("inventory", {}).get(item, 0)
+        sync_user_doc_cache("pet", apply)
+    return after
+
+def debit_coins(amount, set_fields=None, guard=None, username=None):
+    """残高が足りる場合のみコインを減らす（不足ならNone）"""
+    return update_user_economy(coins=-amount, set_fields=set_fields, guard=guard, username=username)
+
+def credit_coins(amount, set_fields=None, username=None):
+    """コインを増やす"""
+    return update_user_economy(coins=amount, set_fields=set_fields, username=username)
+
+def move_inventory(items, coins=0, set_fields=None, guard=None, username=None):
+    """在庫（とコイン）をまとめて移動する（例: コイン→餌の購入、餌の消費）"""
+    return update_user_economy(coins=coins, items=items, set_fields=set_fields, guard=guard, username=username)
+
+def update_pokedex_scores(username, before_pokedex, new_mask):
+    """発見によって増えた分だけランキング用スコアを加算する
+    
+    before_pokedex は発見を記録した更新の直前の図鑑（find_one_and_updateで原子的に取得）なので、
+    同時に同じペットを発見しても加算されるのは先に記録した方だけになる
+    """
+    before_mask = get_discovered_mask(before_pokedex)
+    
+    if "discovered_mask" not in before_pokedex or "discovery_count" not in before_pokedex:
+        # 未移行のデータはビットマスクとスコアをまとめて補完する
+        mask = before_mask | new_mask
+        update = {"$set": {f"pokedex.{key}": value for key, value in pokedex_scores(mask).items()}}
+        words = pokedex_mask_words(before_mask)
+        if words:
+            update["$bit"] = {f"pokedex.discovered_mask.{word}": {"or": value} for word, value in words.items()}
+        users_collection.update_one({"username": username}, update)
         return
     
-    # ★デバッグ用ログ追加
-    print(f"[DEBUG] Incrementing 育成_count for {username}: {image_name}")
-    
-    # ★重要: まず現在のデータを取得
-    user_pokedex = get_user_pokedex()
-    
-    # 育成回数をインクリメント
-    current_count = user_pokedex["育成_counts"].get(image_name, 0)
-    user_pokedex["育成_counts"][image_name] = current_count + 1
+    added = new_mask & ~before_mask
+    if added:
+        users_collection.update_one(
+            {"username": username},
+            {"$inc": {f"pokedex.{key}": value for key, value in pokedex_scores(added).items()}}
+        )
+        note_leaderboard_discovery()
+
+def pokedex_count_key(image_name):
+    """育成_countsのキー（"."はフィールドパスの区切りになるため"_"に置き換える）"""
+    return image_name.replace(".", "_")
+
+def get_育成_count(user_pokedex, image_name):
+    """育成回数を取得（旧形式の"."を含むキーで保存された回数も合算）"""
+    counts = user_pokedex.get("育成_counts", {})
+    return counts.get(pokedex_count_key(image_name), 0) + counts.get(image_name, 0)
+
+def record_pokedex_discovery(image_names, raised=False, username=None):
+    """ペットの状態が変わったときに図鑑へ発見を記録（$addToSetなので何度呼んでも同じ）
     
-    # ★重要: データベースに保存
-    save_user_pokedex(user_pokedex)
+    raised=Trueの場合は各画像の育成回数も$incで加算し、発見の記録と1回の更新にまとめる
+    """
+    username = username or session.get("username")
+    # eggは図鑑に追加しない
+    image_names = [name for name in image_names if not name.split("/")[-1].startswith("egg")]
+    if not username or not image_names:
+        return
     
-    # ★デバッグ用ログ追加
-    print(f"[DEBUG] Updated 育成_count for {image_name}: {current_count} -> {current_count + 1}")
+    new_mask = pokedex_mask_from_images(image_names)
+    update = {"$addToSet": {"pokedex.discovered": {"$each": image_names}}}
+    if new_mask:
+        update["$bit"] = {
+            f"pokedex.discovered_mask.{word}": {"or": value}
+            for word, value in pokedex_mask_words(new_mask).items()
+        }
+    increments = {"pet_version": 1}
+    if raised:
+        for name in image_names:
+            path = f"pokedex.育成_counts.{pokedex_count_key(name)}"
+            increments[path] = increments.get(path, 0) + 1
+    update["$inc"] = increments
+    before = users_collection.find_one_and_update(
+        {"username": username},
+        update,
+        projection={"_id": 0, "pokedex.discovered_mask": 1, "pokedex.discovered": 1, "pokedex.discovery_count": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    before_pokedex = (before or {}).get("pokedex") or {}
+    update_pokedex_scores(username, before_pokedex, new_mask)
+    
+    if has_request_context() and username == session.get("username"):
+        def apply(pokedex):
+            discovered = pokedex.setdefault("discovered", [])
+            discovered.extend(name for name in dict.fromkeys(image_names) if name not in discovered)
+            if new_mask:
+                mask = get_discovered_mask(pokedex) | new_mask
+                pokedex["discovered_mask"] = pokedex_mask_words(mask)
+                pokedex.update(pokedex_scores(mask))
+            if raised:
+                counts = pokedex.setdefault("育成_counts", {})
+                for name in image_names:
+                    key = pokedex_count_key(name)
+                    counts[key] = counts.get(key, 0) + 1
+        sync_user_doc_cache("pokedex", apply)
 
 # =============================================================================
 # ユーティリティ関数
 # =============================================================================
 
-def get_weather_data(location):
-    """OpenWeatherMap APIから天気情報を取得"""
+def get_month_calendar(year, month):
+    """指定された年月のカレンダーデータを取得"""
+    cal = calendar.Calendar(firstweekday=6)
+    month_days = cal.monthdayscalendar(year, month)
+    weeknames = ['日', '月', '火', '水', '木', '金', '土']
+    return month_days, weeknames
+
+# =============================================================================
+# 天気情報（全ユーザー共通のキャッシュ・サーキットブレーカー）
+# =============================================================================
+# 天気は数分おきにしか変わらず全ユーザーで同じなので、場所ごとにプロセス内で共有する。
+# TTL内はキャッシュを返し、TTL切れでも許容期間内なら古い値を返しながら裏で1回だけ
+# 取り直す。キャッシュが無いときに同時に来たリクエストは、1回の取得結果を待って共有する。
+# APIが失敗し続けるときは一定時間呼び出しを止め、手元の値かNoneを返す。
+
+WEATHER_CACHE_TTL_SECONDS = float(os.environ.get("WEATHER_CACHE_TTL_SECONDS", 600))
+WEATHER_STALE_SECONDS = float(os.environ.get("WEATHER_STALE_SECONDS", 3600))
+WEATHER_WAIT_SECONDS = 6  # 取得中の他リクエストを待つ上限（APIのタイムアウト + 余裕）
+
+weather_cache = {}     # 場所 -> {"data": 天気情報, "fetched_at": 取得時刻}
+weather_inflight = {}  # 場所 -> 取得完了を知らせるEvent
+weather_lock = threading.Lock()
+
+# 天気APIへの接続はセッションで使い回す（毎回の接続確立を避ける）
+weather_session = requests.Session()
+weather_session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=8))
+weather_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=8))
+
+# 連続して失敗したら一定時間APIを呼ばない（サーキットブレーカー）
+WEATHER_BREAKER_THRESHOLD = int(os.environ.get("WEATHER_BREAKER_THRESHOLD", 3))
+WEATHER_BREAKER_COOLDOWN_SECONDS = float(os.environ.get("WEATHER_BREAKER_COOLDOWN_SECONDS", 60))
+
+weather_stats = {
+    "hits": 0, "stale_hits": 0, "misses": 0,
+    "upstream_calls": 0, "upstream_failures": 0, "short_circuits": 0,
+    "consecutive_failures": 0, "open_until": 0.0,
+}
+
+def record_weather_result(ok):
+    """APIの呼び出し結果を記録し、失敗が続いたらブレーカーを開く"""
+    with weather_lock:
+        if ok:
+            weather_stats["consecutive_failures"] = 0
+            return
+        weather_stats["upstream_failures"] += 1
+        weather_stats["consecutive_failures"] += 1
+        if weather_stats["consecutive_failures"] >= WEATHER_BREAKER_THRESHOLD:
+            weather_stats["open_until"] = time.monotonic() + WEATHER_BREAKER_COOLDOWN_SECONDS
+            print(f"⚠️ Weather API circuit opened for {WEATHER_BREAKER_COOLDOWN_SECONDS}s")
+
+def fetch_weather_data(location):
+    """OpenWeatherMap APIから天気情報を取得（ブレーカーが開いている間は呼ばない）"""
+    with weather_lock:
+        if time.monotonic() < weather_stats["open_until"]:
+            weather_stats["short_circuits"] += 1
+            return None
+        weather_stats["upstream_calls"] += 1
+    
+    weather_info = None
     try:
-        url = f"http://api.openweathermap.org/data/2.5/weather?q={location}&appid={WEATHER_API_KEY}&units=metric&lang=ja"
-        response = requests.get(url, timeout=5)
+        params = {"q": location, "appid": WEATHER_API_KEY, "units": "metric", "lang": "ja"}
+        response = weather_session.get(WEATHER_API_URL, params=params, timeout=5)
         
         if response.status_code == 200:
             data = response.json()
@@ -270,27 +1057,85 @@ def get_weather_data(location):
                 "description": data["weather"][0]["description"],
                 "icon": data["weather"][0]["icon"]
             }
-            return weather_info
-        else:
-            return None
     except Exception as e:
         print(f"Weather API Error: {e}")
-        return None
-
-def get_month_calendar(year, month):
-    """指定された年月のカレンダーデータを取得"""
-    cal = calendar.Calendar(firstweekday=6)
-    month_days = cal.monthdayscalendar(year, month)
-    weeknames = ['日', '月', '火', '水', '木', '金', '土']
-    return month_days, weeknames
+    
+    record_weather_result(weather_info is not None)
+    return weather_info
 
-def generate_event_id(date, user_events):
-    """新しいイベントIDを生成"""
-    if date not in user_events or len(user_events[date]) == 0:
-        return 1
+def refresh_weather_cache(location, done):
+    """天気を取得してキャッシュを差し替える（失敗時は既存のキャッシュを残す）"""
+    try:
+        data = fetch_weather_data(location)
+        if data is not None:
+            with weather_lock:
+                weather_cache[location] = {"data": data, "fetched_at": time.monotonic()}
+    finally:
+        with weather_lock:
+            weather_inflight.pop(location, None)
+        done.set()
+
+def get_weather_data(location, wait=True):
+    """天気情報をキャッシュから返す（必要なときだけAPIを呼ぶ）
+    
+    wait=False の場合はキャッシュが無くても待たずにNoneを返し、取得は裏で行う
+    """
+    with weather_lock:
+        entry = weather_cache.get(location)
+        age = time.monotonic() - entry["fetched_at"] if entry else None
+        if entry and age < WEATHER_CACHE_TTL_SECONDS:
+            weather_stats["hits"] += 1
+            return entry["data"]
+        usable = entry is not None and age < WEATHER_STALE_SECONDS
+        weather_stats["stale_hits" if usable else "misses"] += 1
+        done = weather_inflight.get(location)
+        is_leader = done is None
+        if is_leader:
+            done = weather_inflight[location] = threading.Event()
+    
+    if usable or not wait:
+        # 手元の値（無ければNone）を返しつつ裏で取り直す
+        if is_leader:
+            threading.Thread(target=refresh_weather_cache, args=(location, done), daemon=True).start()
+        return entry["data"] if usable else None
+    
+    if is_leader:
+        refresh_weather_cache(location, done)
     else:
-        max_id = max(ev.get("id", 0) for ev in user_events[date])
-        return max_id + 1
+        done.wait(WEATHER_WAIT_SECONDS)
+    
+    entry = weather_cache.get(location)
+    if entry and time.monotonic() - entry["fetched_at"] < WEATHER_STALE_SECONDS:
+        return entry["data"]
+    return None
+
+@app.route("/api/weather")
+def weather_api():
+    """天気情報をJSONで返す（カレンダー表示とは別に取得する用）"""
+    if "username" not in session:
+        return jsonify({"error": "未ログイン"}), 401
+    
+    location = request.args.get("location", "Tokyo")
+    weather = get_weather_data(location)
+    if weather is None:
+        return jsonify({"success": False, "error": "天気情報を取得できませんでした"}), 503
+    return jsonify({"success": True, "weather": weather})
+
+@app.route("/api/weather/status")
+def weather_status():
+    """天気キャッシュとサーキットブレーカーの監視用情報"""
+    with weather_lock:
+        stats = dict(weather_stats)
+        locations = len(weather_cache)
+    open_for = max(stats.pop("open_until") - time.monotonic(), 0)
+    return jsonify({
+        **stats,
+        "cached_locations": locations,
+        "circuit_open": open_for > 0,
+        "circuit_open_seconds": round(open_for, 1),
+        "cache_ttl_seconds": WEATHER_CACHE_TTL_SECONDS,
+        "stale_seconds": WEATHER_STALE_SECONDS
+    })
 
 # =============================================================================
 # ペットシステム定数
@@ -301,6 +1146,39 @@ EXP_TABLE = {
     5: 30, 6: 40, 7: 50, 8: 60, 9: 70,
 }
 
+# EXP_THRESHOLDS[level] = Lv.0からそのレベルに到達するまでの累計経験値
+EXP_THRESHOLDS = list(itertools.accumulate((EXP_TABLE[level] for level in sorted(EXP_TABLE)), initial=0))
+
+FOOD_EXP = {
+    '基本の餌': 1,
+    'おいしい餌': 6,
+    'プレミアム餌': 14,
+    'スペシャル餌': 32,
+}
+
+MAX_FEED_QUANTITY = 999
+
+def plan_feeding(level, exp, max_level, foods):
+    """餌をまとめて与えた結果（レベル・残り経験値・実際に消費する個数）を累計経験値から一度に計算
+    
+    foods は (餌の名前, 個数) の並び。最終進化に必要な分を超える餌は消費しない
+    """
+    start_total = EXP_THRESHOLDS[level] + exp
+    cap = EXP_THRESHOLDS[max_level]
+    total = start_total
+    consumed = {}
+    
+    for food_name, quantity in foods:
+        unit = FOOD_EXP[food_name]
+        needed = max(-(-(cap - total) // unit), 0)
+        used = min(quantity, needed)
+        if used:
+            consumed[food_name] = consumed.get(food_name, 0) + used
+            total += used * unit
+    
+    new_level = min(bisect.bisect_right(EXP_THRESHOLDS, total) - 1, max_level)
+    return new_level, total - EXP_THRESHOLDS[new_level], total - start_total, consumed
+
 def calculate_success_reward(duration_minutes):
     """予定達成時のコインの獲得数を計算"""
     if duration_minutes < 30:
@@ -380,30 +1258,6 @@ def get_evolution_type(pet_type):
     
     return random.choices(evolution_types, weights=weight_values)[0]
 
-def get_rarity_stars(image_name):
-    """ペット画像からレアリティ星を計算"""
-    import re
-    
-    bird_match = re.match(r'pet1/lv10_type(\d+)\.gif', image_name)
-    if bird_match:
-        evo_type = int(bird_match.group(1))
-        weights = BIRD_EVOLUTION_WEIGHTS
-        total_weight = sum(weights.values())
-        probability = (weights.get(evo_type, 0) / total_weight) * 100
-        return calculate_stars_from_probability(probability)
-    
-    other_match = re.match(r'pet(\d+)/lv5_type(\d+)\.gif', image_name)
-    if other_match:
-        pet_type = int(other_match.group(1))
-        evo_type = int(other_match.group(2))
-        weights = EVOLUTION_WEIGHTS.get(pet_type, {})
-        if weights:
-            total_weight = sum(weights.values())
-            probability = (weights.get(evo_type, 0) / total_weight) * 100
-            return calculate_stars_from_probability(probability)
-    
-    return None
-
 def calculate_stars_from_probability(probability):
     """出現確率から星の数を計算"""
     if probability <= 5:
@@ -447,6 +1301,100 @@ PET_NAMES = {
     "pet6/death.jpg": "肥料",
 }
 
+# =============================================================================
+# 図鑑カタログ（起動時に1回だけ構築する不変データ）
+# =============================================================================
+
+PokedexEntry = namedtuple("PokedexEntry", ["index", "image", "name", "pet_type", "stage", "evolution", "rarity"])
+
+def build_pokedex_catalog():
+    """PET_NAMESとEVOLUTION_WEIGHTSから図鑑に並ぶ全70種類を図鑑の表示順で作成"""
+    entries = []
+    
+    def add(image, pet_type, stage, evolution=None, rarity=None):
+        entries.append(PokedexEntry(
+            index=len(entries), image=image, name=PET_NAMES.get(image, "???"),
+            pet_type=pet_type, stage=stage, evolution=evolution, rarity=rarity
+        ))
+    
+    for pet_type, weights in sorted(EVOLUTION_WEIGHTS.items()):
+        max_level = 10 if pet_type == 1 else 5
+        total_weight = sum(weights.values())
+        
+        for level in range(1, max_level):
+            add(f"pet{pet_type}/lv{level}.gif", pet_type, level)
+        
+        for evo_type, weight in sorted(weights.items()):
+            rarity = calculate_stars_from_probability(weight / total_weight * 100)
+            add(f"pet{pet_type}/lv{max_level}_type{evo_type}.gif", pet_type, max_level, evo_type, rarity)
+        
+        add(f"pet{pet_type}/death.jpg", pet_type, None)
+    
+    return tuple(entries)
+
+POKEDEX_CATALOG = build_pokedex_catalog()
+POKEDEX_SIZE = len(POKEDEX_CATALOG)
+CATALOG_INDEX = {entry.image: entry.index for entry in POKEDEX_CATALOG}
+
+# 発見済みペットはカタログの番号をビット位置としたビットマスクでも保持する
+# （$bitで更新できるよう32ビットずつ pokedex.discovered_mask.w0, w1, ... に分割）
+DISCOVERED_MASK_WORD_BITS = 32
+DISCOVERED_MASK_WORDS = (POKEDEX_SIZE + DISCOVERED_MASK_WORD_BITS - 1) // DISCOVERED_MASK_WORD_BITS
+
+# ★の数ごとに該当するビットを集めたマスク（★合計 = Σ ★数 × popcount(発見 & マスク)）
+STAR_MASKS = {}
+for _entry in POKEDEX_CATALOG:
+    if _entry.rarity:
+        STAR_MASKS[_entry.rarity] = STAR_MASKS.get(_entry.rarity, 0) | (1 << _entry.index)
+
+def pokedex_mask_from_images(image_names):
+    """画像パスのリストをビットマスクに変換（カタログにない画像は無視）"""
+    mask = 0
+    for image_name in image_names:
+        index = CATALOG_INDEX.get(image_name)
+        if index is not None:
+            mask |= 1 << index
+    return mask
+
+def pokedex_mask_words(mask):
+    """ビットマスクを保存用の32ビットごとのフィールドに分割（0のワードは省略）"""
+    words = {}
+    for i in range(DISCOVERED_MASK_WORDS):
+        word = (mask >> (i * DISCOVERED_MASK_WORD_BITS)) & ((1 << DISCOVERED_MASK_WORD_BITS) - 1)
+        if word:
+            words[f"w{i}"] = Int64(word)
+    return words
+
+def get_discovered_mask(user_pokedex):
+    """図鑑データから発見済みビットマスクを取得（未移行のデータは発見リストから計算）"""
+    words = user_pokedex.get("discovered_mask")
+    if words is None:
+        return pokedex_mask_from_images(user_pokedex.get("discovered", []))
+    
+    mask = 0
+    for i in range(DISCOVERED_MASK_WORDS):
+        mask |= int(words.get(f"w{i}", 0)) << (i * DISCOVERED_MASK_WORD_BITS)
+    return mask
+
+def count_discovered(mask):
+    """発見数（立っているビットの数）"""
+    return mask.bit_count()
+
+def total_stars_from_mask(mask):
+    """発見済みペットの★合計"""
+    return sum(stars * (mask & star_mask).bit_count() for stars, star_mask in STAR_MASKS.items())
+
+def pokedex_scores(mask):
+    """ランキング用に非正規化して保持するスコア（発見数・★合計）"""
+    return {"discovery_count": count_discovered(mask), "total_stars": total_stars_from_mask(mask)}
+
+def with_derived_pokedex_fields(user_pokedex):
+    """発見リストから計算したビットマスクとランキング用スコアを図鑑データに付け加える（移行用）"""
+    mask = pokedex_mask_from_images(user_pokedex.get("discovered", []))
+    user_pokedex["discovered_mask"] = pokedex_mask_words(mask)
+    user_pokedex.update(pokedex_scores(mask))
+    return user_pokedex
+
 PET_TYPES = {
     1: {
         "name": "ペット1",
@@ -482,16 +1430,15 @@ PET_TYPES = {
     }
 }
 
-def get_pet_image():
-    """現在のペットの画像パスを取得"""
-    pet = get_user_pet()
+def get_pet_image(pet=None):
+    """ペットの状態から画像パスを求める（図鑑の更新などの副作用なし）"""
+    if pet is None:
+        pet = get_user_pet()
     pet_type = pet.get("pet_type")
     
     if not pet["alive"]:
         if pet["started"] and pet_type:
-            img = f"pet{pet_type}/death.jpg"
-            add_to_pokedex(img)
-            return img
+            return f"pet{pet_type}/death.jpg"
         return f"pet{pet_type}/egg.jpg" if pet_type else "pet1/egg.jpg"
     
     if pet["level"] == 0:
@@ -499,22 +1446,14 @@ def get_pet_image():
     
     if pet_type == 1:
         if pet["level"] == 10:
-            img = f"pet1/lv10_type{pet['evolution']}.gif"
-            add_to_pokedex(img)
-            return img
+            return f"pet1/lv10_type{pet['evolution']}.gif"
         else:
-            img = f"pet1/lv{pet['level']}.gif"
-            add_to_pokedex(img)
-            return img
+            return f"pet1/lv{pet['level']}.gif"
     
     if pet["level"] == 5:
-        img = f"pet{pet_type}/lv5_type{pet['evolution']}.gif"
-        add_to_pokedex(img)
-        return img
+        return f"pet{pet_type}/lv5_type{pet['evolution']}.gif"
     
-    img = f"pet{pet_type}/lv{pet['level']}.gif"
-    add_to_pokedex(img)
-    return img
+    return f"pet{pet_type}/lv{pet['level']}.gif"
 
 # =============================================================================
 # 認証ルート
@@ -552,7 +1491,9 @@ def signup():
         users_collection.insert_one({
             "username": username,
             "password": generate_password_hash(password),
-            "created_at": datetime.now(JST).isoformat()
+            "created_at": datetime.now(JST).isoformat(),
+            "layout_version": USER_LAYOUT_VERSION,
+            "events": {"collection": event_days_collection.name}
         })
         
         return redirect(url_for("login"))
@@ -577,6 +1518,77 @@ def logout():
     session.pop("username", None)
     return redirect(url_for("login"))
 
+# =============================================================================
+# 描画済みHTMLの断片キャッシュ
+# =============================================================================
+# 月表示グリッドとタイムラインは予定が変わらない限り同じHTMLになるので、
+# (ユーザー, データバージョン, 表示条件) をキーに描画結果をプロセス内で使い回す。
+# 書き込みでバージョンが進むと古いキーは参照されなくなり、LRUで追い出される。
+
+FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_SIZE", 1024))
+
+fragment_cache = OrderedDict()
+fragment_cache_lock = threading.Lock()
+
+def render_cached_fragment(key, template_name, **context):
+    """キーに対応する描画済みHTMLを返す（無ければ描画してキャッシュ）"""
+    with fragment_cache_lock:
+        html = fragment_cache.get(key)
+        if html is not None:
+            fragment_cache.move_to_end(key)
+            return html
+    
+    html = Markup(render_template(template_name, **context))
+    with fragment_cache_lock:
+        fragment_cache[key] = html
+        fragment_cache.move_to_end(key)
+        while len(fragment_cache) > FRAGMENT_CACHE_SIZE:
+            fragment_cache.popitem(last=False)
+    return html
+
+# =============================================================================
+# 条件付きGET（ETag）
+# =============================================================================
+# ページの内容はユーザーのデータバージョン・テンプレート・日付で決まるので、
+# それらからETagを作り、If-None-Matchが一致すれば重いデータを読む前に304を返す。
+# （現在時刻の表示はcalendar.jsが読み込み時に更新する）
+
+template_hashes = {}
+
+def get_template_hash(template_name):
+    """テンプレートのソースのハッシュ（変更されたらETagも変わる）"""
+    if template_name not in template_hashes:
+        source = app.jinja_loader.get_source(app.jinja_env, template_name)[0]
+        template_hashes[template_name] = hashlib.sha1(source.encode("utf-8")).hexdigest()[:12]
+    return template_hashes[template_name]
+
+def get_user_etag(*template_names):
+    """現在のユーザー・URL・データバージョン・テンプレート・日付からETagを作る"""
+    key = json.dumps([
+        session.get("username"),
+        request.full_path,
+        get_user_versions(),
+        [get_template_hash(name) for name in template_names],
+        datetime.now(JST).strftime("%Y-%m-%d"),
+    ], ensure_ascii=False)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+def not_modified_response(etag):
+    """If-None-MatchがETagと一致すれば304レスポンス、そうでなければNone"""
+    if not request.if_none_match.contains(etag):
+        return None
+    response = make_response("", 304)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+def with_etag(body, etag):
+    """レスポンスにETagを付け、毎回再検証させる"""
+    response = make_response(body)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
 # =============================================================================
 # カレンダールート
 # =============================================================================
@@ -594,13 +1606,26 @@ def index_get(year, month):
     if "username" not in session:
         return redirect(url_for("login"))
     
+    etag = get_user_etag("calendar.html", "calendar_timeline.html", "calendar_month_grid.html")
+    not_modified = not_modified_response(etag)
+    if not_modified:
+        return not_modified
+    
+    prefetch_user_sections("calendar")
+    
     username = session.get("username")
-    user_events = get_user_events()
+    month_start, month_end = get_month_date_range(year, month)
+    user_events = get_user_events(month_start, month_end)
     user_goals = get_user_goals()
     user_locs = get_user_locations()
     
     weeks, weeknames = get_month_calendar(year, month)
     today = datetime.now(JST).strftime("%Y-%m-%d")
+    # 表示月以外を見ているときも今日の予定だけは別途取得する
+    if today not in user_events and not (month_start <= today <= month_end):
+        today_day_events = get_user_day_events(today)
+        if today_day_events:
+            user_events[today] = today_day_events
     today_events = user_events.get(today, [])
     today_events_sorted = sorted(today_events, key=lambda x: x.get("start_time", x.get("time", "00:00")))
 
@@ -613,61 +1638,152 @@ def index_get(year, month):
     month_key = f"{year}-{str(month).zfill(2)}"
     current_goal = user_goals.get(month_key, {"goal": "", "achieved": False})
 
-    weather = get_weather_data("Tokyo")
+    # 天気の取得は待たない（キャッシュが無ければ裏で取得し、/api/weatherか次回の表示で反映）
+    weather = get_weather_data("Tokyo", wait=False)
+    
+    # タイムラインの表示は「終了時刻を過ぎた予定」が増えたときだけ変わる
+    data_version = get_user_data_version()
+    past_event_ids = tuple(ev.get("id") for ev in today_events_sorted if ev.get("end_time", "23:59") <= now_time)
+    timeline_html = render_cached_fragment(
+        (username, "timeline", data_version, today, past_event_ids),
+        "calendar_timeline.html",
+        today=today, today_events=today_events_sorted, now_time=now_time
+    )
+    month_grid_html = render_cached_fragment(
+        (username, "month_grid", data_version, year, month, today),
+        "calendar_month_grid.html",
+        year=year, month=month, weeks=weeks, events=user_events, today=today
+    )
 
-    return render_template(
+    return with_etag(render_template(
         "calendar.html",
         year=year, month=month, weeks=weeks, weeknames=weeknames,
         events=user_events, today=today, today_events=today_events_sorted,
         now_time=now_time,
         prev_link=url_for("index_get", year=prev_year, month=prev_month),
         next_link=url_for("index_get", year=next_year, month=next_month),
-        pet=pet, image=get_pet_image(), exp_table=EXP_TABLE,
+        pet=pet, image=get_pet_image(pet), exp_table=EXP_TABLE,
         username=username, current_goal=current_goal,
         month_key=month_key, weather=weather,
-        locations=user_locs, pet_types=PET_TYPES
-    )
+        locations=user_locs, pet_types=PET_TYPES, recurrence_freqs=RECURRENCE_FREQS,
+        event_settings=get_user_settings(),
+        timeline_html=timeline_html, month_grid_html=month_grid_html
+    ), etag)
 
 # =============================================================================
 # イベント管理ルート
 # =============================================================================
 
-@app.route("/add_event", methods=["POST"])
-def add_event():
-    if "username" not in session:
-        return redirect(url_for("login"))
-    
-    user_events = get_user_events()
-    date_str = request.form.get("date", "")
-    start_time = request.form.get("start_time", "")
-    end_time = request.form.get("end_time", "")
-    event_text = request.form.get("event", "")
-    location = request.form.get("location", "その他")
+def validate_event_times(start_time, end_time):
+    """予定の開始・終了時間をチェック（問題があればエラーメッセージを返す）"""
+    if not all(re.fullmatch(r"(?:[01]\d|2[0-3]):[0-5]\d", value) for value in (start_time, end_time)):
+        return "時間の形式が不正です"
+    if start_time >= end_time:
+        return "終了時間は開始時間より後にしてください"
+    return None
 
+def validate_new_event(date_str, start_time, end_time):
+    """追加する予定の日付と時間をチェック（問題があればエラーメッセージを返す）"""
     if not re.match(r"\d{4}-\d{2}-\d{2}", date_str):
-        return "日付形式が不正です", 400
+        return "日付形式が不正です"
 
-    if start_time >= end_time:
-        return "終了時間は開始時間より後にしてください", 400
+    error = validate_event_times(start_time, end_time)
+    if error:
+        return error
 
     today_str = datetime.now(JST).strftime("%Y-%m-%d")
     now_time_str = datetime.now(JST).strftime("%H:%M")
 
     if date_str < today_str:
-        return "過去の日付の予定は追加できません", 400
+        return "過去の日付の予定は追加できません"
     if date_str == today_str and end_time < now_time_str:
-        return "今日の過去時間の予定は追加できません", 400
-
-    if date_str not in user_events:
-        user_events[date_str] = []
+        return "今日の過去時間の予定は追加できません"
+    return None
 
-    new_id = generate_event_id(date_str, user_events)
-    user_events[date_str].append({
-        "id": new_id, "start_time": start_time, "end_time": end_time, 
+def create_user_event(date_str, start_time, end_time, event_text, location):
+    """予定を1件追加して、追加した予定を返す"""
+    new_event = {
+        "id": next_event_id(), "start_time": start_time, "end_time": end_time, 
         "event": event_text, "location": location, "done": None
-    })
-    user_events[date_str].sort(key=lambda x: x["start_time"])
-    save_user_events(user_events)
+    }
+    if not push_user_event(date_str, new_event):
+        # カウンタが既存IDに追いついていない場合は、その日の最大IDまで進めて再発行
+        max_id = max(ev.get("id", 0) for ev in get_user_day_events(date_str))
+        users_collection.update_one({"username": session["username"]}, {"$max": {"event_seq": max_id}})
+        new_event["id"] = next_event_id()
+        push_user_event(date_str, new_event)
+    return new_event
+
+def read_recurrence_fields(data):
+    """フォーム/JSONから繰り返しの指定を取り出す（繰り返さない場合はNone）"""
+    freq = data.get("repeat") or None
+    if freq is None:
+        return None
+    
+    def optional_int(name):
+        value = data.get(name)
+        if value in (None, ""):
+            return None
+        try:
+            return int(value)
+        except (ValueError, TypeError):
+            return value
+    
+    # 省略した場合だけ1にする（0などの不正な値はvalidate_recurrenceで断る）
+    interval = optional_int("interval")
+    exceptions = data.get("exceptions")
+    return {
+        "freq": freq,
+        "interval": interval if interval is not None else 1,
+        "until": data.get("until") or None,
+        "count": optional_int("count"),
+        "exceptions": [
+            day for day in (exceptions if isinstance(exceptions, list) else [])
+            if isinstance(day, str) and re.fullmatch(r"\d{4}-\d{2}-\d{2}", day)
+        ],
+    }
+
+def update_user_event_or_occurrence(date_str, event_id, fields):
+    """予定を更新する（繰り返し予定の回はその日だけ通常の予定として切り離して更新）"""
+    if update_user_event(date_str, event_id, fields):
+        return True
+    rule = find_recurring_occurrence(date_str, event_id)
+    if rule is None:
+        return False
+    skip_recurring_occurrence(date_str, event_id)
+    detached = create_user_event(
+        date_str, fields["start_time"], fields["end_time"], fields["event"], fields["location"]
+    )
+    done = rule.get("done", {}).get(date_str)
+    if done is not None:
+        update_user_event(date_str, detached["id"], {"done": done})
+    return True
+
+@app.route("/add_event", methods=["POST"])
+def add_event():
+    if "username" not in session:
+        return redirect(url_for("login"))
+    
+    date_str = request.form.get("date", "")
+    start_time = request.form.get("start_time", "")
+    end_time = request.form.get("end_time", "")
+    event_text = request.form.get("event", "")
+    location = request.form.get("location", "その他")
+
+    error = validate_new_event(date_str, start_time, end_time)
+    recurrence = read_recurrence_fields(request.form)
+    if not error and recurrence:
+        error = validate_recurrence(date_str, recurrence["freq"], recurrence["interval"],
+                                    recurrence["until"], recurrence["count"])
+    if not error:
+        error = check_event_overlap(date_str, start_time, end_time, recurrence)
+    if error:
+        return error, 400
+
+    if recurrence:
+        create_recurring_event(date_str, start_time, end_time, event_text, location, **recurrence)
+    else:
+        create_user_event(date_str, start_time, end_time, event_text, location)
 
     dt = datetime.strptime(date_str, "%Y-%m-%d")
     return redirect(url_for("index_get", year=dt.year, month=dt.month))
@@ -677,7 +1793,6 @@ def update_event():
     if "username" not in session:
         return redirect(url_for("login"))
     
-    user_events = get_user_events()
     date_str = request.form.get("date", "")
     event_id = int(request.form.get("id", 0))
     new_start_time = request.form.get("start_time", "")
@@ -685,42 +1800,762 @@ def update_event():
     new_event = request.form.get("event", "")
     new_location = request.form.get("location", "その他")
 
-    if new_start_time >= new_end_time:
-        return "終了時間は開始時間より後にしてください", 400
+    error = (validate_event_times(new_start_time, new_end_time)
+             or check_event_overlap(date_str, new_start_time, new_end_time, ignore_id=event_id))
+    if error:
+        return error, 400
 
-    if date_str not in user_events:
+    updated = update_user_event_or_occurrence(date_str, event_id, {
+        "start_time": new_start_time,
+        "end_time": new_end_time,
+        "event": new_event,
+        "location": new_location,
+    })
+    if not updated:
         return "日付データなし", 404
 
-    for ev in user_events[date_str]:
-        if ev["id"] == event_id:
-            ev["start_time"] = new_start_time
-            ev["end_time"] = new_end_time
-            ev["event"] = new_event
-            ev["location"] = new_location
-            save_user_events(user_events)
-            break
-
     dt = datetime.strptime(date_str, "%Y-%m-%d")
     return redirect(url_for("index_get", year=dt.year, month=dt.month))
 
+# =============================================================================
+# 予定のJSON API（カレンダー全体を再描画せずに差分だけ反映する用）
+# =============================================================================
+
+EVENTS_API_MAX_DAYS = 366
+
+def parse_date_arg(value):
+    """YYYY-MM-DD形式の日付を検証（不正な場合はValueError）"""
+    return datetime.strptime(value or "", "%Y-%m-%d").strftime("%Y-%m-%d")
+
+@app.route("/api/events", methods=["GET"])
+def events_api_list():
+    """指定した月（year, month）または期間（start, end）の予定を日付ごとに返す"""
+    if "username" not in session:
+        return jsonify({"error": "未ログイン"}), 401
+    
+    try:
+        if "start" in request.args or "end" in request.args:
+            start_date = parse_date_arg(request.args.get("start"))
+            end_date = parse_date_arg(request.args.get("end"))
+        else:
+            year = int(request.args.get("year", ""))
+            month = int(request.args.get("month", ""))
+            start_date, end_date = get_month_date_range(year, month)
+    except (ValueError, TypeError, calendar.IllegalMonthError):
+        return jsonify({"error": "期間の指定が不正です"}), 400
+    
+    span = (datetime.strptime(end_date, "%Y-%m-%d") - datetime.strptime(start_date, "%Y-%m-%d")).days
+    if span < 0 or span >= EVENTS_API_MAX_DAYS:
+        return jsonify({"error": f"期間は{EVENTS_API_MAX_DAYS}日以内で指定してください"}), 400
+    
+    return jsonify({
+        "success": True,
+        "start": start_date,
+        "end": end_date,
+        "events": get_user_events(start_date, end_date)
+    })
+
+@app.route("/api/events/create", methods=["POST"])
+def events_api_create():
+    """予定を追加し、その日の予定一覧を返す"""
+    if "username" not in session:
+        return jsonify({"error": "未ログイン"}), 401
+    
+    data = request.get_json(silent=True) or {}
+    date_str = data.get("date", "")
+    start_time = data.get("start_time", "")
+    end_time = data.get("end_time", "")
+    
+    error = validate_new_event(date_str, start_time, end_time)
+    recurrence = read_recurrence_fields(data)
+    if not error and recurrence:
+        error = validate_recurrence(date_str, recurrence["freq"], recurrence["interval"],
+                                    recurrence["until"], recurrence["count"])
+    if not error:
+        error = check_event_overlap(date_str, start_time, end_time, recurrence)
+    if error:
+        return jsonify({"error": error}), 400
+    
+    if recurrence:
+        rule = create_recurring_event(
+            date_str, start_time, end_time, data.get("event", ""), data.get("location", "その他"), **recurrence
+        )
+        return jsonify({"success": True, "date": date_str, "recurring": True, "rule": rule})
+    
+    event = create_user_event(
+        date_str, start_time, end_time, data.get("event", ""), data.get("location", "その他")
+    )
+    return jsonify({
+        "success": True,
+        "date": date_str,
+        "event": event,
+        "events": get_user_day_events(date_str)
+    })
+
+@app.route("/api/events/update", methods=["POST"])
+def events_api_update():
+    """予定を更新し、その日の予定一覧を返す"""
+    if "username" not in session:
+        return jsonify({"error": "未ログイン"}), 401
+    
+    data = request.get_json(silent=True) or {}
+    date_str = data.get("date", "")
+    start_time = data.get("start_time", "")
+    end_time = data.get("end_time", "")
+    try:
+        event_id = int(data.get("id", 0))
+    except (ValueError, TypeError):
+        return jsonify({"error": "無効な予定IDです"}), 400
+    
+    error = (validate_event_times(start_time, end_time)
+             or check_event_overlap(date_str, start_time, end_time, ignore_id=event_id))
+    if error:
+        return jsonify({"error": error}), 400
+    
+    updated = update_user_event_or_occurrence(date_str, event_id, {
+        "start_time": start_time,
+        "end_time": end_time,
+        "event": data.get("event", ""),
+        "location": data.get("location", "その他"),
+    })
+    if not updated:
+        return jsonify({"error": "日付データなし"}), 404
+    
+    return jsonify({
+        "success": True,
+        "date": date_str,
+        "events": get_user_day_events(date_str)
+    })
+
+@app.route("/api/events/recurring/delete", methods=["POST"])
+def events_api_delete_recurring():
+    """繰り返し予定をすべての回ごと削除"""
+    if "username" not in session:
+        return jsonify({"error": "未ログイン"}), 401
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        event_id = int(data.get("id", 0))
+    except (ValueError, TypeError):
+        return jsonify({"error": "無効な予定IDです"}), 400
+    
+    if not delete_recurring_event(event_id):
+        return jsonify({"error": "繰り返し予定が見つかりません"}), 404
+    return jsonify({"success": True})
+
+@app.route("/api/events/free_slots", methods=["GET"])
+def events_api_free_slots():
+    """期間（start, end、省略時は今日）の空き時間を日付ごとに返す（from, toで時間帯、minで最短の分数）"""
+    if "username" not in session:
+        return jsonify({"error": "未ログイン"}), 401
+    
+    today_str = datetime.now(JST).strftime("%Y-%m-%d")
+    try:
+        start_date = parse_date_arg(request.args.get("start", today_str))
+        end_date = parse_date_arg(request.args.get("end", start_date))
+        min_minutes = parse_int_arg("min", 1, 1, DAY_MINUTES)
+    except (ValueError, TypeError):
+        return jsonify({"error": "期間の指定が不正です"}), 400
+    
+    span = (parse_ymd(end_date) - parse_ymd(start_date)).days
+    if span < 0 or span >= EVENTS_API_MAX_DAYS:
+        return jsonify({"error": f"期間は{EVENTS_API_MAX_DAYS}日以内で指定してください"}), 400
+    
+    time_from = request.args.get("from", "00:00")
+    time_to = request.args.get("to", "24:00")
+    if (not all(re.fullmatch(r"(?:[01]\d|2[0-3]):[0-5]\d|24:00", value) for value in (time_from, time_to))
+            or time_from >= time_to):
+        return jsonify({"error": "時間帯の指定が不正です"}), 400
+    range_start, range_end = time_to_minutes(time_from), time_to_minutes(time_to)
+    
+    events_by_date = get_user_events(start_date, end_date)
+    slots = {}
+    for offset in range(span + 1):
+        date_str = (parse_ymd(start_date) + timedelta(days=offset)).isoformat()
+        day = build_day_intervals(events_by_date.get(date_str, []))
+        slots[date_str] = [
+            {"start": minutes_to_time(start), "end": minutes_to_time(end), "minutes": end - start}
+            for start, end in find_free_slots(day, range_start, range_end, min_minutes)
+        ]
+    
+    return jsonify({"success": True, "start": start_date, "end": end_date, "slots": slots})
+
+@app.route("/api/events/settings", methods=["GET", "POST"])
+def events_api_settings():
+    """予定に関する設定（reject_overlaps: 時間が重なる予定を登録しない）の取得・変更"""
+    if "username" not in session:
+        return jsonify({"error": "未ログイン"}), 401
+    
+    settings = get_user_settings()
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        if "reject_overlaps" in data:
+            if not isinstance(data["reject_overlaps"], bool):
+                return jsonify({"error": "設定の値が不正です"}), 400
+            settings = dict(settings, reject_overlaps=data["reject_overlaps"])
+            save_user_settings(settings)
+    
+    return jsonify({"success": True, "settings": settings})
+
+# =============================================================================
+# 予定の検索（n-gramインデックス）
+# =============================================================================
+# MongoDBのテキストインデックスは日本語を単語に区切れないため、予定ごとに本文と
+# 場所の1文字・2文字のn-gram（search_grams）を保存し、
+# (username, events.search_grams, date) のインデックスで候補の日だけを読む。
+# n-gramの一致は候補の絞り込みにだけ使い、部分一致かどうかはここで確かめる。
+# 結果は日付・開始時刻の新しい順に1行1件のJSON（NDJSON）で流し、
+# 最後の行に続きを取得するためのカーソルを付ける。
+
+EVENT_SEARCH_PAGE_LIMIT = 100
+EVENT_SEARCH_RECURRING_DAYS = 365  # 期間の終わりを省略した場合、繰り返し予定は今日から1年先まで展開する
+
+def parse_search_terms(query):
+    """検索語を空白で区切り、インデックスで引くn-gramと一緒に返す"""
+    terms = normalize_search_text(query).split()
+    grams = set()
+    for term in terms:
+        if len(term) == 1:
+            grams.add(term)
+        else:
+            grams.update(term[i:i + 2] for i in range(len(term) - 1))
+    return terms, sorted(grams)
+
+def event_matches_search(event, terms, location):
+    """予定が検索語をすべて含み、場所の条件に合うか"""
+    if location and event.get("location") != location:
+        return False
+    haystack = normalize_search_text(event.get("event")) + "\n" + normalize_search_text(event.get("location"))
+    return all(term in haystack for term in terms)
+
+def event_search_key(row):
+    """並び順（新しい順）とカーソルに使うキー"""
+    return row["date"], row.get("start_time", row.get("time", "00:00")), row["id"]
+
+def encode_event_search_cursor(row):
+    """最後に返した行から続きを取得するカーソルを作成"""
+    raw = json.dumps(list(event_search_key(row)), ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_event_search_cursor(cursor):
+    """検索カーソルを解析（不正な場合はValueError）"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        date_str, start_time, event_id = json.loads(raw.decode("utf-8"))
+    except Exception:
+        raise ValueError("invalid cursor")
+    if not isinstance(start_time, str) or not isinstance(event_id, int):
+        raise ValueError("invalid cursor")
+    return parse_date_arg(date_str), start_time, event_id
+
+def event_search_row(date_str, event):
+    """検索結果の1行（画面で使う項目だけ）"""
+    row = {
+        "date": date_str,
+        "id": event.get("id", 0),
+        "start_time": event.get("start_time", event.get("time", "00:00")),
+        "end_time": event.get("end_time", ""),
+        "event": event.get("event", ""),
+        "location": event.get("location", "その他"),
+        "done": event.get("done"),
+    }
+    if event.get("recurrence"):
+        row["recurrence"] = event["recurrence"]
+    return row
+
+def search_single_events(username, grams, terms, location, start_date, end_date):
+    """日付ごとの予定から一致するものを新しい順に返す（インデックスで候補日を絞る）"""
+    date_range = {"$lte": end_date} if end_date else {}
+    if start_date:
+        date_range["$gte"] = start_date
+    element = {}
+    if grams:
+        element["search_grams"] = {"$all": grams}
+    if location:
+        element["location"] = location
+    query = {"username": username}
+    if element:
+        query["events"] = {"$elemMatch": element}
+    if date_range:
+        query["date"] = date_range
+    
+    docs = event_days_collection.find(query, EVENT_DAY_PROJECTION).sort("date", -1).batch_size(50)
+    for doc in docs:
+        rows = [event_search_row(doc["date"], ev) for ev in doc.get("events", [])
+                if event_matches_search(ev, terms, location)]
+        yield from sorted(rows, key=event_search_key, reverse=True)
+
+def search_recurring_events(username, grams, terms, location, start_date, end_date):
+    """一致する繰り返し予定を期間内で展開し、新しい順に返す"""
+    query = {"username": username}
+    if grams:
+        query["search_grams"] = {"$all": grams}
+    if location:
+        query["location"] = location
+    if start_date:
+        query["$or"] = [{"last_date": None}, {"last_date": {"$gte": start_date}}]
+    query["start_date"] = {"$lte": end_date}
+    
+    rows = []
+    for rule in recurring_events_collection.find(query, {"_id": 0, "search_grams": 0}):
+        if not event_matches_search(rule, terms, location):
+            continue
+        for date_str in expand_recurrence(rule, start_date or rule["start_date"], end_date):
+            rows.append(event_search_row(date_str, recurring_occurrence(rule, date_str)))
+    return sorted(rows, key=event_search_key, reverse=True)
+
+@app.route("/api/events/search", methods=["GET"])
+def events_api_search():
+    """予定の本文・場所を検索（q, location, from, to, limit, cursor）して1行1件のJSONで返す"""
+    if "username" not in session:
+        return jsonify({"error": "未ログイン"}), 401
+    
+    username = session["username"]
+    terms, grams = parse_search_terms(request.args.get("q", ""))
+    location = request.args.get("location") or None
+    try:
+        start_date = parse_date_arg(request.args["from"]) if request.args.get("from") else None
+        end_date = parse_date_arg(request.args["to"]) if request.args.get("to") else None
+    except ValueError:
+        return jsonify({"error": "期間の指定が不正です"}), 400
+    try:
+        limit = parse_int_arg("limit", 50, 1, EVENT_SEARCH_PAGE_LIMIT)
+    except (ValueError, TypeError):
+        return jsonify({"error": "件数の指定が不正です"}), 400
+    cursor = None
+    if request.args.get("cursor"):
+        try:
+            cursor = decode_event_search_cursor(request.args["cursor"])
+        except ValueError:
+            return jsonify({"error": "カーソルが不正です"}), 400
+    
+    # カーソルより後の日は読まない（同じ日の残りは並び順のキーで飛ばす）
+    if cursor and (end_date is None or cursor[0] < end_date):
+        end_date = cursor[0]
+    recurring_end = end_date or (datetime.now(JST).date() + timedelta(days=EVENT_SEARCH_RECURRING_DAYS)).isoformat()
+    
+    def generate():
+        rows = heapq.merge(
+            search_single_events(username, grams, terms, location, start_date, end_date),
+            search_recurring_events(username, grams, terms, location, start_date, recurring_end),
+            key=event_search_key, reverse=True
+        )
+        if cursor:
+            rows = itertools.dropwhile(lambda row: event_search_key(row) >= cursor, rows)
+        last_row = None
+        for count, row in enumerate(rows):
+            if count == limit:
+                # limit + 1件目があれば続きがあるので、最後に返した行をカーソルにする
+                yield json.dumps({"next_cursor": encode_event_search_cursor(last_row)}) + "\n"
+                return
+            yield json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n"
+            last_row = row
+        yield json.dumps({"next_cursor": None}) + "\n"
+    
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+# =============================================================================
+# iCalendar（ICS）の書き出し・取り込み
+# =============================================================================
+# 書き出しは日付順に読みながら予定ごとにVEVENTを出力し、全体をメモリ上に組み立てない。
+# 取り込みはアップロードを1行ずつ読んでVEVENTごとに検証し、ICS_IMPORT_BATCH_SIZE件
+# ごとにIDをまとめて確保して、日付ごとの$pushをbulk_writeで書き込む。
+# 検証はadd_eventと同じ（validate_new_event / validate_recurrence）で、
+# 取り込めなかった予定は理由と一緒に返す。
+
+ICS_IMPORT_BATCH_SIZE = 500
+ICS_IMPORT_MAX_EVENTS = int(os.environ.get("ICS_IMPORT_MAX_EVENTS", 20000))
+ICS_SKIPPED_REPORT_LIMIT = 100  # レスポンスに含める「取り込めなかった予定」の上限
+ICS_RRULE_FREQS = {"DAILY": "daily", "WEEKLY": "weekly", "MONTHLY": "monthly"}
+ICS_WEEKDAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+ICS_HEADER = (
+    "BEGIN:VCALENDAR\r\n"
+    "VERSION:2.0\r\n"
+    "PRODID:-//FurLife//Calendar//JA\r\n"
+    "CALSCALE:GREGORIAN\r\n"
+    "BEGIN:VTIMEZONE\r\n"
+    "TZID:Asia/Tokyo\r\n"
+    "BEGIN:STANDARD\r\n"
+    "DTSTART:19700101T000000\r\n"
+    "TZOFFSETFROM:+0900\r\n"
+    "TZOFFSETTO:+0900\r\n"
+    "TZNAME:JST\r\n"
+    "END:STANDARD\r\n"
+    "END:VTIMEZONE\r\n"
+)
+
+def escape_ics_text(text):
+    """ICSのTEXT値として書けるようにエスケープ"""
+    return (text or "").replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+def unescape_ics_text(text):
+    """ICSのTEXT値のエスケープを戻す"""
+    return re.sub(r"\\(.)", lambda m: "\n" if m.group(1) in "nN" else m.group(1), text)
+
+def fold_ics_line(line):
+    """1行を75バイト以内で折り返す（マルチバイト文字の途中では切らない）"""
+    chunks = []
+    current, size, limit = "", 0, 75
+    for ch in line:
+        width = len(ch.encode("utf-8"))
+        if size + width > limit:
+            chunks.append(current)
+            current, size, limit = "", 0, 74  # 継続行は先頭の空白の分だけ短くする
+        current += ch
+        size += width
+    chunks.append(current)
+    return "\r\n ".join(chunks) + "\r\n"
+
+def ics_local_datetime(date_str, time_str):
+    """YYYY-MM-DD と HH:MM からTZID付きで書く日時（YYYYMMDDTHHMMSS）を作る"""
+    return date_str.replace("-", "") + "T" + time_str.replace(":", "")[:4] + "00"
+
+def ics_vevent(date_str, event, dtstamp, rule=None):
+    """1件の予定（繰り返し予定はルール）をVEVENTの文字列にする"""
+    start_time = event.get("start_time", event.get("time", "00:00"))
+    end_time = event.get("end_time") or start_time
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:event-{event.get('id', 0)}-{date_str.replace('-', '')}@furlife",
+        f"DTSTAMP:{dtstamp}",
+        f"DTSTART;TZID=Asia/Tokyo:{ics_local_datetime(date_str, start_time)}",
+        f"DTEND;TZID=Asia/Tokyo:{ics_local_datetime(date_str, end_time)}",
+        f"SUMMARY:{escape_ics_text(event.get('event', ''))}",
+        f"LOCATION:{escape_ics_text(event.get('location', 'その他'))}",
+    ]
+    if rule:
+        rrule = f"RRULE:FREQ={rule['freq'].upper()};INTERVAL={rule.get('interval', 1)}"
+        if rule.get("count"):
+            rrule += f";COUNT={rule['count']}"
+        if rule.get("until"):
+            # 開始がTZID付きの日時なので、UNTILは終了日の終わり（JST）をUTCで書く
+            until = JST.localize(datetime.strptime(rule["until"], "%Y-%m-%d").replace(hour=23, minute=59, second=59))
+            rrule += f";UNTIL={until.astimezone(pytz.utc).strftime('%Y%m%dT%H%M%SZ')}"
+        lines.append(rrule)
+        if rule.get("exceptions"):
+            exdates = ",".join(ics_local_datetime(day, start_time) for day in rule["exceptions"])
+            lines.append(f"EXDATE;TZID=Asia/Tokyo:{exdates}")
+    lines.append("END:VEVENT")
+    return "".join(fold_ics_line(line) for line in lines)
+
+def generate_user_ics(username):
+    """ユーザーの予定をICSとして少しずつ出力する"""
+    dtstamp = datetime.now(pytz.utc).strftime("%Y%m%dT%H%M%SZ")
+    yield ICS_HEADER
+    days = event_days_collection.find({"username": username}, EVENT_DAY_PROJECTION).sort("date", 1).batch_size(200)
+    for doc in days:
+        yield "".join(ics_vevent(doc["date"], ev, dtstamp) for ev in doc.get("events", []))
+    rules = recurring_events_collection.find({"username": username}, {"_id": 0, "search_grams": 0}).sort("start_date", 1)
+    for rule in rules:
+        yield ics_vevent(rule["start_date"], rule, dtstamp, rule=rule)
+    yield "END:VCALENDAR\r\n"
+
+def read_ics_lines(stream):
+    """アップロードを1行ずつ読み、折り返しを戻した行を返す"""
+    pending = None
+    for raw in stream:
+        line = raw.rstrip(b"\r\n")
+        if line[:1] in (b" ", b"\t") and pending is not None:
+            # 折り返しはマルチバイト文字の途中のこともあるので、つないでから文字列にする
+            pending += line[1:]
+            continue
+        if pending is not None:
+            yield pending.decode("utf-8", errors="replace")
+        pending = line
+    if pending:
+        yield pending.decode("utf-8", errors="replace")
+
+def parse_ics_property(line):
+    """「NAME;PARAM=VALUE:値」を (NAME, {PARAM: VALUE}, 値) に分ける（形式が違えばNone）"""
+    in_quotes = False
+    for index, ch in enumerate(line):
+        if ch == '"':
+            in_quotes = not in_quotes
+        elif ch == ":" and not in_quotes:
+            break
+    else:
+        return None
+    name, *params = line[:index].split(";")
+    params = dict(param.split("=", 1) for param in params if "=" in param)
+    return name.upper(), {key.upper(): value.strip('"') for key, value in params.items()}, line[index + 1:]
+
+def read_ics_events(lines):
+    """VEVENTごとにプロパティの辞書を返す（VALARMなど入れ子の部品は読み飛ばす）"""
+    props = None
+    nested = 0
+    for line in lines:
+        prop = parse_ics_property(line)
+        if prop is None:
+            continue
+        name, params, value = prop
+        if name == "BEGIN" and value.upper() == "VEVENT":
+            props, nested = {}, 0
+        elif props is None:
+            continue
+        elif name == "BEGIN":
+            nested += 1
+        elif name == "END" and nested:
+            nested -= 1
+        elif name == "END" and value.upper() == "VEVENT":
+            yield props
+            props = None
+        elif not nested:
+            props.setdefault(name, []).append((params, value))
+
+ICS_DATETIME_PATTERN = re.compile(r"(\d{4})(\d{2})(\d{2})(?:$|T(\d{2})(\d{2})(\d{2}))")
+
+def parse_ics_datetime(params, value):
+    """DTSTARTなどの値を日本時間の日時に変換し、(日時, 日付のみか) を返す
+    
+    取り込みでは1件ごとに2回呼ぶので、strptimeを使わずに数字を切り出し、
+    日本時間（TZIDがAsia/Tokyoか無し）の場合はタイムゾーンの変換もしない
+    """
+    match = ICS_DATETIME_PATTERN.match(value)
+    if not match:
+        raise ValueError(value)
+    year, month, day, hour, minute, second = match.groups()
+    if params.get("VALUE", "").upper() == "DATE" or hour is None:
+        return datetime(int(year), int(month), int(day)), True
+    moment = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
+    if value.endswith("Z"):
+        moment = pytz.utc.localize(moment).astimezone(JST)
+    elif params.get("TZID") and params["TZID"] != JST.zone:
+        try:
+            zone = pytz.timezone(params["TZID"])
+        except pytz.UnknownTimeZoneError:
+            zone = JST
+        moment = zone.localize(moment).astimezone(JST)
+    # TZIDの無い日時（floating）は日本時間として扱う
+    return moment.replace(tzinfo=None), False
+
+def parse_ics_duration(value):
+    """DURATION（例: PT1H30M）をtimedeltaに変換"""
+    match = re.fullmatch(r"P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?", value)
+    if not match:
+        raise ValueError(value)
+    weeks, days, hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds)
+
+def parse_ics_rrule(value, start):
+    """RRULEを繰り返しの指定に変換（対応していない指定ならValueError）"""
+    parts = dict(part.split("=", 1) for part in value.upper().split(";") if "=" in part)
+    freq = ICS_RRULE_FREQS.get(parts.pop("FREQ", None))
+    if freq is None:
+        raise ValueError("未対応の繰り返しです")
+    # 開始日と同じ曜日・日にちを指定しているだけのBYDAY/BYMONTHDAYは読み飛ばせる
+    if freq == "weekly" and parts.get("BYDAY") == ICS_WEEKDAYS[start.weekday()]:
+        parts.pop("BYDAY")
+    if freq == "monthly" and parts.get("BYMONTHDAY") == str(start.day):
+        parts.pop("BYMONTHDAY")
+    parts.pop("WKST", None)
+    try:
+        interval = int(parts.pop("INTERVAL", 1))
+        count = int(parts.pop("COUNT")) if "COUNT" in parts else None
+        until = parse_ics_datetime({}, parts.pop("UNTIL"))[0].strftime("%Y-%m-%d") if "UNTIL" in parts else None
+    except ValueError:
+        raise ValueError("繰り返しの形式が不正です")
+    if parts:
+        raise ValueError("未対応の繰り返しです")
+    return {"freq": freq, "interval": interval, "until": until, "count": count}
+
+def ics_to_event(props):
+    """VEVENTを取り込む予定に変換（取り込めない場合は理由をValueErrorで返す）"""
+    if "DTSTART" not in props:
+        raise ValueError("開始日時がありません")
+    try:
+        start, all_day = parse_ics_datetime(*props["DTSTART"][0])
+        if "DTEND" in props:
+            end = parse_ics_datetime(*props["DTEND"][0])[0]
+        elif "DURATION" in props:
+            end = start + parse_ics_duration(props["DURATION"][0][1])
+        elif all_day:
+            end = start + timedelta(days=1)
+        else:
+            end = None
+    except ValueError:
+        raise ValueError("日時の形式が不正です")
+    if end is None:
+        raise ValueError("終了日時がありません")
+    
+    date_str = start.strftime("%Y-%m-%d")
+    start_time = start.strftime("%H:%M")
+    if end.date() == start.date():
+        end_time = end.strftime("%H:%M")
+    elif end == datetime.combine(start.date() + timedelta(days=1), datetime.min.time()):
+        end_time = "23:59"  # 翌日0時まで（終日の予定を含む）は、その日の終わりまでとする
+    else:
+        raise ValueError("日をまたぐ予定は取り込めません")
+    
+    error = validate_new_event(date_str, start_time, end_time)
+    if error:
+        raise ValueError(error)
+    
+    recurrence = None
+    if "RRULE" in props:
+        recurrence = parse_ics_rrule(props["RRULE"][0][1], start)
+        try:
+            recurrence["exceptions"] = sorted({
+                parse_ics_datetime(params, day)[0].strftime("%Y-%m-%d")
+                for params, value in props.get("EXDATE", []) for day in value.split(",") if day
+            })
+        except ValueError:
+            raise ValueError("除外日の形式が不正です")
+        error = validate_recurrence(date_str, recurrence["freq"], recurrence["interval"],
+                                    recurrence["until"], recurrence["count"])
+        if error:
+            raise ValueError(error)
+    
+    return {
+        "date": date_str, "start_time": start_time, "end_time": end_time,
+        "event": unescape_ics_text(props.get("SUMMARY", [({}, "")])[0][1]),
+        "location": unescape_ics_text(props.get("LOCATION", [({}, "")])[0][1]) or "その他",
+        "recurrence": recurrence,
+    }
+
+def write_imported_events(entries):
+    """取り込んだ予定をまとめて保存し、(通常の予定の件数, 繰り返し予定の件数) を返す"""
+    first_id = reserve_event_ids(len(entries))
+    events_by_date = {}
+    rules = []
+    for event_id, entry in enumerate(entries, first_id):
+        if entry["recurrence"]:
+            rules.append(with_stored_fields(build_recurring_rule(
+                event_id, entry["date"], entry["start_time"], entry["end_time"],
+                entry["event"], entry["location"], **entry["recurrence"]
+            )))
+            continue
+        events_by_date.setdefault(entry["date"], []).append(with_stored_fields({
+            "id": event_id, "start_time": entry["start_time"], "end_time": entry["end_time"],
+            "event": entry["event"], "location": entry["location"], "done": None
+        }))
+    
+    username = session.get("username")
+    operations = [
+        UpdateOne(
+            {"username": username, "date": date_str},
+            {"$push": {"events": {"$each": day_events, "$sort": EVENT_DAY_ORDER}}},
+            upsert=True
+        )
+        for date_str, day_events in events_by_date.items()
+    ]
+    clear_user_events_cache()
+    if operations:
+        try:
+            event_days_collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # 同じ日への同時upsertで一意制約に当たった分は、既存の日のドキュメントへの追加としてやり直す
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != 11000 for error in errors):
+                raise
+            event_days_collection.bulk_write([operations[error["index"]] for error in errors], ordered=False)
+    if rules:
+        recurring_events_collection.insert_many(rules, ordered=False)
+    return len(entries) - len(rules), len(rules)
+
+def drop_overlapping_entries(entries):
+    """既存の予定や先に取り込む予定と重なるものを除き、(残す予定, [(除いた予定, 理由)]) を返す"""
+    checks = [(entry, *overlap_check_dates(entry["date"], entry["recurrence"])) for entry in entries]
+    range_start = min(entry["date"] for entry in entries)
+    range_end = max(end_date for _, _, end_date in checks)
+    events_by_date = {date_str: list(events) for date_str, events in get_user_events(range_start, range_end).items()}
+    
+    kept = []
+    dropped = []
+    for entry, dates, _ in checks:
+        conflict = find_schedule_conflict(events_by_date, dates, entry["start_time"], entry["end_time"])
+        if conflict:
+            dropped.append((entry, overlap_error(conflict)))
+            continue
+        kept.append(entry)
+        for date_str in dates:
+            events_by_date.setdefault(date_str, []).append(
+                {"start_time": entry["start_time"], "end_time": entry["end_time"]}
+            )
+    return kept, dropped
+
+@app.route("/api/events/export.ics", methods=["GET"])
+def events_api_export_ics():
+    """ユーザーの予定をすべてICS（iCalendar）で書き出す"""
+    if "username" not in session:
+        return jsonify({"error": "未ログイン"}), 401
+    
+    response = Response(stream_with_context(generate_user_ics(session["username"])),
+                        mimetype="text/calendar")
+    response.headers["Content-Disposition"] = "attachment; filename=furlife.ics"
+    return response
+
+@app.route("/api/events/import", methods=["POST"])
+def events_api_import_ics():
+    """アップロードされたICSファイル（file）の予定を取り込み、取り込めなかった予定を報告する"""
+    if "username" not in session:
+        return jsonify({"error": "未ログイン"}), 401
+    
+    upload = request.files.get("file")
+    if upload is None:
+        return jsonify({"error": "ファイルを選択してください"}), 400
+    
+    reject_overlaps = get_user_settings().get("reject_overlaps")
+    imported = {"events": 0, "recurring": 0}
+    skipped = []
+    skipped_count = 0
+    truncated = False
+    
+    def skip(index, summary, reason):
+        nonlocal skipped_count
+        skipped_count += 1
+        if len(skipped) < ICS_SKIPPED_REPORT_LIMIT:
+            skipped.append({"index": index, "event": summary, "reason": reason})
+    
+    def write_batch(entries):
+        if reject_overlaps:
+            entries, dropped = drop_overlapping_entries(entries)
+            for entry, reason in dropped:
+                skip(entry["index"], entry["event"], reason)
+        if entries:
+            events, rules = write_imported_events(entries)
+            imported["events"] += events
+            imported["recurring"] += rules
+    
+    batch = []
+    for index, props in enumerate(read_ics_events(read_ics_lines(upload.stream)), 1):
+        if index > ICS_IMPORT_MAX_EVENTS:
+            truncated = True
+            break
+        try:
+            entry = ics_to_event(props)
+        except ValueError as e:
+            skip(index, unescape_ics_text(props.get("SUMMARY", [({}, "")])[0][1]), str(e))
+            continue
+        entry["index"] = index
+        batch.append(entry)
+        if len(batch) >= ICS_IMPORT_BATCH_SIZE:
+            write_batch(batch)
+            batch = []
+    if batch:
+        write_batch(batch)
+    
+    if truncated:
+        print(f"⚠️ ICS import truncated at {ICS_IMPORT_MAX_EVENTS} events for {session['username']}")
+    return jsonify({
+        "success": True,
+        "imported": imported["events"],
+        "imported_recurring": imported["recurring"],
+        "skipped_count": skipped_count,
+        "skipped": skipped,
+        "truncated": truncated,
+    })
+
 @app.route("/delete_event", methods=["POST"])
 def delete_event():
     if "username" not in session:
         return jsonify({"error": "未ログイン"}), 401
     
-    user_events = get_user_events()
     date_str = request.form.get("date", "")
     event_id = int(request.form.get("id", 0))
 
-    if date_str not in user_events:
+    # 繰り返し予定はその日の回だけを除外する
+    if not pull_user_event(date_str, event_id) and not skip_recurring_occurrence(date_str, event_id):
         return jsonify({"error": "日付データなし"}), 404
-
-    user_events[date_str] = [ev for ev in user_events[date_str] if ev["id"] != event_id]
-    
-    if len(user_events[date_str]) == 0:
-        del user_events[date_str]
-    
-    save_user_events(user_events)
     return jsonify({"success": True})
 
 @app.route("/set_done", methods=["POST"])
@@ -728,64 +2563,62 @@ def set_done():
     if "username" not in session:
         return jsonify({"error": "未ログイン"}), 401
     
-    user_events = get_user_events()
     pet = get_user_pet()
     
     date_str = request.form.get("date", "")
     event_id = int(request.form.get("id", 0))
     done_value = request.form.get("done")
 
-    if date_str not in user_events:
+    ev = mark_user_event_done(date_str, event_id, done_value == "true")
+    if ev is None:
+        # 繰り返し予定の場合はその日の回にだけ記録する
+        ev = mark_recurring_event_done(date_str, event_id, done_value == "true")
+    if ev is None:
+        already_set = event_days_collection.count_documents(
+            {"username": session["username"], "date": date_str, "events.id": event_id}, limit=1
+        ) or find_recurring_occurrence(date_str, event_id) is not None
+        if already_set:
+            return jsonify({"error": "すでに設定済み"}), 400
         return jsonify({"error": "該当イベントなし"}), 404
+    ev["done"] = done_value == "true"
+    
+    interval = event_interval(ev)
+    duration_minutes = interval.end - interval.start
 
-    for ev in user_events[date_str]:
-        if ev.get("id") == event_id:
-            if ev.get("done") is not None:
-                return jsonify({"error": "すでに設定済み"}), 400
-
-            ev["done"] = True if done_value == "true" else False
-            save_user_events(user_events)
-            
-            start_time = ev.get("start_time", "00:00")
-            end_time = ev.get("end_time", "23:59")
-            start_h, start_m = map(int, start_time.split(":"))
-            end_h, end_m = map(int, end_time.split(":"))
-            duration_minutes = (end_h * 60 + end_m) - (start_h * 60 + start_m)
-
-            if ev["done"]:
-                pet["alive"] = True
-                pet["started"] = True
-                
-                coin_reward = calculate_success_reward(duration_minutes)
-                pet["coins"] += coin_reward
-                
-                pet["message"] = f"タスク完了!コインを{coin_reward}枚獲得!(コイン: {pet['coins']})"
-            else:
-                pet_type = pet.get("pet_type", 1)
-                penalty = calculate_failure_penalty(duration_minutes, pet["level"], pet_type)
-                
-                if penalty["dies"]:
-                    pet["alive"] = False
-                    pet["level"] = 0
-                    pet["exp"] = 0
-                    pet["message"] = "ペットが死亡しました…"
-                else:
-                    level_down = penalty["level_down"]
-                    pet["level"] = max(0, pet["level"] - level_down)
-                    pet["exp"] = 0
-                    pet["message"] = f"できなかった…レベルが{level_down}下がって{pet['level']}に!"
-            
-            save_user_pet(pet)
-            break
+    if ev["done"]:
+        pet["alive"] = True
+        pet["started"] = True
+        
+        coin_reward = calculate_success_reward(duration_minutes)
+        credit_coins(coin_reward)
+        
+        pet["message"] = f"タスク完了!コインを{coin_reward}枚獲得!(コイン: {pet['coins']})"
     else:
-        return jsonify({"error": "該当イベントなし"}), 404
+        pet_type = pet.get("pet_type", 1)
+        penalty = calculate_failure_penalty(duration_minutes, pet["level"], pet_type)
+        
+        if penalty["dies"]:
+            pet["alive"] = False
+            pet["level"] = 0
+            pet["exp"] = 0
+            pet["message"] = "ペットが死亡しました…"
+        else:
+            level_down = penalty["level_down"]
+            pet["level"] = max(0, pet["level"] - level_down)
+            pet["exp"] = 0
+            pet["message"] = f"できなかった…レベルが{level_down}下がって{pet['level']}に!"
+        
+        # 死亡・レベルダウンで姿が変わった場合は図鑑に記録
+        record_pokedex_discovery([get_pet_image(pet)])
+    
+    save_user_pet(pet)
 
     return jsonify({
         "success": True,
         "pet_level": pet["level"],
         "pet_alive": pet["alive"],
         "pet_coins": pet["coins"],
-        "pet_image": get_pet_image(),
+        "pet_image": get_pet_image(pet),
         "pet_message": pet["message"],
         "pet_exp": pet["exp"],
         "next_exp": EXP_TABLE.get(pet["level"], 0),
@@ -801,8 +2634,13 @@ def get_locations():
     if "username" not in session:
         return jsonify({"error": "未ログイン"}), 401
     
+    etag = get_user_etag()
+    not_modified = not_modified_response(etag)
+    if not_modified:
+        return not_modified
+    
     locations = get_user_locations()
-    return jsonify({"success": True, "locations": locations})
+    return with_etag(jsonify({"success": True, "locations": locations}), etag)
 
 @app.route("/save_locations", methods=["POST"])
 def save_locations_route():
@@ -859,11 +2697,21 @@ def achieve_goal():
     if user_goals[month_key]["achieved"]:
         return jsonify({"error": "すでに達成済みです"}), 400
     
-    user_goals[month_key]["achieved"] = True
-    save_user_goals(user_goals)
+    if not is_safe_field_key(month_key):
+        return jsonify({"error": "無効な月の指定です"}), 400
+    
+    # 達成済みへの切り替えを条件付きで行い、報酬が二重に付与されないようにする
+    claimed = users_collection.update_one(
+        {"username": session["username"], f"goals.{month_key}.achieved": False},
+        {"$set": {f"goals.{month_key}.achieved": True}}
+    )
+    if claimed.modified_count == 0:
+        return jsonify({"error": "すでに達成済みです"}), 400
+    sync_user_doc_cache("goals", lambda goals: goals.get(month_key, {}).update(achieved=True))
+    note_user_data_changed()
     
     coin_reward = 1500
-    pet["coins"] += coin_reward
+    credit_coins(coin_reward)
     pet["message"] = f"月目標達成おめでとう!コインを{coin_reward}枚獲得!(コイン: {pet['coins']})"
     save_user_pet(pet)
     
@@ -882,6 +2730,13 @@ def shop():
     if "username" not in session:
         return redirect(url_for("login"))
     
+    etag = get_user_etag("shop.html")
+    not_modified = not_modified_response(etag)
+    if not_modified:
+        return not_modified
+    
+    prefetch_user_sections("shop")
+    
     username = session.get("username")
     pet = get_user_pet()
     
@@ -892,14 +2747,14 @@ def shop():
         {"name": "スペシャル餌", "price": 200, "emoji": "🎁", "exp": 32},
     ]
     
-    return render_template(
+    return with_etag(render_template(
         "shop.html",
         pet=pet,
         foods=foods,
         username=username,
-        image=get_pet_image(),
+        image=get_pet_image(pet),
         exp_table=EXP_TABLE
-    )
+    ), etag)
 
 @app.route("/buy_food", methods=["POST"])
 def buy_food():
@@ -932,11 +2787,9 @@ def buy_food():
     unit_price = food_prices[food_name]
     total_price = unit_price * quantity
     
-    if pet["coins"] < total_price:
+    if move_inventory({food_name: quantity}, coins=-total_price) is None:
         return jsonify({"error": "コインが足りません"}), 400
     
-    pet["coins"] -= total_price
-    pet["inventory"][food_name] = pet["inventory"].get(food_name, 0) + quantity
     pet["message"] = f"『{food_name}』を{quantity}個購入しました！"
     save_user_pet(pet)
     
@@ -956,94 +2809,34 @@ def pet_detail():
     if "username" not in session:
         return redirect(url_for("login"))
     
-    username = session.get("username")
-    user_pokedex = get_user_pokedex()
+    etag = get_user_etag("pet_detail.html")
+    not_modified = not_modified_response(etag)
+    if not_modified:
+        return not_modified
     
-    all_pets = []
-    
-    # ペット1系統(鳥系統 - 20種類)
-    for level in range(1, 10):
-        img_name = f"pet1/lv{level}.gif"
-        育成_count = user_pokedex["育成_counts"].get(img_name, 0)
-        all_pets.append({
-            "image": img_name,
-            "name": PET_NAMES.get(img_name, "???"),
-            "discovered": img_name in user_pokedex["discovered"],
-            "pet_type": 1,
-            "育成_count": 育成_count,
-            "rarity": None
-        })
+    prefetch_user_sections("pet_detail")
     
-    for evo_type in range(1, 11):
-        img_name = f"pet1/lv10_type{evo_type}.gif"
-        育成_count = user_pokedex["育成_counts"].get(img_name, 0)
-        rarity = get_rarity_stars(img_name)
-        all_pets.append({
-            "image": img_name,
-            "name": PET_NAMES.get(img_name, "???"),
-            "discovered": img_name in user_pokedex["discovered"],
-            "pet_type": 1,
-            "育成_count": 育成_count,
-            "rarity": rarity
-        })
+    username = session.get("username")
+    user_pokedex = get_user_pokedex()
     
-    img_name = "pet1/death.jpg"
-    育成_count = user_pokedex["育成_counts"].get(img_name, 0)
-    all_pets.append({
-        "image": img_name,
-        "name": PET_NAMES.get(img_name, "???"),
-        "discovered": img_name in user_pokedex["discovered"],
-        "pet_type": 1,
-        "育成_count": 育成_count,
-        "rarity": None
-    })
+    discovered_mask = get_discovered_mask(user_pokedex)
     
-    # ペット2-6系統(各10種類)
-    for pet_type in range(2, 7):
-        for level in range(1, 5):
-            img_name = f"pet{pet_type}/lv{level}.gif"
-            育成_count = user_pokedex["育成_counts"].get(img_name, 0)
-            all_pets.append({
-                "image": img_name,
-                "name": PET_NAMES.get(img_name, "???"),
-                "discovered": img_name in user_pokedex["discovered"],
-                "pet_type": pet_type,
-                "育成_count": 育成_count,
-                "rarity": None
-            })
-        
-        for evo_type in range(1, 6):
-            img_name = f"pet{pet_type}/lv5_type{evo_type}.gif"
-            育成_count = user_pokedex["育成_counts"].get(img_name, 0)
-            rarity = get_rarity_stars(img_name)
-            all_pets.append({
-                "image": img_name,
-                "name": PET_NAMES.get(img_name, "???"),
-                "discovered": img_name in user_pokedex["discovered"],
-                "pet_type": pet_type,
-                "育成_count": 育成_count,
-                "rarity": rarity
-            })
-        
-        img_name = f"pet{pet_type}/death.jpg"
-        育成_count = user_pokedex["育成_counts"].get(img_name, 0)
-        all_pets.append({
-            "image": img_name,
-            "name": PET_NAMES.get(img_name, "???"),
-            "discovered": img_name in user_pokedex["discovered"],
-            "pet_type": pet_type,
-            "育成_count": 育成_count,
-            "rarity": None
-        })
+    # 不変の図鑑カタログにユーザーの発見状況・育成回数を重ねる
+    all_pets = [
+        dict(entry._asdict(),
+             discovered=bool(discovered_mask >> entry.index & 1),
+             育成_count=get_育成_count(user_pokedex, entry.image))
+        for entry in POKEDEX_CATALOG
+    ]
     
     pet = get_user_pet()
     
-    return render_template(
+    return with_etag(render_template(
         "pet_detail.html",
-        pet=pet, image=get_pet_image(), exp_table=EXP_TABLE,
+        pet=pet, image=get_pet_image(pet), exp_table=EXP_TABLE,
         all_pets=all_pets, pet_names=PET_NAMES, username=username,
         pet_types=PET_TYPES
-    )
+    ), etag)
 
 @app.route("/start", methods=["POST"])
 def start():
@@ -1068,18 +2861,18 @@ def start():
         "alive": pet["alive"], "started": pet["started"],
         "level": pet["level"], "food": pet["food"],
         "exp": pet["exp"], "next_exp": EXP_TABLE[0],
-        "image": get_pet_image(), "message": pet["message"],
+        "image": get_pet_image(pet), "message": pet["message"],
         "pet_type": pet_type
     })
 
 @app.route("/feed", methods=["POST"])
 def feed():
+    """餌を与える（quantityで個数、foodsで複数種類をまとめて指定可能）"""
     if "username" not in session:
         return jsonify({"error": "未ログイン"}), 401
     
     pet = get_user_pet()
     data = request.get_json() if request.is_json else {}
-    food_name = data.get("food_name", "基本の餌")
     
     if not pet["alive"]:
         return jsonify({"message": "まだ育てていません。"})
@@ -1091,98 +2884,108 @@ def feed():
         pet["message"] = "最終進化に到達!これ以上は成長できません。"
         return jsonify({
             "message": pet["message"], 
-            "image": get_pet_image(),
+            "image": get_pet_image(pet),
             "exp": pet["exp"], 
             "next_exp": 0,
             "level": pet["level"],
             "inventory": pet["inventory"]
         })
 
-    if pet["inventory"].get(food_name, 0) <= 0:
-        pet["message"] = f"{food_name}がありません!"
-        return jsonify({
-            "message": pet["message"],
-            "image": get_pet_image(),
-            "exp": pet["exp"],
-            "next_exp": EXP_TABLE.get(pet["level"], 0),
-            "level": pet["level"],
-            "inventory": pet["inventory"]
-        })
+    # 与える餌の一覧 [(餌の名前, 個数), ...]
+    if isinstance(data.get("foods"), dict):
+        requested = list(data["foods"].items())
+    else:
+        requested = [(data.get("food_name", "基本の餌"), data.get("quantity", 1))]
+    
+    foods = []
+    for food_name, quantity in requested:
+        if food_name not in FOOD_EXP:
+            return jsonify({"error": "無効な餌です"}), 400
+        try:
+            quantity = int(quantity)
+        except (ValueError, TypeError):
+            return jsonify({"error": "無効な個数です"}), 400
+        if quantity < 1 or quantity > MAX_FEED_QUANTITY:
+            return jsonify({"error": f"個数は1〜{MAX_FEED_QUANTITY}の範囲で指定してください"}), 400
+        foods.append((food_name, quantity))
+    
+    requested_totals = {}
+    for food_name, quantity in foods:
+        requested_totals[food_name] = requested_totals.get(food_name, 0) + quantity
+    
+    for food_name, quantity in requested_totals.items():
+        if pet["inventory"].get(food_name, 0) < quantity:
+            owned = pet["inventory"].get(food_name, 0)
+            pet["message"] = f"{food_name}がありません!" if owned <= 0 else f"{food_name}が足りません!(所持数: {owned})"
+            return jsonify({
+                "message": pet["message"],
+                "image": get_pet_image(pet),
+                "exp": pet["exp"],
+                "next_exp": EXP_TABLE.get(pet["level"], 0),
+                "level": pet["level"],
+                "inventory": pet["inventory"]
+            })
 
-    food_exp = {
-        '基本の餌': 1,
-        'おいしい餌': 6,
-        'プレミアム餌': 14,
-        'スペシャル餌': 32,
-    }
+    start_level = pet["level"]
+    new_level, new_exp, exp_gain, consumed = plan_feeding(start_level, pet["exp"], max_level, foods)
+    levels_gained = new_level - start_level
+    
+    changes = {"level": new_level, "exp": new_exp}
+    if new_level == max_level:
+        changes["evolution"] = get_evolution_type(pet_type)
+    
+    evolution = changes.get("evolution", pet.get("evolution", 1))
+    if levels_gained == 0:
+        changes["message"] = f"経験値+{exp_gain}! (EXP: {new_exp}/{EXP_TABLE.get(new_level, 0)})"
+    elif new_level == max_level:
+        changes["message"] = f"最終進化!タイプ{evolution}に進化した!!!(Lv.{start_level}→Lv.{new_level})" if levels_gained > 1 else f"最終進化!タイプ{evolution}に進化した!!!"
+    elif levels_gained == 1:
+        changes["message"] = f"レベルアップ!!!(レベル{new_level})"
+    else:
+        changes["message"] = f"{levels_gained}レベルアップ!!!(Lv.{start_level}→Lv.{new_level})"
     
-    exp_gain = food_exp.get(food_name, 1)
+    # 在庫の減算とレベル・経験値の更新を1回の条件付き更新で行う
+    # （在庫が足りない・他のリクエストで育成状態が変わった場合は何も書き込まない）
+    snapshot = get_user_doc_entry("pet", lambda raw: raw)["snapshot"]
+    guard = {}
+    for field in ("level", "exp"):
+        guard[f"pet.{field}"] = snapshot[field] if field in snapshot else {"$exists": False}
     
-    pet["inventory"][food_name] -= 1
-    pet["exp"] += exp_gain
+    used = {food_name: -quantity for food_name, quantity in consumed.items()}
+    if move_inventory(used, set_fields=changes, guard=guard) is None:
+        return jsonify({"error": "ペットの状態が変わりました。もう一度お試しください"}), 409
     
-    start_level = pet["level"]
-    levels_gained = 0
-
-    # レベルアップ判定（ループ内では保存しない）
-    while pet["level"] < max_level:
-        required_exp = EXP_TABLE.get(pet["level"], 999)
-        if pet["exp"] >= required_exp:
-            pet["level"] += 1
-            pet["exp"] -= required_exp
-            levels_gained += 1
-        else:
-            break
-
-    if pet["level"] == max_level:
-        pet["evolution"] = get_evolution_type(pet_type)
-
-    save_user_pet(pet)
-
-    # ★改善: レベルアップした場合のみ図鑑更新
-    if levels_gained > 0:
-        # ★改善: 画像取得を1回だけに
-        evolved_image = get_pet_image()
-        add_to_pokedex(evolved_image)
-        increment_育成_count(evolved_image)
-        
-        # ★改善: メッセージ生成
-        if pet["level"] == max_level:
-            pet["message"] = f"最終進化!タイプ{pet['evolution']}に進化した!!!(Lv.{start_level}→Lv.{pet['level']})" if levels_gained > 1 else f"最終進化!タイプ{pet['evolution']}に進化した!!!"
-        elif levels_gained == 1:
-            pet["message"] = f"レベルアップ!!!(レベル{pet['level']})"
-        else:
-            pet["message"] = f"{levels_gained}レベルアップ!!!(Lv.{start_level}→Lv.{pet['level']})"
-        
-        save_user_pet(pet)
-        
+    if levels_gained == 0:
         return jsonify({
             "level": pet["level"],
             "exp": pet["exp"], 
-            "next_exp": EXP_TABLE.get(pet["level"], 0) if pet["level"] < max_level else 0,
+            "next_exp": EXP_TABLE.get(pet["level"], 0),
             "message": pet["message"], 
-            "image": evolved_image,
-            "pet_type": pet_type,
-            "evolution": pet.get("evolution", 1),
+            "image": get_pet_image(pet),
             "inventory": pet["inventory"],
-            "levels_gained": levels_gained,
-            "start_level": start_level
+            "consumed": consumed
         })
-    else:
-        # レベルアップしなかった場合
-        required_exp = EXP_TABLE.get(pet["level"], 0)
-        pet["message"] = f"経験値+{exp_gain}! (EXP: {pet['exp']}/{required_exp})"
-        save_user_pet(pet)
-
-    next_exp = EXP_TABLE.get(pet["level"], 0)
-
+    
+    # 通過した段階をすべて返し、図鑑にもまとめて1回で記録する
+    passed_levels = [
+        {"level": level, "image": get_pet_image({**pet, "level": level})}
+        for level in range(start_level + 1, new_level + 1)
+    ]
+    record_pokedex_discovery([passed["image"] for passed in passed_levels], raised=True)
+    
     return jsonify({
         "level": pet["level"],
         "exp": pet["exp"], 
-        "next_exp": next_exp,
+        "next_exp": EXP_TABLE.get(pet["level"], 0) if pet["level"] < max_level else 0,
         "message": pet["message"], 
-        "image": get_pet_image(),
-        "inventory": pet["inventory"]
+        "image": passed_levels[-1]["image"],
+        "pet_type": pet_type,
+        "evolution": pet.get("evolution", 1),
+        "inventory": pet["inventory"],
+        "consumed": consumed,
+        "levels_gained": levels_gained,
+        "start_level": start_level,
+        "passed_levels": passed_levels
     })
 
 @app.route("/revive", methods=["POST"])
@@ -1208,7 +3011,7 @@ def revive():
     
     return jsonify({
         "alive": pet["alive"], "started": pet["started"],
-        "image": get_pet_image(), "message": pet["message"],
+        "image": get_pet_image(pet), "message": pet["message"],
         "level": 0, "food": current_food, "exp": 0,
         "next_exp": EXP_TABLE[0], "pet_type": pet_type
     })
@@ -1242,72 +3045,311 @@ def manifest():
 # ランキングページ
 # =============================================================================
 
-@app.route("/ranking")
-def ranking():
+LEADERBOARD_PROJECTION = {"_id": 0, "username": 1, "pokedex.discovery_count": 1, "pokedex.total_stars": 1}
+
+def leaderboard_row(doc):
+    """ランキング表示用の1行"""
+    pokedex = doc.get("pokedex") or {}
+    return {
+        "username": doc.get("username", "Unknown"),
+        "discovery_count": pokedex.get("discovery_count", 0),
+        "total_stars": pokedex.get("total_stars", 0)
+    }
+
+def get_leaderboard_top(field, limit=10):
+    """スコアの降順（同点はユーザー名順）で上位を取得"""
+    docs = users_collection.find(
+        {f"pokedex.{field}": {"$exists": True}}, LEADERBOARD_PROJECTION
+    ).sort([(f"pokedex.{field}", -1), ("username", 1)]).limit(limit)
+    return [leaderboard_row(doc) for doc in docs]
+
+def get_leaderboard_rank(field, score):
+    """指定スコアの順位（より高いスコアを持つユーザー数 + 1）"""
+    return users_collection.count_documents({f"pokedex.{field}": {"$gt": score}}) + 1
+
+def get_user_pokedex_scores(user_pokedex):
+    """図鑑データのランキング用スコア（未補完のデータはビットマスクから計算）"""
+    if "discovery_count" in user_pokedex and "total_stars" in user_pokedex:
+        return {"discovery_count": user_pokedex["discovery_count"], "total_stars": user_pokedex["total_stars"]}
+    return pokedex_scores(get_discovered_mask(user_pokedex))
+
+# =============================================================================
+# ランキングのスナップショット（全ユーザー共通・バックグラウンドで再計算）
+# =============================================================================
+# トップNと「スコア→順位」表をプロセス内で共有し、リクエストは常に手元の
+# スナップショットを返す（古くなっていても待たない）。再計算は専用スレッドが
+# 一定間隔ごと、または一定数の新規発見があった時点で行う。
+
+LEADERBOARD_FIELDS = ("discovery_count", "total_stars")
+LEADERBOARD_TOP_N = int(os.environ.get("LEADERBOARD_TOP_N", 10))
+LEADERBOARD_REFRESH_SECONDS = float(os.environ.get("LEADERBOARD_REFRESH_SECONDS", 60))
+LEADERBOARD_REFRESH_DISCOVERIES = int(os.environ.get("LEADERBOARD_REFRESH_DISCOVERIES", 20))
+
+leaderboard_state = {
+    "snapshot": None,
+    "pending_discoveries": 0,
+    "refresh_count": 0,
+    "refresher": None,
+}
+leaderboard_lock = threading.Lock()
+leaderboard_wakeup = threading.Event()
+
+def build_score_rank_table(field):
+    """スコアごとの人数を集計し、スコア→順位を二分探索で引ける表を作る"""
+    groups = users_collection.aggregate([
+        {"$match": {f"pokedex.{field}": {"$exists": True}}},
+        {"$group": {"_id": f"$pokedex.{field}", "count": {"$sum": 1}}},
+        {"$sort": {"_id": -1}},
+    ])
+    negated_scores = []  # 昇順に並ぶ -score（bisect用）
+    users_above = [0]    # users_above[i] = 上位i種類のスコアを持つユーザー数
+    for group in groups:
+        negated_scores.append(-group["_id"])
+        users_above.append(users_above[-1] + group["count"])
+    return {"negated_scores": negated_scores, "users_above": users_above}
+
+def lookup_rank(rank_table, score):
+    """スコア→順位の表から順位を求める（より高いスコアを持つユーザー数 + 1）"""
+    higher_groups = bisect.bisect_left(rank_table["negated_scores"], -score)
+    return rank_table["users_above"][higher_groups] + 1
+
+def refresh_leaderboard_snapshot():
+    """ランキングのスナップショットを再計算して差し替える"""
+    started = time.monotonic()
+    snapshot = {field: {
+        "top": get_leaderboard_top(field, LEADERBOARD_TOP_N),
+        "ranks": build_score_rank_table(field),
+    } for field in LEADERBOARD_FIELDS}
+    snapshot["computed_at"] = time.time()
+    snapshot["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+    
+    with leaderboard_lock:
+        leaderboard_state["snapshot"] = snapshot
+        leaderboard_state["pending_discoveries"] = 0
+        leaderboard_state["refresh_count"] += 1
+    return snapshot
+
+def leaderboard_refresher_loop():
+    """一定間隔または発見数のしきい値到達でスナップショットを再計算し続ける"""
+    while True:
+        leaderboard_wakeup.wait(LEADERBOARD_REFRESH_SECONDS)
+        leaderboard_wakeup.clear()
+        try:
+            refresh_leaderboard_snapshot()
+        except Exception as e:
+            print(f"⚠️ Leaderboard refresh error: {e}")
+
+def ensure_leaderboard_refresher():
+    """再計算スレッドが動いていなければ起動"""
+    with leaderboard_lock:
+        refresher = leaderboard_state["refresher"]
+        if refresher is None or not refresher.is_alive():
+            refresher = threading.Thread(target=leaderboard_refresher_loop, name="leaderboard-refresher", daemon=True)
+            leaderboard_state["refresher"] = refresher
+            refresher.start()
+
+def get_leaderboard_snapshot():
+    """共有スナップショットを返す（まだ無いときだけ同期的に計算）"""
+    ensure_leaderboard_refresher()
+    snapshot = leaderboard_state["snapshot"]
+    if snapshot is None:
+        snapshot = refresh_leaderboard_snapshot()
+    return snapshot
+
+def note_leaderboard_discovery():
+    """新規発見を数え、しきい値に達したら再計算スレッドを起こす"""
+    with leaderboard_lock:
+        leaderboard_state["pending_discoveries"] += 1
+        wake = leaderboard_state["pending_discoveries"] >= LEADERBOARD_REFRESH_DISCOVERIES
+    if wake:
+        leaderboard_wakeup.set()
+
+@app.route("/api/ranking/status")
+def ranking_status():
+    """ランキングスナップショットの監視用情報"""
+    snapshot = leaderboard_state["snapshot"]
+    return jsonify({
+        "ready": snapshot is not None,
+        "age_seconds": round(time.time() - snapshot["computed_at"], 1) if snapshot else None,
+        "duration_ms": snapshot["duration_ms"] if snapshot else None,
+        "refresh_count": leaderboard_state["refresh_count"],
+        "pending_discoveries": leaderboard_state["pending_discoveries"],
+        "refresh_interval_seconds": LEADERBOARD_REFRESH_SECONDS,
+        "refresh_after_discoveries": LEADERBOARD_REFRESH_DISCOVERIES
+    })
+
+# =============================================================================
+# ランキングAPI（カーソルページング・自分の周辺）
+# =============================================================================
+# 並び順は (スコア降順, ユーザー名昇順) で一意に決まり、カーソルは直前の行の
+# (スコア, ユーザー名, 通し番号) を持つ。次ページはインデックス上の位置から
+# 読み始めるため、深いページでも1ページ目と同じコストで取得できる。
+
+LEADERBOARD_ORDERS = {"discovery": "discovery_count", "stars": "total_stars"}
+LEADERBOARD_PAGE_LIMIT = 100
+LEADERBOARD_AROUND_LIMIT = 50
+
+def encode_leaderboard_cursor(score, username, position):
+    """ページングカーソルを作成"""
+    raw = json.dumps([score, username, position], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_leaderboard_cursor(cursor):
+    """ページングカーソルを解析（不正な場合はValueError）"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        score, username, position = json.loads(raw.decode("utf-8"))
+    except Exception:
+        raise ValueError("invalid cursor")
+    if not isinstance(score, int) or not isinstance(username, str) or not isinstance(position, int):
+        raise ValueError("invalid cursor")
+    return score, username, position
+
+def find_leaderboard_after(field, score, username, limit):
+    """並び順で (score, username) より後ろの行を取得"""
+    path = f"pokedex.{field}"
+    query = {"$or": [
+        {path: {"$lt": score}},
+        {path: score, "username": {"$gt": username}},
+    ]}
+    docs = users_collection.find(query, LEADERBOARD_PROJECTION).sort([(path, -1), ("username", 1)]).limit(limit)
+    return list(docs)
+
+def find_leaderboard_before(field, score, username, limit):
+    """並び順で (score, username) より前の行を、近い方からlimit件取得して並び順で返す"""
+    path = f"pokedex.{field}"
+    query = {"$or": [
+        {path: {"$gt": score}},
+        {path: score, "username": {"$lt": username}},
+    ]}
+    docs = list(users_collection.find(query, LEADERBOARD_PROJECTION).sort([(path, 1), ("username", -1)]).limit(limit))
+    docs.reverse()
+    return docs
+
+def format_leaderboard_rows(docs, field, first_position, rank_table, username, first_rank=None):
+    """APIレスポンス用の行（通し番号・同点は同順位の順位・自分かどうか）
+    
+    first_rankを渡した場合、順位はスナップショットの表ではなく通し番号から求める
+    （並び順に連続した行なので、同点グループの順位はその先頭の通し番号。先頭のグループはfirst_rank）
+    """
+    rows = []
+    for offset, doc in enumerate(docs):
+        row = leaderboard_row(doc)
+        row["position"] = first_position + offset
+        if first_rank is None:
+            row["rank"] = lookup_rank(rank_table, row[field])
+        elif not rows:
+            row["rank"] = first_rank
+        else:
+            row["rank"] = rows[-1]["rank"] if row[field] == rows[-1][field] else row["position"]
+        row["is_me"] = row["username"] == username
+        rows.append(row)
+    return rows
+
+def parse_int_arg(name, default, minimum, maximum):
+    """クエリパラメータを範囲内の整数として取得（不正な場合はValueError）"""
+    value = int(request.args.get(name, default))
+    if value < minimum or value > maximum:
+        raise ValueError(name)
+    return value
+
+@app.route("/api/ranking/leaderboard")
+def leaderboard_api():
+    """ランキングをJSONで返す（cursorで続きを取得、around=meで自分の前後k件）"""
     if "username" not in session:
-        return redirect(url_for("login"))
+        return jsonify({"error": "未ログイン"}), 401
     
     username = session.get("username")
+    order = request.args.get("order", "discovery")
+    if order not in LEADERBOARD_ORDERS:
+        return jsonify({"error": "無効な並び順です"}), 400
+    field = LEADERBOARD_ORDERS[order]
     
-    # 全ユーザーの図鑑データを取得
-    all_pokedex = list(pokedex_collection.find({}, {"username": 1, "discovered": 1, "育成_counts": 1}))
-    
-    # ランキングデータを計算
-    ranking_data = []
-    for user_data in all_pokedex:
-        user_username = user_data.get("username", "Unknown")
-        discovered = user_data.get("discovered", [])
-        育成_counts = user_data.get("育成_counts", {})
-        
-        # 発見数
-        discovery_count = len(discovered)
-        
-        # 総獲得★数を計算
-        total_stars = 0
-        for pet_image in discovered:
-            rarity = get_rarity_stars(pet_image)
-            if rarity:
-                total_stars += rarity
-        
-        ranking_data.append({
-            "username": user_username,
-            "discovery_count": discovery_count,
-            "total_stars": total_stars
+    try:
+        limit = parse_int_arg("limit", 20, 1, LEADERBOARD_PAGE_LIMIT)
+        k = parse_int_arg("k", 5, 1, LEADERBOARD_AROUND_LIMIT)
+    except (ValueError, TypeError):
+        return jsonify({"error": "件数の指定が不正です"}), 400
+    
+    if request.args.get("around") == "me":
+        # 自分の周辺は通し番号・順位・前後の行をすべて最新のデータから求める
+        # （スナップショットの順位と混ぜると、通し番号と順位が食い違う）
+        my_score = get_user_pokedex_scores(get_user_pokedex())[field]
+        my_rank = get_leaderboard_rank(field, my_score)
+        # 自分の通し番号 = 自分より高いスコアの人数 + 同点で名前が前の人数 + 1
+        my_position = my_rank + users_collection.count_documents(
+            {f"pokedex.{field}": my_score, "username": {"$lt": username}}
+        )
+        above = find_leaderboard_before(field, my_score, username, k)
+        me = users_collection.find_one(
+            {"username": username, f"pokedex.{field}": {"$exists": True}}, LEADERBOARD_PROJECTION
+        )
+        below = find_leaderboard_after(field, my_score, username, k)
+        docs = above + ([me] if me else []) + below
+        # 先頭の行が自分と同点でなければ、その同点グループの順位だけ数え直す
+        first_score = leaderboard_row(docs[0])[field] if docs else my_score
+        first_rank = my_rank if first_score == my_score else get_leaderboard_rank(field, first_score)
+        rows = format_leaderboard_rows(docs, field, my_position - len(above), None, username, first_rank)
+        # スコアがまだ保存されていない自分はランキングに載っていないので、通し番号・順位は返さない
+        # （前後の行はスコアから決まる位置の周辺で、通し番号はランキングの一覧と同じ）
+        return jsonify({
+            "success": True,
+            "order": order,
+            "my_position": my_position if me else None,
+            "my_rank": my_rank if me else None,
+            "rows": rows
         })
     
-    # 発見数ランキング（降順）
-    discovery_ranking = sorted(ranking_data, key=lambda x: x["discovery_count"], reverse=True)
+    rank_table = get_leaderboard_snapshot()[field]["ranks"]
     
-    # ★数ランキング（降順）
-    stars_ranking = sorted(ranking_data, key=lambda x: x["total_stars"], reverse=True)
+    cursor = request.args.get("cursor")
+    if cursor:
+        try:
+            score, last_username, last_position = decode_leaderboard_cursor(cursor)
+        except ValueError:
+            return jsonify({"error": "無効なカーソルです"}), 400
+        docs = find_leaderboard_after(field, score, last_username, limit)
+        first_position = last_position + 1
+    else:
+        path = f"pokedex.{field}"
+        docs = list(users_collection.find({path: {"$exists": True}}, LEADERBOARD_PROJECTION)
+                    .sort([(path, -1), ("username", 1)]).limit(limit))
+        first_position = 1
     
-    # 自分の順位を取得
-    current_user_discovery_rank = None
-    current_user_stars_rank = None
-    current_user_data = None
+    rows = format_leaderboard_rows(docs, field, first_position, rank_table, username)
+    next_cursor = None
+    if len(rows) == limit:
+        last = rows[-1]
+        next_cursor = encode_leaderboard_cursor(last[field], last["username"], last["position"])
     
-    for i, user in enumerate(discovery_ranking, start=1):
-        if user["username"] == username:
-            current_user_discovery_rank = i
-            current_user_data = user
-            break
+    return jsonify({"success": True, "order": order, "rows": rows, "next_cursor": next_cursor})
+
+@app.route("/ranking")
+def ranking():
+    if "username" not in session:
+        return redirect(url_for("login"))
     
-    for i, user in enumerate(stars_ranking, start=1):
-        if user["username"] == username:
-            current_user_stars_rank = i
-            break
+    prefetch_user_sections("ranking")
+    
+    username = session.get("username")
+    
+    # トップ10は全ユーザー共通のスナップショットから取得
+    snapshot = get_leaderboard_snapshot()
+    top10_discovery = snapshot["discovery_count"]["top"][:10]
+    top10_stars = snapshot["total_stars"]["top"][:10]
     
-    # トップ10を取得
-    top10_discovery = discovery_ranking[:10]
-    top10_stars = stars_ranking[:10]
+    # 自分のスコアは最新の値を使い、順位はスナップショットのスコア→順位表で求める
+    user_pokedex = get_user_pokedex()
+    current_user_data = {"username": username, **get_user_pokedex_scores(user_pokedex)}
+    current_user_discovery_rank = lookup_rank(snapshot["discovery_count"]["ranks"], current_user_data["discovery_count"])
+    current_user_stars_rank = lookup_rank(snapshot["total_stars"]["ranks"], current_user_data["total_stars"])
     
     pet = get_user_pet()
     
     # ★図鑑コンプリート判定（全70種類）
-    is_complete = current_user_data and current_user_data["discovery_count"] >= 70
+    is_complete = current_user_data["discovery_count"] >= POKEDEX_SIZE
     
     # コンプリート済みフラグをチェック（初回のみ演出）
-    user_pokedex = get_user_pokedex()
     already_celebrated = user_pokedex.get("complete_celebrated", False)
     show_celebration = is_complete and not already_celebrated
     
@@ -1320,7 +3362,7 @@ def ranking():
         "ranking.html",
         username=username,
         pet=pet,
-        image=get_pet_image(),
+        image=get_pet_image(pet),
         exp_table=EXP_TABLE,
         top10_discovery=top10_discovery,
         top10_stars=top10_stars,
@@ -1338,14 +3380,283 @@ def init_db():
     print("📊 Creating database indexes...")
     try:
         events_collection.create_index([("username", 1)])
+        event_days_collection.create_index([("username", 1), ("date", 1)], unique=True)
+        recurring_events_collection.create_index([("username", 1), ("id", 1)], unique=True)
+        recurring_events_collection.create_index([("username", 1), ("start_date", 1)])
+        # 予定検索用のn-gramインデックス（日付の新しい順にそのまま読めるようdateを降順で含める）
+        event_days_collection.create_index([("username", 1), ("events.search_grams", 1), ("date", -1)])
+        recurring_events_collection.create_index([("username", 1), ("search_grams", 1)])
         pokedex_collection.create_index([("username", 1)])
         users_collection.create_index([("username", 1)], unique=True)
+        users_collection.create_index([("pokedex.discovery_count", -1), ("username", 1)])
+        users_collection.create_index([("pokedex.total_stars", -1), ("username", 1)])
         goals_collection.create_index([("username", 1)])
         locations_collection.create_index([("username", 1)])
         pets_collection.create_index([("username", 1)])
         print("✅ Indexes created successfully")
     except Exception as e:
         print(f"⚠️ Index creation note: {e}")
+    init_auction_db()
+    
+    # 旧形式の予定が残っていれば日付分割形式へ移行する（移行済みのユーザーは対象外）
+    users, days = migrate_events_to_day_partitions()
+    if users:
+        print(f"✅ Migrated events: {users} users, {days} days")
+
+# =============================================================================
+# データ移行
+# =============================================================================
+
+def legacy_event_content(date_str, ev):
+    """移行済みかどうかを判定するための予定の内容（IDを振り直しても同じになる）"""
+    return (date_str, ev.get("start_time"), ev.get("end_time"), ev.get("event"), ev.get("location"))
+
+def migrate_events_to_day_partitions(batch_size=500):
+    """旧eventsコレクション（ユーザーごとの巨大な辞書）を日付ごとのドキュメントに分割する
+    
+    移行前に新しい形式で書き込まれた日があっても、その日の配列に旧データの予定を$pushで追加する。
+    同じ日に同じ内容の予定が既にあれば移行済みとして飛ばし、移行前に作られた別の予定と
+    IDが重なっていた場合は新しいIDを振り直す（再実行しても安全）。
+    usersのevent_seqカウンタは書き込む前に既存の最大イベントIDまで進めておき、
+    全ての日の書き込みが終わってから旧ドキュメントに移行済みの印を付ける
+    """
+    migrated_users = 0
+    migrated_days = 0
+    
+    for doc in events_collection.find({"partitioned": {"$ne": True}}, {"username": 1, "events": 1}):
+        username = doc.get("username")
+        if not username:
+            continue
+        
+        legacy_days = {date_str: day_events for date_str, day_events in (doc.get("events") or {}).items() if day_events}
+        max_event_id = max((ev.get("id", 0) for day_events in legacy_days.values() for ev in day_events), default=0)
+        
+        # 新しいIDを振り直すことがあるので、先にカウンタを旧データの最大ID以上に進める
+        users_collection.update_one({"username": username}, {"$max": {"event_seq": max_event_id}})
+        
+        # 移行前に新しい形式で書き込まれた予定（使用中のIDと、日付ごとの内容）
+        existing_ids = set()
+        existing_contents = set()
+        for day in event_days_collection.find({"username": username}, {"date": 1, "events": 1}):
+            for ev in day.get("events", []):
+                existing_ids.add(ev.get("id"))
+                existing_contents.add(legacy_event_content(day["date"], ev))
+        
+        pending = {}
+        collided = []
+        for date_str, day_events in legacy_days.items():
+            for ev in day_events:
+                if legacy_event_content(date_str, ev) in existing_contents:
+                    continue  # 移行済み（IDを振り直したものを含む）
+                if ev.get("id") in existing_ids:
+                    collided.append((date_str, dict(ev)))
+                else:
+                    pending.setdefault(date_str, []).append(dict(ev))
+        
+        if collided:
+            counter = users_collection.find_one_and_update(
+                {"username": username},
+                {"$inc": {"event_seq": len(collided)}},
+                projection={"_id": 0, "event_seq": 1},
+                return_document=ReturnDocument.AFTER
+            )
+            first_id = counter["event_seq"] - len(collided) + 1
+            for offset, (date_str, ev) in enumerate(collided):
+                ev["id"] = first_id + offset
+                pending.setdefault(date_str, []).append(ev)
+        
+        operations = []
+        for date_str, day_events in pending.items():
+            # 同じ予定を二重に追加しないよう、追加するIDがまだ無い場合だけ書き込む（無い日は作成）
+            operations.append(UpdateOne(
+                {"username": username, "date": date_str, "events.id": {"$nin": [ev["id"] for ev in day_events]}},
+                {"$push": {"events": {"$each": [with_stored_fields(ev) for ev in day_events],
+                                      "$sort": EVENT_DAY_ORDER}}},
+                upsert=True
+            ))
+            migrated_days += 1
+            if len(operations) >= batch_size:
+                event_days_collection.bulk_write(operations, ordered=False)
+                operations = []
+        if operations:
+            event_days_collection.bulk_write(operations, ordered=False)
+        
+        # 全ての日の書き込みが成功した後で移行済みにする（途中で失敗したら次回やり直す）
+        events_collection.update_one({"_id": doc["_id"]}, {"$set": {"partitioned": True}})
+        migrated_users += 1
+    
+    return migrated_users, migrated_days
+
+# 旧コレクションとusersドキュメント内のセクション名の対応（フィールド名はセクション内の値）
+LEGACY_USER_COLLECTIONS = (
+    ("pet", pets_collection, None),
+    ("pokedex", pokedex_collection, None),
+    ("goals", goals_collection, "goals"),
+    ("locations", locations_collection, "locations"),
+)
+
+def legacy_section_value(section, doc, field):
+    """旧コレクションのドキュメントからusersドキュメントに載せる値を取り出す"""
+    if field:
+        return doc.get(field)
+    value = {key: value for key, value in doc.items() if key not in ("_id", "username")}
+    if section == "pokedex":
+        with_derived_pokedex_fields(value)
+    return value
+
+def backfill_user_aggregate(username):
+    """1ユーザー分の旧コレクションのデータをusersドキュメントへ集約する"""
+    sections = {}
+    for section, collection, field in LEGACY_USER_COLLECTIONS:
+        doc = collection.find_one({"username": username})
+        value = legacy_section_value(section, doc, field) if doc else None
+        if value is not None:
+            sections[section] = value
+    
+    sections["layout_version"] = USER_LAYOUT_VERSION
+    sections["events"] = {"collection": event_days_collection.name}
+    # 他のリクエストが先に補完していた場合は上書きしない
+    users_collection.update_one(
+        {"username": username, "layout_version": {"$exists": False}},
+        {"$set": sections}
+    )
+
+def migrate_users_to_aggregate(batch_size=500):
+    """旧コレクション（pets / pokedex / goals / locations）をusersドキュメントへ一括で集約する"""
+    migrated = 0
+    for section, collection, field in LEGACY_USER_COLLECTIONS:
+        operations = []
+        for doc in collection.find({}):
+            value = legacy_section_value(section, doc, field)
+            if not doc.get("username") or value is None:
+                continue
+            operations.append(UpdateOne(
+                {"username": doc["username"], "layout_version": {"$exists": False}},
+                {"$set": {section: value}}
+            ))
+            if len(operations) >= batch_size:
+                users_collection.bulk_write(operations, ordered=False)
+                operations = []
+        if operations:
+            users_collection.bulk_write(operations, ordered=False)
+    
+    result = users_collection.update_many(
+        {"layout_version": {"$exists": False}},
+        {"$set": {
+            "layout_version": USER_LAYOUT_VERSION,
+            "events": {"collection": event_days_collection.name}
+        }}
+    )
+    migrated += result.modified_count
+    return migrated
+
+@app.cli.command("migrate-users")
+def migrate_users_command():
+    """flask --app app migrate-users で旧コレクションのユーザーデータをusersへ集約"""
+    init_db()
+    migrated = migrate_users_to_aggregate()
+    print(f"✅ Migrated users: {migrated}")
+
+def backfill_discovered_masks(batch_size=500):
+    """発見リストしか持たないユーザーの図鑑にビットマスクを追加する"""
+    updated = 0
+    operations = []
+    query = {"pokedex.discovered": {"$exists": True}, "pokedex.discovered_mask": {"$exists": False}}
+    for doc in users_collection.find(query, {"username": 1, "pokedex.discovered": 1}):
+        mask = pokedex_mask_from_images(doc["pokedex"].get("discovered", []))
+        # 並行して$bitで書き込まれたビットを消さないようにORで合成する
+        update = {"$bit": {f"pokedex.discovered_mask.{word}": {"or": value}
+                           for word, value in pokedex_mask_words(mask).items()}}
+        if not update["$bit"]:
+            update = {"$set": {"pokedex.discovered_mask": {}}}
+        operations.append(UpdateOne({"_id": doc["_id"]}, update))
+        updated += 1
+        if len(operations) >= batch_size:
+            users_collection.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        users_collection.bulk_write(operations, ordered=False)
+    return updated
+
+def backfill_event_fields(batch_size=500):
+    """検索用n-gram・開始/終了の分を持たない予定に付け直す（本文・時刻から作り直すので再実行しても安全）"""
+    updated_days = 0
+    operations = []
+    missing = {"$or": [
+        {"search_grams": {"$exists": False}},
+        {"start_time": {"$exists": True}, "start_min": {"$exists": False}},
+    ]}
+    query = {"events": {"$elemMatch": missing}}
+    for doc in event_days_collection.find(query, {"events": 1}):
+        # 読んだ後に追加・削除された予定を巻き戻さないよう、配列が変わっていない場合だけ置き換える
+        operations.append(UpdateOne(
+            {"_id": doc["_id"], "events": doc["events"]},
+            {"$set": {"events": sorted((with_stored_fields(ev) for ev in doc["events"]),
+                                       key=lambda ev: event_interval(ev)[:2])}}
+        ))
+        updated_days += 1
+        if len(operations) >= batch_size:
+            event_days_collection.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        event_days_collection.bulk_write(operations, ordered=False)
+    
+    updated_rules = 0
+    projection = {"event": 1, "location": 1, "start_time": 1, "end_time": 1}
+    for rule in recurring_events_collection.find(missing, projection):
+        stored = with_stored_fields(rule)
+        recurring_events_collection.update_one(
+            {"_id": rule["_id"]},
+            {"$set": {key: stored[key] for key in ("search_grams", "start_min", "end_min") if key in stored}}
+        )
+        updated_rules += 1
+    return updated_days, updated_rules
+
+def backfill_leaderboard_scores(batch_size=500):
+    """全ユーザーの発見数・★合計を発見データから再計算して保存する"""
+    updated = 0
+    operations = []
+    projection = {"pokedex.discovered_mask": 1, "pokedex.discovered": 1}
+    for doc in users_collection.find({"pokedex": {"$exists": True}}, projection):
+        scores = pokedex_scores(get_discovered_mask(doc["pokedex"]))
+        operations.append(UpdateOne(
+            {"_id": doc["_id"]},
+            {"$set": {f"pokedex.{key}": value for key, value in scores.items()}}
+        ))
+        updated += 1
+        if len(operations) >= batch_size:
+            users_collection.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        users_collection.bulk_write(operations, ordered=False)
+    return updated
+
+@app.cli.command("backfill-leaderboard")
+def backfill_leaderboard_command():
+    """flask --app app backfill-leaderboard でランキング用スコアを補完"""
+    init_db()
+    updated = backfill_leaderboard_scores()
+    print(f"✅ Backfilled leaderboard scores: {updated} users")
+
+@app.cli.command("backfill-pokedex-masks")
+def backfill_pokedex_masks_command():
+    """flask --app app backfill-pokedex-masks で図鑑の発見ビットマスクを補完"""
+    updated = backfill_discovered_masks()
+    print(f"✅ Backfilled discovered masks: {updated} users")
+
+@app.cli.command("backfill-event-fields")
+def backfill_event_fields_command():
+    """flask --app app backfill-event-fields で予定の検索用n-gram・開始/終了の分を補完"""
+    init_db()
+    days, rules = backfill_event_fields()
+    print(f"✅ Backfilled event fields: {days} days, {rules} recurring rules")
+
+@app.cli.command("migrate-events")
+def migrate_events_command():
+    """flask --app app migrate-events で旧形式の予定データを日付分割形式へ移行"""
+    init_db()
+    users, days = migrate_events_to_day_partitions()
+    print(f"✅ Migrated events: {users} users, {days} days")
 
 # =============================================================================
 # app.pyに追加するコード
@@ -1368,6 +3679,12 @@ AUCTION_DURATIONS = {
 
 AUCTION_FEE_RATE = 0.05  # 出品手数料 5%
 
+# 一覧に必要な項目だけを読む（決済用のジャーナルなどは読まない）
+AUCTION_LIST_PROJECTION = {
+    "pet_data": 1, "seller": 1, "starting_price": 1, "end_time": 1, "image": 1, "rarity": 1,
+    "current_price": 1, "bid_count": 1, "highest_bidder": 1,
+}
+
 # =============================================================================
 # ペットタイプ8（スタンド系）の追加
 # =============================================================================
@@ -1468,62 +3785,43 @@ def auction():
     if "username" not in session:
         return redirect(url_for("login"))
     
+    prefetch_user_sections("auction")
+    
     username = session.get("username")
     pet = get_user_pet()
     
-    # 現在アクティブなオークションを取得
-    active_auctions = list(auctions_collection.find({"status": "active"}))
+    # 現在アクティブなオークションを終了が近い順に取得（価格・入札数・最高入札者はオークションに保存済み）
+    active_auctions = auctions_collection.find({"status": "active"}, AUCTION_LIST_PROJECTION).sort("end_time", 1)
+    
+    # 自分が入札したオークション（入札履歴から重複なしで1回で取得）
+    my_bid_auction_ids = set(bids_collection.distinct("auction_id", {"bidder": username}))
     
     # 各オークションの情報を整形
     auction_list = []
     for auction in active_auctions:
-        # 残り時間を計算
-        time_remaining = get_time_remaining(auction["end_time"])
-        
-        # 現在の最高入札額を取得
-        highest_bid = bids_collection.find_one(
-            {"auction_id": str(auction["_id"])},
-            sort=[("amount", -1)]
-        )
-        
-        current_price = highest_bid["amount"] if highest_bid else auction["starting_price"]
-        bid_count = bids_collection.count_documents({"auction_id": str(auction["_id"])})
-        
-        # 自分が最高入札者かチェック
-        is_highest_bidder = False
-        if highest_bid and highest_bid.get("bidder") == username:
-            is_highest_bidder = True
-        
         auction_list.append({
             "id": str(auction["_id"]),
             "pet_data": auction["pet_data"],
             "seller": auction["seller"],
             "starting_price": auction["starting_price"],
-            "current_price": current_price,
-            "bid_count": bid_count,
-            "time_remaining": time_remaining,
+            "current_price": auction.get("current_price", auction["starting_price"]),
+            "bid_count": auction.get("bid_count", 0),
+            "time_remaining": get_time_remaining(auction["end_time"]),
             "is_own": auction["seller"] == username,
-            "is_highest_bidder": is_highest_bidder,
+            "is_highest_bidder": auction.get("highest_bidder") == username,
             "image": auction.get("image", "pet1/egg.jpg"),
             "rarity": auction.get("rarity", 1)
         })
     
-    # 残り時間でソート（終了が近い順）
-    auction_list.sort(key=lambda x: x["time_remaining"]["total_seconds"])
-    
-    # 自分の出品中オークションを取得
+    # 自分の出品中オークション・入札中オークション
     my_auctions = [a for a in auction_list if a["is_own"]]
-    
-    # 自分の入札履歴を取得
-    my_bids = list(bids_collection.find({"bidder": username}))
-    my_bid_auction_ids = [bid["auction_id"] for bid in my_bids]
     my_bidding_auctions = [a for a in auction_list if a["id"] in my_bid_auction_ids]
     
     return render_template(
         "auction.html",
         username=username,
         pet=pet,
-        image=get_pet_image(),
+        image=get_pet_image(pet),
         exp_table=EXP_TABLE,
         auctions=auction_list,
         my_auctions=my_auctions,
@@ -1563,12 +3861,6 @@ def create_auction():
     # 出品手数料を計算
     fee = calculate_auction_fee(starting_price)
     
-    if pet.get("coins", 0) < fee:
-        return jsonify({"error": f"手数料が不足しています（必要: {fee}コイン）"}), 400
-    
-    # 手数料を徴収
-    pet["coins"] -= fee
-    
     # ペットのコピーを作成（出品用）
     pet_data_copy = {
         "level": pet["level"],
@@ -1587,7 +3879,21 @@ def create_auction():
     rarity = get_pet_rarity_value(pet)
     
     # ペット画像を取得
-    pet_image = get_pet_image()
+    pet_image = get_pet_image(pet)
+    
+    # 手数料の徴収とペットのリセット（卵に戻す）を1回で行う
+    # （同じペットの二重出品を防ぐため、育成中のままであることも条件にする）
+    charged = debit_coins(fee, set_fields={
+        "alive": False,
+        "started": False,
+        "level": 0,
+        "exp": 0,
+        "evolution": 1,
+        "pet_type": None,
+        "message": "ペットを出品しました！新しいペットを育てましょう。"
+    }, guard={"pet.alive": True, "pet.started": True})
+    if charged is None:
+        return jsonify({"error": f"手数料が不足しています（必要: {fee}コイン）"}), 400
     
     # オークションを作成
     auction_data = {
@@ -1599,23 +3905,15 @@ def create_auction():
         "status": "active",
         "fee": fee,
         "image": pet_image,
-        "rarity": rarity
+        "rarity": rarity,
+        "current_price": starting_price,
+        "bid_count": 0,
+        "highest_bidder": None,
+        "escrow": []
     }
     
     result = auctions_collection.insert_one(auction_data)
-    
-    # ペットをリセット（卵に戻す）
-    pet.update({
-        "alive": False,
-        "started": False,
-        "level": 0,
-        "exp": 0,
-        "evolution": 1,
-        "pet_type": None,
-        "message": "ペットを出品しました！新しいペットを育てましょう。"
-    })
-    
-    save_user_pet(pet)
+    schedule_auction(str(result.inserted_id), end_time.timestamp())
     
     return jsonify({
         "success": True,
@@ -1657,52 +3955,56 @@ def place_bid():
     if not is_auction_active(auction):
         return jsonify({"error": "このオークションは終了しています"}), 400
     
-    # 現在の最高入札額を取得
-    highest_bid = bids_collection.find_one(
-        {"auction_id": auction_id},
-        sort=[("amount", -1)]
-    )
-    
-    current_highest = highest_bid["amount"] if highest_bid else auction["starting_price"]
-    
     # 入札額が現在の最高額より高いかチェック
+    current_highest = auction.get("current_price", auction["starting_price"])
     if bid_amount <= current_highest:
         return jsonify({"error": f"入札額は{current_highest + 1}コイン以上である必要があります"}), 400
     
-    # コイン残高をチェック
-    pet = get_user_pet()
+    # これまでの自分の入札で預けているコイン（返金用）
+    my_escrow = [entry["amount"] for entry in auction.get("escrow", []) if entry["bidder"] == username]
+    refund_amount = sum(my_escrow)
     
-    if pet.get("coins", 0) < bid_amount:
+    # 前回の入札額を返金して新しい入札額を差し引く（差額を1回で、残高が足りる場合のみ）
+    charged = bid_amount - refund_amount
+    pet = debit_coins(charged)
+    if pet is None:
         return jsonify({"error": "コインが不足しています"}), 400
     
-    # 前回の自分の入札を取得（返金用）
-    previous_bid = bids_collection.find_one({
-        "auction_id": auction_id,
-        "bidder": username
-    })
-    
-    # 前回の入札があれば返金
-    refund_amount = 0
-    if previous_bid:
-        refund_amount = previous_bid["amount"]
-        pet["coins"] += refund_amount
-    
-    # 新しい入札額を差し引く
-    pet["coins"] -= bid_amount
-    save_user_pet(pet)
-    
-    # 入札を記録
-    bid_data = {
-        "auction_id": auction_id,
-        "bidder": username,
-        "amount": bid_amount,
-        "bid_time": datetime.now(JST)
+    # まだ有効で、入札額が保存済みの最高額を上回っている場合だけ価格・入札数・最高入札者を更新し、
+    # 差し引いた額を同じ更新で預かり（escrow）に積む。決済はこのオークションの値だけを見るので、
+    # 入札の受付と預かりの記録の間に決済が割り込むことはない
+    # （読んだ後に他の入札が入っていたら条件に合わず、同時に同じ額で入札しても通るのは1件だけ）
+    now = datetime.now(JST)
+    query = {
+        "_id": auction["_id"], "status": "active", "end_time": {"$gt": now},
+        "current_price": {"$lt": bid_amount}, "escrow": {"$exists": True}
     }
+    if not my_escrow:
+        # 初めての入札の場合だけ入札数を増やす（同じユーザーの同時の初入札は1件だけ通す）
+        query["escrow.bidder"] = {"$ne": username}
+    accepted = auctions_collection.find_one_and_update(
+        query,
+        {
+            "$set": {"current_price": bid_amount, "highest_bidder": username},
+            "$inc": {"bid_count": 0 if my_escrow else 1},
+            "$push": {"escrow": {"bidder": username, "amount": charged}}
+        },
+        projection={"_id": 1}
+    )
+    if accepted is None:
+        pet = credit_coins(charged)
+        latest = auctions_collection.find_one(
+            {"_id": auction["_id"]}, {"status": 1, "end_time": 1, "current_price": 1, "starting_price": 1}
+        )
+        if not latest or not is_auction_active(latest):
+            return jsonify({"error": "このオークションは終了しています"}), 400
+        current_highest = latest.get("current_price", latest["starting_price"])
+        return jsonify({"error": f"入札額は{current_highest + 1}コイン以上である必要があります"}), 400
     
-    # 既存の入札を更新または新規作成
+    # 入札履歴を記録（一覧の「入札中」の表示用。額は下がらないよう$maxで更新）
     bids_collection.update_one(
         {"auction_id": auction_id, "bidder": username},
-        {"$set": bid_data},
+        {"$max": {"amount": bid_amount}, "$set": {"bid_time": now}},
         upsert=True
     )
     
@@ -1714,114 +4016,384 @@ def place_bid():
     })
 
 # =============================================================================
-# オークション終了処理（定期実行）
+# オークションの決済（トランザクション / ジャーナル）
 # =============================================================================
+# 終了したオークションはAUCTION_SETTLEMENT_BATCH_SIZE件ずつまとめて決済する。
+# 落札者・落札額・預かり（入札時に差し引いたコイン）はオークション自身に保存されているので、
+# 落札者へのペット付与・出品者への売上・預かりの返金をユーザーごとの更新にしてbulk_writeで書く。
+# トランザクションが使える（レプリカセット）場合はオークションの確定と一緒に
+# 1つのトランザクションで書き込む。使えない場合は決済内容をオークションに
+# ジャーナルとして先に保存し、各ユーザーの更新には印（settlement_marks）を付けて
+# 同じ更新を二度適用しないようにする。途中で止まった決済はAUCTION_SETTLEMENT_TIMEOUT_SECONDS後に
+# 同期のついでに取り直し、保存済みのジャーナルどおりにやり直す。
 
-@app.route("/api/auction/finalize", methods=["POST"])
-def finalize_auctions():
-    """終了したオークションを処理（管理者用または定期実行）"""
+AUCTION_SETTLEMENT_BATCH_SIZE = 500
+AUCTION_SETTLEMENT_TIMEOUT_SECONDS = 300
+
+auction_settlement_state = {"transactions": None}  # トランザクションが使えるか（None: まだ分からない）
+
+class AuctionSettlementConflict(Exception):
+    """トランザクション中に他のワーカーが先にオークションを確定していた"""
+
+def claim_expired_auctions(auction_ids):
+    """終了時刻を過ぎた受付中のオークションをまとめて決済中に切り替え、切り替えられた分を返す"""
+    now = datetime.now(JST)
+    token = ObjectId()
+    object_ids = [ObjectId(auction_id) for auction_id in auction_ids]
+    auctions_collection.update_many(
+        {"_id": {"$in": object_ids}, "status": "active", "end_time": {"$lte": now}},
+        {"$set": {"status": "finalizing", "finalizing_at": now, "settlement_token": token}}
+    )
+    return list(auctions_collection.find({"_id": {"$in": object_ids}, "settlement_token": token}))
+
+def claim_stale_settlements():
+    """決済中のまま止まっているオークションを取り直して返す"""
+    now = datetime.now(JST)
+    token = ObjectId()
+    auctions_collection.update_many(
+        {"status": "finalizing",
+         "finalizing_at": {"$lt": now - timedelta(seconds=AUCTION_SETTLEMENT_TIMEOUT_SECONDS)}},
+        {"$set": {"finalizing_at": now, "settlement_token": token}}
+    )
+    return list(auctions_collection.find({"status": "finalizing", "settlement_token": token}))
+
+def auction_escrow(auction, bids):
+    """入札者ごとに預かっているコイン（入札時に差し引いた額の合計）"""
+    if "escrow" not in auction:
+        # 預かりを持たない古いオークションは、入札ごとの最新の額がそのまま預かり額
+        return {bid["bidder"]: bid["amount"] for bid in bids}
+    escrow = {}
+    for entry in auction["escrow"]:
+        escrow[entry["bidder"]] = escrow.get(entry["bidder"], 0) + entry["amount"]
+    return escrow
+
+def plan_settlement(auction, bids):
+    """1件のオークションの決済内容（ユーザーごとのペットの更新と結果）を作る
+    
+    落札者と落札額はオークションに保存した最高入札者・現在価格を使い、預かったコインのうち
+    落札額を超える分（落札者以外は全額）を返金する
+    """
+    ops = []
+    escrow = auction_escrow(auction, bids)
+    if "escrow" in auction:
+        winner = auction.get("highest_bidder")
+        final_price = auction.get("current_price")
+    else:
+        highest_bid = max(bids, key=lambda bid: bid["amount"], default=None)
+        winner = highest_bid["bidder"] if highest_bid else None
+        final_price = highest_bid["amount"] if highest_bid else None
+    
+    if winner:
+        # 落札成功（落札者のコインは入札時に差し引き済み。ペットは上書きし、コイン・在庫はそのまま）
+        ops.append({"username": winner, "set": {
+            **auction["pet_data"],
+            "message": f"オークションで{auction['seller']}さんのペットを落札しました！"
+        }})
+        ops.append({"username": auction["seller"], "inc": {"coins": final_price}, "set": {
+            "message": f"あなたのペットが{final_price}コインで落札されました！"
+        }})
+        result = {"status": "sold", "winner": winner, "final_price": final_price}
+    else:
+        # 入札なし - 出品者にペットを返却
+        ops.append({"username": auction["seller"], "set": {
+            **auction["pet_data"],
+            "message": "オークションが終了しましたが、入札がありませんでした。"
+        }})
+        result = {"status": "unsold"}
+    
+    refunded = 0
+    for bidder, amount in escrow.items():
+        if bidder == winner:
+            amount -= final_price
+        if amount <= 0:
+            continue
+        ops.append({"username": bidder, "inc": {"coins": amount}})
+        refunded += amount
+    result["refunded"] = refunded
+    return {"ops": ops, "result": result}
+
+def settlement_user_update(op, mark=None):
+    """決済内容の1件をusersへのUpdateOneにする（markがあれば印の無い場合だけ適用して印を付ける）"""
+    query = {"username": op["username"]}
+    update = {"$inc": {"pet_version": 1}}
+    update["$inc"].update({f"pet.{key}": value for key, value in op.get("inc", {}).items()})
+    if op.get("set"):
+        update["$set"] = {f"pet.{key}": value for key, value in op["set"].items()}
+    if mark:
+        query["settlement_marks"] = {"$ne": mark}
+        update["$push"] = {"settlement_marks": mark}
+    return UpdateOne(query, update)
+
+def settlement_auction_change(auction, plan, now):
+    """オークションを結果どおりに確定する (条件, 更新)（取り直された場合は条件に合わない）"""
+    return (
+        {"_id": auction["_id"], "status": "finalizing", "settlement_token": auction["settlement_token"]},
+        {"$set": {**plan["result"], "finalized_at": now}, "$unset": {"settlement_token": ""}}
+    )
+
+def settlement_auction_update(auction, plan, now):
+    """オークションを結果どおりに確定するUpdateOne"""
+    return UpdateOne(*settlement_auction_change(auction, plan, now))
+
+def is_transaction_unsupported(error):
+    """トランザクションが使えない構成（単体のmongodなど）でのエラーか"""
+    if isinstance(error, NotImplementedError):
+        return True
+    return isinstance(error, OperationFailure) and (error.code == 20 or "Transaction numbers" in str(error))
+
+def apply_settlements_in_transaction(batch):
+    """決済内容とオークションの確定を1つのトランザクションで書き込む"""
     now = datetime.now(JST)
     
-    # 終了したオークションを取得
-    expired_auctions = auctions_collection.find({
-        "status": "active",
-        "end_time": {"$lt": now}
-    })
+    def write(txn):
+        result = auctions_collection.bulk_write(
+            [settlement_auction_update(auction, plan, now) for auction, plan in batch], session=txn
+        )
+        if result.matched_count != len(batch):
+            raise AuctionSettlementConflict()
+        users_collection.bulk_write(
+            [settlement_user_update(op) for _, plan in batch for op in plan["ops"]], session=txn
+        )
     
-    finalized_count = 0
+    with client.start_session() as txn:
+        txn.with_transaction(write)
+
+def apply_settlements_with_journal(batch):
+    """決済内容をジャーナルとして保存してから、印付きの更新で1回だけ反映し、確定できた分を返す"""
+    now = datetime.now(JST)
+    journal = [
+        UpdateOne({"_id": auction["_id"], "settlement": {"$exists": False}}, {"$set": {"settlement": plan}})
+        for auction, plan in batch if "settlement" not in auction
+    ]
+    if journal:
+        auctions_collection.bulk_write(journal, ordered=False)
     
-    for auction in expired_auctions:
-        auction_id = str(auction["_id"])
-        
-        # 最高入札を取得
-        highest_bid = bids_collection.find_one(
-            {"auction_id": auction_id},
-            sort=[("amount", -1)]
-        )
+    user_updates = [
+        settlement_user_update(op, f"{auction['_id']}:{index}")
+        for auction, plan in batch for index, op in enumerate(plan["ops"])
+    ]
+    if user_updates:
+        users_collection.bulk_write(user_updates, ordered=False)
+    
+    # bulk_writeでは件数しか分からないので、どれを確定できたかが分かるよう1件ずつ確定する
+    settled = [
+        (auction, plan) for auction, plan in batch
+        if auctions_collection.update_one(*settlement_auction_change(auction, plan, now)).matched_count
+    ]
+    # 確定できた分の印だけ消す（消す前に止まっても、残った印は害が無い）。
+    # 確定できなかった分は、止まったと見なされて他のワーカーに取り直されている。そのワーカーは
+    # 同じジャーナルをやり直しており、どの更新が反映済みかは印でしか分からないので、
+    # ここで印を消すと同じ入金・返金がもう一度行われてしまう
+    settled_marks = [f"{auction['_id']}:{index}"
+                     for auction, plan in settled for index in range(len(plan["ops"]))]
+    usernames = list({op["username"] for _, plan in settled for op in plan["ops"]})
+    if usernames:
+        users_collection.update_many({"username": {"$in": usernames}},
+                                     {"$pull": {"settlement_marks": {"$in": settled_marks}}})
+    return settled
+
+def settle_auction_batch(auctions):
+    """決済中にしたオークションをまとめて決済し、決済した件数を返す"""
+    if not auctions:
+        return 0
+    
+    auction_ids = [str(auction["_id"]) for auction in auctions]
+    # 預かりを持たない古いオークションの分だけ入札をまとめて読む
+    legacy_ids = [auction_id for auction, auction_id in zip(auctions, auction_ids)
+                  if "escrow" not in auction and "settlement" not in auction]
+    bids_by_auction = {}
+    if legacy_ids:
+        for bid in bids_collection.find({"auction_id": {"$in": legacy_ids}}):
+            bids_by_auction.setdefault(bid["auction_id"], []).append(bid)
+    # やり直しの場合は保存済みのジャーナルどおりに決済する
+    batch = [(auction, auction.get("settlement") or plan_settlement(auction, bids_by_auction.get(auction_id, [])))
+             for auction, auction_id in zip(auctions, auction_ids)]
+    
+    settled = batch
+    journaled = any("settlement" in auction for auction in auctions)
+    if auction_settlement_state["transactions"] is False or journaled:
+        settled = apply_settlements_with_journal(batch)
+    else:
+        try:
+            apply_settlements_in_transaction(batch)
+            auction_settlement_state["transactions"] = True
+        except AuctionSettlementConflict:
+            # 他のワーカーが先に確定した分があるので、1件ずつやり直して確定済みの分は飛ばす
+            settled = []
+            for item in batch:
+                try:
+                    apply_settlements_in_transaction([item])
+                    settled.append(item)
+                except AuctionSettlementConflict:
+                    pass
+        except Exception as e:
+            if not is_transaction_unsupported(e):
+                raise
+            print("⚠️ MongoDB transactions unavailable, settling auctions with a journal")
+            auction_settlement_state["transactions"] = False
+            settled = apply_settlements_with_journal(batch)
+    
+    # 図鑑への記録は$addToSetなので決済の後に何度行っても同じ
+    for auction, plan in settled:
+        if plan["result"]["status"] == "sold":
+            record_pokedex_discovery([get_pet_image(auction["pet_data"])], username=plan["result"]["winner"])
+    return len(settled)
+
+# =============================================================================
+# オークション終了処理（サーバー側のスケジューラ）
+# =============================================================================
+# 出品時と定期的な同期で各オークションの終了時刻を最小ヒープに積み、専用スレッドが
+# 一番早い終了時刻まで眠って、終了したものから決済する。複数のワーカープロセスで
+# 動いていても、statusをactive → finalizingへ原子的に切り替えられた1つだけが決済する。
+# POST /api/auction/finalize はスケジューラを起こすだけ（何度呼んでも結果は同じ）。
+
+AUCTION_SCHEDULER_ENABLED = os.environ.get("AUCTION_SCHEDULER_ENABLED", "1") == "1"
+AUCTION_SCHEDULER_SYNC_SECONDS = float(os.environ.get("AUCTION_SCHEDULER_SYNC_SECONDS", 300))
+AUCTION_SCHEDULER_MIN_SYNC_SECONDS = 10  # 外部から起こされたときにDBと同期する間隔の下限
+AUCTION_RETRY_SECONDS = 5  # まだ終了していなかった（時計のずれ）場合に確認し直すまでの秒数
+
+auction_schedule = []  # (終了時刻のUNIX秒, オークションID) の最小ヒープ
+auction_scheduler_state = {
+    "thread": None,
+    "scheduled_ids": set(),
+    "last_sync": None,
+    "sync_requested": True,
+    "finalized": 0,
+    "errors": 0,
+}
+auction_scheduler_lock = threading.Lock()
+auction_scheduler_wakeup = threading.Event()
+
+def auction_end_timestamp(end_time):
+    """終了時刻をUNIX秒にする（pymongoが返すタイムゾーン無しの日時はUTC）"""
+    if end_time.tzinfo is None:
+        end_time = pytz.utc.localize(end_time)
+    return end_time.timestamp()
+
+def schedule_auction(auction_id, timestamp):
+    """オークションの終了時刻をヒープに積む（積み済みなら何もしない）"""
+    with auction_scheduler_lock:
+        if auction_id in auction_scheduler_state["scheduled_ids"]:
+            return
+        auction_scheduler_state["scheduled_ids"].add(auction_id)
+        heapq.heappush(auction_schedule, (timestamp, auction_id))
+    auction_scheduler_wakeup.set()
+
+def sync_auction_schedule():
+    """DB上の受付中のオークションを積み直す（他のプロセスでの出品や再起動前の分）"""
+    for doc in auctions_collection.find({"status": "active"}, {"end_time": 1}):
+        schedule_auction(str(doc["_id"]), auction_end_timestamp(doc["end_time"]))
+    with auction_scheduler_lock:
+        auction_scheduler_state["last_sync"] = time.monotonic()
+
+def pop_due_auctions(now):
+    """終了時刻を過ぎたオークションIDをヒープから取り出す"""
+    due = []
+    with auction_scheduler_lock:
+        while auction_schedule and auction_schedule[0][0] <= now:
+            _, auction_id = heapq.heappop(auction_schedule)
+            auction_scheduler_state["scheduled_ids"].discard(auction_id)
+            due.append(auction_id)
+    return due
+
+def finalize_due_auctions(auction_ids):
+    """終了時刻が来たオークションをまとめて決済し、決済した件数を返す"""
+    claimed = claim_expired_auctions(auction_ids)
+    claimed_ids = {str(auction["_id"]) for auction in claimed}
+    
+    # まだ終了していなければ少し後に確認し直す（決済済み・キャンセル済みなら何もしない）
+    unclaimed = [ObjectId(auction_id) for auction_id in auction_ids if auction_id not in claimed_ids]
+    if unclaimed:
+        retry_at = time.time() + AUCTION_RETRY_SECONDS
+        for doc in auctions_collection.find({"_id": {"$in": unclaimed}, "status": "active"}, {"end_time": 1}):
+            schedule_auction(str(doc["_id"]), max(auction_end_timestamp(doc["end_time"]), retry_at))
+    
+    return settle_auction_batch(claimed)
+
+def auction_scheduler_loop():
+    """次の終了時刻（または次の同期）まで眠り、終了したオークションを決済し続ける"""
+    while True:
+        with auction_scheduler_lock:
+            last_sync = auction_scheduler_state["last_sync"]
+            sync_due = (auction_scheduler_state["sync_requested"] or last_sync is None
+                        or time.monotonic() - last_sync >= AUCTION_SCHEDULER_SYNC_SECONDS)
+            auction_scheduler_state["sync_requested"] = False
+        try:
+            if sync_due:
+                sync_auction_schedule()
+                recovered = settle_auction_batch(claim_stale_settlements())
+                if recovered:
+                    print(f"✅ Recovered {recovered} stalled auction settlements")
+        except Exception as e:
+            print(f"⚠️ Auction schedule sync error: {e}")
         
-        if highest_bid:
-            # 落札成功
-            winner = highest_bid["bidder"]
-            final_price = highest_bid["amount"]
-            
-            # 落札者にペットを付与
-            winner_pet = get_user_pet_by_username(winner)
-            
-            # 現在のペットがいる場合は上書き警告（実装では強制上書き）
-            winner_pet.update(auction["pet_data"])
-            winner_pet["message"] = f"オークションで{auction['seller']}さんのペットを落札しました！"
-            
-            save_user_pet_by_username(winner, winner_pet)
-            
-            # 出品者に売上を付与
-            seller_pet = get_user_pet_by_username(auction["seller"])
-            seller_pet["coins"] = seller_pet.get("coins", 0) + final_price
-            seller_pet["message"] = f"あなたのペットが{final_price}コインで落札されました！"
-            save_user_pet_by_username(auction["seller"], seller_pet)
-            
-            # オークションのステータスを更新
-            auctions_collection.update_one(
-                {"_id": auction["_id"]},
-                {"$set": {
-                    "status": "sold",
-                    "winner": winner,
-                    "final_price": final_price,
-                    "finalized_at": now
-                }}
-            )
-            
-        else:
-            # 入札なし - 出品者にペットを返却
-            seller_pet = get_user_pet_by_username(auction["seller"])
-            seller_pet.update(auction["pet_data"])
-            seller_pet["message"] = "オークションが終了しましたが、入札がありませんでした。"
-            save_user_pet_by_username(auction["seller"], seller_pet)
-            
-            # オークションのステータスを更新
-            auctions_collection.update_one(
-                {"_id": auction["_id"]},
-                {"$set": {
-                    "status": "unsold",
-                    "finalized_at": now
-                }}
-            )
+        due = pop_due_auctions(time.time())
+        for start in range(0, len(due), AUCTION_SETTLEMENT_BATCH_SIZE):
+            try:
+                finalized = finalize_due_auctions(due[start:start + AUCTION_SETTLEMENT_BATCH_SIZE])
+            except Exception as e:
+                # 決済中のまま残った分は、次の同期でジャーナルどおりにやり直す
+                print(f"⚠️ Auction finalize error: {e}")
+                with auction_scheduler_lock:
+                    auction_scheduler_state["errors"] += 1
+                continue
+            with auction_scheduler_lock:
+                auction_scheduler_state["finalized"] += finalized
         
-        finalized_count += 1
+        with auction_scheduler_lock:
+            timeout = AUCTION_SCHEDULER_SYNC_SECONDS
+            if auction_scheduler_state["last_sync"] is not None:
+                timeout -= time.monotonic() - auction_scheduler_state["last_sync"]
+            if auction_schedule:
+                timeout = min(timeout, auction_schedule[0][0] - time.time())
+        auction_scheduler_wakeup.wait(max(0, timeout))
+        auction_scheduler_wakeup.clear()
+
+def ensure_auction_scheduler():
+    """スケジューラのスレッドが動いていなければ起動"""
+    if not AUCTION_SCHEDULER_ENABLED:
+        return
+    with auction_scheduler_lock:
+        scheduler = auction_scheduler_state["thread"]
+        if scheduler is None or not scheduler.is_alive():
+            scheduler = threading.Thread(target=auction_scheduler_loop, name="auction-scheduler", daemon=True)
+            auction_scheduler_state["thread"] = scheduler
+            scheduler.start()
+
+@app.before_request
+def start_auction_scheduler():
+    """閲覧者がいなくてもオークションが終了するよう、最初のリクエストでスケジューラを起動"""
+    ensure_auction_scheduler()
+
+@app.route("/api/auction/finalize", methods=["POST"])
+def finalize_auctions():
+    """スケジューラにDBとの同期と終了済みオークションの確認を依頼する（何度呼んでも同じ結果になる）"""
+    with auction_scheduler_lock:
+        last_sync = auction_scheduler_state["last_sync"]
+        if last_sync is None or time.monotonic() - last_sync >= AUCTION_SCHEDULER_MIN_SYNC_SECONDS:
+            auction_scheduler_state["sync_requested"] = True
+        pending = len(auction_schedule)
+    auction_scheduler_wakeup.set()
     
     return jsonify({
         "success": True,
-        "finalized": finalized_count
+        "pending": pending
     })
 
-# =============================================================================
-# ヘルパー関数（ユーザー指定版）
-# =============================================================================
-
-def get_user_pet_by_username(target_username):
-    """指定したユーザーのペットデータを取得"""
-    doc = pets_collection.find_one({"username": target_username})
-    if not doc:
-        return {
-            "level": 0, "food": 0, "exp": 0, "coins": 0,
-            "message": "",
-            "alive": False, "started": False, "pet_type": None, "evolution": 1,
-            "inventory": {
-                '基本の餌': 0,
-                'おいしい餌': 0,
-                'プレミアム餌': 0,
-                'スペシャル餌': 0,
-            }
-        }
-    return doc
-
-def save_user_pet_by_username(target_username, pet_data):
-    """指定したユーザーのペットデータを保存"""
-    pet_data["username"] = target_username
-    pets_collection.update_one(
-        {"username": target_username},
-        {"$set": pet_data},
-        upsert=True
-    )
+@app.route("/api/auction/scheduler/status")
+def auction_scheduler_status():
+    """オークションスケジューラの監視用情報"""
+    with auction_scheduler_lock:
+        scheduler = auction_scheduler_state["thread"]
+        next_end = auction_schedule[0][0] if auction_schedule else None
+        return jsonify({
+            "enabled": AUCTION_SCHEDULER_ENABLED,
+            "running": scheduler is not None and scheduler.is_alive(),
+            "pending": len(auction_schedule),
+            "next_end_in_seconds": round(next_end - time.time(), 1) if next_end else None,
+            "finalized": auction_scheduler_state["finalized"],
+            "errors": auction_scheduler_state["errors"],
+        })
 
 # =============================================================================
 # オークションキャンセルAPI
@@ -1852,11 +4424,16 @@ def cancel_auction():
         return jsonify({"error": "自分の出品のみキャンセルできます"}), 400
     
     # 入札があるかチェック
-    bid_count = bids_collection.count_documents({"auction_id": auction_id})
-    
-    if bid_count > 0:
+    if auction.get("highest_bidder"):
         return jsonify({"error": "入札があるためキャンセルできません"}), 400
     
+    # オークションを削除（終了処理が先に始まっていたり、直前に入札が入っていたらキャンセルしない）
+    deleted = auctions_collection.delete_one(
+        {"_id": ObjectId(auction_id), "status": "active", "highest_bidder": None}
+    )
+    if deleted.deleted_count == 0:
+        return jsonify({"error": "入札があるか、オークションが終了しているためキャンセルできません"}), 400
+    
     # ペットを返却
     pet = get_user_pet()
     pet.update(auction["pet_data"])
@@ -1866,9 +4443,6 @@ def cancel_auction():
     
     save_user_pet(pet)
     
-    # オークションを削除
-    auctions_collection.delete_one({"_id": ObjectId(auction_id)})
-    
     return jsonify({
         "success": True,
         "message": "オークションをキャンセルしました"
@@ -1885,14 +4459,68 @@ def init_auction_db():
         auctions_collection.create_index([("seller", 1)])
         auctions_collection.create_index([("status", 1)])
         auctions_collection.create_index([("end_time", 1)])
+        auctions_collection.create_index([("status", 1), ("end_time", 1)])
         bids_collection.create_index([("auction_id", 1)])
         bids_collection.create_index([("bidder", 1)])
         bids_collection.create_index([("auction_id", 1), ("amount", -1)])
         print("✅ Auction indexes created successfully")
     except Exception as e:
         print(f"⚠️ Auction index creation note: {e}")
+    
+    # 価格・入札数・最高入札者・預かりを持たない（この変更より前に出品された）オークションに付け直す
+    updated = backfill_auction_stats()
+    if updated:
+        print(f"✅ Backfilled auction stats: {updated} auctions")
+
+def backfill_auction_stats(batch_size=500):
+    """預かり（escrow）を持たない出品中のオークションに、入札から集計した現在価格・入札数・最高入札者・預かりを保存する"""
+    auctions = list(auctions_collection.find(
+        {"status": "active", "escrow": {"$exists": False}}, {"starting_price": 1}
+    ))
+    if not auctions:
+        return 0
+    
+    # 入札をオークションごとに1回の集計でまとめる（額の高い順に並べて先頭を最高入札者にする）
+    # 古い入札は最新の額をそのまま差し引いているので、入札ごとの額がそのまま預かり額になる
+    auction_ids = [str(auction["_id"]) for auction in auctions]
+    stats = {row["_id"]: row for row in bids_collection.aggregate([
+        {"$match": {"auction_id": {"$in": auction_ids}}},
+        {"$sort": {"amount": -1}},
+        {"$group": {
+            "_id": "$auction_id",
+            "current_price": {"$first": "$amount"},
+            "highest_bidder": {"$first": "$bidder"},
+            "bid_count": {"$sum": 1},
+            "escrow": {"$push": {"bidder": "$bidder", "amount": "$amount"}}
+        }}
+    ])}
+    
+    operations = []
+    for auction in auctions:
+        row = stats.get(str(auction["_id"]))
+        # 預かりの無いオークションには入札できないので、集計の後に値が変わることはない
+        operations.append(UpdateOne(
+            {"_id": auction["_id"], "escrow": {"$exists": False}},
+            {"$set": {
+                "current_price": row["current_price"] if row else auction["starting_price"],
+                "bid_count": row["bid_count"] if row else 0,
+                "highest_bidder": row["highest_bidder"] if row else None,
+                "escrow": row["escrow"] if row else []
+            }}
+        ))
+        if len(operations) >= batch_size:
+            auctions_collection.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        auctions_collection.bulk_write(operations, ordered=False)
+    return len(auctions)
+
+@app.cli.command("backfill-auction-stats")
+def backfill_auction_stats_command():
+    """flask --app app backfill-auction-stats でオークションの現在価格・入札数・最高入札者・預かりを補完"""
+    updated = backfill_auction_stats()
+    print(f"✅ Backfilled auction stats: {updated} auctions")
 
-# init_db()関数にinit_auction_db()を追加してください
 
 # =============================================================================
 # MongoDBのObjectIdインポート追加
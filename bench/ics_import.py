@@ -0,0 +1,104 @@
+"""ICS取り込みのベンチマーク
+
+N件（デフォルト10,000件）の予定を含むICSを生成し、POST /api/events/import で取り込む。
+解析だけにかかる時間、取り込み全体の時間、MongoDBへの往復回数（MONGO_DEBUGのX-Mongo-Round-Trips）を表示する。
+
+    MONGODB_URI=mongodb://localhost:27017 python bench/ics_import.py --events 10000
+    python bench/ics_import.py --mongomock   # テスト用のmongomockの代替で動かす（速度の目安にはならない）
+
+データベースのusers / event_days / recurring_eventsにベンチマーク用のユーザーの予定を書き込み、最後に削除する。
+"""
+import argparse
+import io
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_USER = "__bench_ics_import__"
+
+
+def build_ics(count, recurring_ratio):
+    """count件のVEVENTを含むICSを作る（recurring_ratioの割合は毎週の繰り返し予定）"""
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//furlife//bench//JA"]
+    start = date.today() + timedelta(days=1)  # 過去の日付は取り込まれないので明日から
+    recurring_every = int(1 / recurring_ratio) if recurring_ratio else 0
+    for index in range(count):
+        day = start + timedelta(days=index % 365)
+        hour = 6 + index % 14
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:bench-{index}@furlife",
+            f"DTSTART;TZID=Asia/Tokyo:{day:%Y%m%d}T{hour:02d}0000",
+            f"DTEND;TZID=Asia/Tokyo:{day:%Y%m%d}T{hour:02d}3000",
+            f"SUMMARY:ベンチマークの予定 {index}\\, 会議室{index % 7}",
+            f"LOCATION:東京{index % 5}",
+        ]
+        if recurring_every and index % recurring_every == 0:
+            lines.append("RRULE:FREQ=WEEKLY;COUNT=10")
+        lines.append("END:VEVENT")
+    lines.append("END:VCALENDAR")
+    return ("\r\n".join(lines) + "\r\n").encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--recurring-ratio", type=float, default=0.05)
+    parser.add_argument("--mongomock", action="store_true", help="tests/conftest.pyのmongomockの代替を使う")
+    args = parser.parse_args()
+
+    os.environ["MONGO_DEBUG"] = "1"
+    os.environ.setdefault("AUCTION_SCHEDULER_ENABLED", "0")
+    os.environ["ICS_IMPORT_MAX_EVENTS"] = str(max(args.events, int(os.environ.get("ICS_IMPORT_MAX_EVENTS", 0) or 0)))
+    sys.path.insert(0, ROOT)
+    if args.mongomock:
+        sys.path.insert(0, os.path.join(ROOT, "tests"))
+        import conftest  # noqa: F401  pymongo.MongoClientをmongomockの代替に差し替える
+    import app as furlife
+
+    payload = build_ics(args.events, args.recurring_ratio)
+
+    started = time.perf_counter()
+    parsed = sum(1 for _ in map(furlife.ics_to_event, furlife.read_ics_events(furlife.read_ics_lines(io.BytesIO(payload)))))
+    parse_seconds = time.perf_counter() - started
+
+    furlife.users_collection.delete_one({"username": BENCH_USER})
+    furlife.users_collection.insert_one({
+        "username": BENCH_USER,
+        "password": "x",
+        "layout_version": furlife.USER_LAYOUT_VERSION,
+        "events": {"collection": furlife.event_days_collection.name},
+    })
+    client = furlife.app.test_client()
+    with client.session_transaction() as sess:
+        sess["username"] = BENCH_USER
+
+    try:
+        started = time.perf_counter()
+        response = client.post(
+            "/api/events/import",
+            data={"file": (io.BytesIO(payload), "bench.ics")},
+            content_type="multipart/form-data",
+        )
+        import_seconds = time.perf_counter() - started
+        result = response.get_json()
+        day_docs = furlife.event_days_collection.count_documents({"username": BENCH_USER})
+    finally:
+        furlife.event_days_collection.delete_many({"username": BENCH_USER})
+        furlife.recurring_events_collection.delete_many({"username": BENCH_USER})
+        furlife.users_collection.delete_one({"username": BENCH_USER})
+
+    round_trips = int(response.headers.get("X-Mongo-Round-Trips", 0))
+    print(f"backend:          {'mongomock' if args.mongomock else furlife.MONGODB_URI.split('@')[-1]}")
+    print(f"ICS size:         {len(payload) / 1024 / 1024:.1f} MiB, {parsed} events")
+    print(f"parse only:       {parse_seconds:.2f}s ({parsed / parse_seconds:,.0f} events/s)")
+    print(f"import:           {import_seconds:.2f}s ({parsed / import_seconds:,.0f} events/s), HTTP {response.status_code}")
+    print(f"imported:         {result.get('imported')} events, {result.get('imported_recurring')} recurring rules, "
+          f"{result.get('skipped_count')} skipped, {day_docs} day documents")
+    print(f"round trips:      {round_trips} ({round_trips / max(parsed, 1) * 1000:.1f} per 1,000 events)")
+
+
+if __name__ == "__main__":
+    main()
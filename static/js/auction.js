@@ -440,21 +440,6 @@ function initAnimations() {
   });
 }
 
-// =============================================================================
-// 定期的なオークション終了チェック
-// =============================================================================
-
-function startPeriodicCheck() {
-  // 5分ごとにオークション終了処理をチェック
-  setInterval(async () => {
-    try {
-      await fetch('/api/auction/finalize', { method: 'POST' });
-    } catch (error) {
-      console.error('Finalize check error:', error);
-    }
-  }, 5 * 60 * 1000);
-}
-
 // =============================================================================
 // 初期化
 // =============================================================================
@@ -470,7 +455,6 @@ function init() {
   initBidModal();
   initCancelButtons();
   initAnimations();
-  startPeriodicCheck();
 }
 
 // ページ読み込み時に初期化
@@ -150,6 +150,58 @@ function initLocationManagement() {
   updateLocationSelect();
 }
 
+// =============================================================================
+// 予定の読み込み・書き出し（iCalendar形式）
+// =============================================================================
+
+function initIcsImportExport() {
+  const exportBtn = q('#settings-export-ics-btn');
+  if (exportBtn) {
+    exportBtn.addEventListener('click', () => {
+      window.location.href = '/api/events/export.ics';
+    });
+  }
+  
+  const importBtn = q('#settings-import-ics-btn');
+  const importInput = q('#settings-import-ics-input');
+  if (!importBtn || !importInput) return;
+  
+  importBtn.addEventListener('click', () => importInput.click());
+  importInput.addEventListener('change', async () => {
+    const file = importInput.files[0];
+    if (!file) return;
+    
+    const body = new FormData();
+    body.append('file', file);
+    importBtn.disabled = true;
+    try {
+      const res = await fetch('/api/events/import', { method: 'POST', body });
+      const data = await res.json();
+      if (!res.ok) {
+        alert(data.error || '読み込みに失敗しました');
+        return;
+      }
+      
+      let message = `${data.imported + data.imported_recurring}件の予定を読み込みました`;
+      if (data.skipped_count > 0) {
+        const details = data.skipped.slice(0, 10).map(s => `・${s.event || '(無題)'}: ${s.reason}`).join('\n');
+        message += `\n${data.skipped_count}件は読み込めませんでした\n${details}`;
+      }
+      if (data.truncated) {
+        message += '\n件数が上限を超えたため、残りは読み込んでいません';
+      }
+      alert(message);
+      location.reload();
+    } catch (err) {
+      console.error('ICS import error:', err);
+      alert('読み込みに失敗しました');
+    } finally {
+      importBtn.disabled = false;
+      importInput.value = '';
+    }
+  });
+}
+
 // =============================================================================
 // カラーピッカー
 // =============================================================================
@@ -732,6 +784,14 @@ function showForm({ date, id = "", startTime = "09:00", endTime = "10:00", event
   q("#endTimeInput").value = endTime;
   q("#eventInput").value = eventText;
   q("#locationSelect").value = location;
+  
+  // 繰り返しは新規追加のときだけ指定できる
+  const repeatGroup = q("#repeatGroup");
+  if (repeatGroup) {
+    repeatGroup.style.display = isEdit ? "none" : "";
+    q("#repeatSelect").value = "";
+    q("#repeatUntilInput").value = "";
+  }
 
   const form = q("#eventForm");
   form.method = "post";
@@ -743,6 +803,80 @@ function showForm({ date, id = "", startTime = "09:00", endTime = "10:00", event
   }, 100);
 }
 
+// 予定の追加・更新はJSON APIで行い、変更された日の表示だけを差し替える
+async function submitEventForm(form) {
+  const isEdit = form.action.endsWith('/update_event');
+  const errorMsg = q("#form-error-message");
+  const payload = Object.fromEntries(new FormData(form));
+  
+  let res;
+  try {
+    res = await fetch(isEdit ? "/api/events/update" : "/api/events/create", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify(payload)
+    });
+  } catch (err) {
+    // 通信できない場合は通常のフォーム送信に切り替える
+    console.error("通信エラー", err);
+    form.submit();
+    return;
+  }
+  
+  const data = await res.json().catch(() => ({}));
+  if (!res.ok || !data.success) {
+    errorMsg.textContent = data.error || "保存に失敗しました";
+    errorMsg.style.display = "block";
+    errorMsg.scrollIntoView({ behavior: "smooth", block: "nearest" });
+    return;
+  }
+  
+  if (data.recurring) {
+    // 繰り返し予定は複数の日に表示されるので表示中の月を読み込み直す
+    location.reload();
+    return;
+  }
+  
+  setDayEvents(data.date, data.events);
+  q("#form").classList.add("hidden");
+  if (selectedCell) selectedCell.classList.remove("selected");
+}
+
+function setDayEvents(date, events) {
+  if (events.length > 0) {
+    allEvents[date] = events;
+  } else {
+    delete allEvents[date];
+  }
+  
+  renderCalendarCell(date);
+  if (currentDisplayDate === date) {
+    displayEventsForDate(date);
+  }
+}
+
+function renderCalendarCell(date) {
+  const cell = document.querySelector(`td.calendar-cell[data-date="${date}"]`);
+  if (!cell) return;
+  
+  cell.querySelectorAll('.event-entry').forEach(el => el.remove());
+  (allEvents[date] || []).forEach(item => {
+    const startTime = item.start_time || item.time || '00:00';
+    const endTime = item.end_time || '23:59';
+    
+    const div = document.createElement('div');
+    div.className = 'calendar-event event-entry';
+    div.dataset.id = item.id;
+    div.dataset.startTime = startTime;
+    div.dataset.endTime = endTime;
+    div.dataset.event = item.event;
+    div.dataset.date = date;
+    div.dataset.location = item.location || 'その他';
+    div.textContent = `${startTime}-${endTime} ${item.event}`;
+    cell.appendChild(div);
+  });
+}
+
 function initFormHandlers() {
   const eventForm = q("#eventForm");
   if (eventForm) {
@@ -761,6 +895,9 @@ function initFormHandlers() {
         errorMsg.scrollIntoView({ behavior: "smooth", block: "nearest" });
         return false;
       }
+      
+      e.preventDefault();
+      submitEventForm(eventForm);
     });
   }
 
@@ -932,6 +1069,24 @@ function initTimeDuration() {
     });
   });
 
+  // 重なる予定の拒否はサーバー側で判定するので、設定もサーバーに保存する
+  const rejectOverlapsCheckbox = q('#reject-overlaps-checkbox');
+  if (rejectOverlapsCheckbox) {
+    rejectOverlapsCheckbox.addEventListener('change', async (e) => {
+      try {
+        const res = await fetch('/api/events/settings', {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ reject_overlaps: e.target.checked })
+        });
+        if (!res.ok) throw new Error(res.status);
+      } catch (err) {
+        console.error('設定の保存に失敗しました', err);
+        e.target.checked = !e.target.checked;
+      }
+    });
+  }
+
   const startTimeInput = q('#startTimeInput');
   const endTimeInput = q('#endTimeInput');
 
@@ -1532,6 +1687,7 @@ function init() {
   initTheme();
   initPetName();
   initLocationManagement();
+  initIcsImportExport();
   initColorPicker();
   initPetSelectModal();
   initEventHandlers();
@@ -378,16 +378,16 @@ function updatePetUI(data) {
 // インベントリ更新
 // =============================================================================
 
+const INVENTORY_ELEMENT_IDS = {
+  '基本の餌': 'inventory-basic',
+  'おいしい餌': 'inventory-tasty',
+  'プレミアム餌': 'inventory-premium',
+  'スペシャル餌': 'inventory-special'
+};
+
 function updateInventory(inventory) {
-  const mapping = {
-    '基本の餌': 'inventory-basic',
-    'おいしい餌': 'inventory-tasty',
-    'プレミアム餌': 'inventory-premium',
-    'スペシャル餌': 'inventory-special'
-  };
-  
   Object.entries(inventory).forEach(([foodName, count]) => {
-    const elementId = mapping[foodName];
+    const elementId = INVENTORY_ELEMENT_IDS[foodName];
     if (elementId) {
       const el = q(`#${elementId}`);
       if (el) el.textContent = count;
@@ -437,84 +437,139 @@ function updateSelectedFoodDisplay() {
   if (emojiEl) emojiEl.textContent = selectedFood.emoji;
   if (nameEl) nameEl.textContent = selectedFood.name;
   if (expEl) expEl.textContent = `+${selectedFood.exp} EXP`;
+  updatePendingFeedDisplay();
 }
 
 
-function initFeedButton() {
+// 続けてクリックした分はまとめて1回の/feedで送る（この時間内のクリックを合算）
+const FEED_BATCH_DELAY_MS = 400;
+
+// 送信待ちの餌 { 餌の名前: 個数 }
+let pendingFoods = {};
+let feedTimer = null;
+let feedInFlight = false;
+
+function countPendingFoods() {
+  return Object.values(pendingFoods).reduce((sum, n) => sum + n, 0);
+}
+
+function updatePendingFeedDisplay() {
+  const expEl = q('#selectedExp');
+  if (!expEl) return;
+  const pending = pendingFoods[selectedFood.name] || 0;
+  expEl.textContent = pending > 0
+    ? `+${selectedFood.exp} EXP ×${pending}`
+    : `+${selectedFood.exp} EXP`;
+}
+
+function queueFeed(foodName) {
+  // 所持数を超えるクリックは送らない（所持数が分からない場合はサーバーの判定に任せる）
+  const countEl = q(`#${INVENTORY_ELEMENT_IDS[foodName]}`);
+  const owned = countEl ? parseInt(countEl.textContent) : NaN;
+  const pending = pendingFoods[foodName] || 0;
+  if (!isNaN(owned) && pending >= owned) {
+    q('#pet-message').textContent = owned > 0
+      ? `${foodName}が足りません!(所持数: ${owned})`
+      : `${foodName}がありません!`;
+    return;
+  }
+  
+  pendingFoods[foodName] = pending + 1;
+  updatePendingFeedDisplay();
+  clearTimeout(feedTimer);
+  feedTimer = setTimeout(flushFeed, FEED_BATCH_DELAY_MS);
+}
+
+async function flushFeed() {
+  if (feedInFlight || countPendingFoods() === 0) return;
+  
+  const foods = pendingFoods;
+  pendingFoods = {};
+  feedInFlight = true;
+  
   const selectedFoodDisplay = q('#selectedFoodDisplay');
-  if (!selectedFoodDisplay) return;
+  selectedFoodDisplay.disabled = true;
+  selectedFoodDisplay.style.opacity = '0.6';
   
-  selectedFoodDisplay.addEventListener('click', async () => {
-    try {
-      selectedFoodDisplay.disabled = true;
-      selectedFoodDisplay.style.opacity = '0.6';
-      
-      const res = await fetch('/feed', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ food_name: selectedFood.name })
-      });
-      
-      const data = await res.json();
-      
-      if (res.ok) {
-        // ★重要: レベルアップしていない場合は通常のUI更新
-        if (!data.levels_gained || data.levels_gained === 0) {
-          updatePetUI(data);
-          selectedFoodDisplay.disabled = false;
-          selectedFoodDisplay.style.opacity = '1';
-          return;
-        }
-        
-        // ★重要: レベルアップした場合
-        const petType = data.pet_type || 1;
-        const isFinalEvolution = (petType === 1 && data.level === 10) || (petType !== 1 && data.level === 5);
-        
-        // 新しく発見したペットを記録（レベルアップ時のみ）
-        if (data.image) {
-          localStorage.setItem('lastDiscoveredPet', data.image);
-        }
-        
-        // スクロール位置を保存
-        const pokedexSections = q('.pokedex-sections');
-        if (pokedexSections) {
-          localStorage.setItem('pokedexScrollPosition', pokedexSections.scrollTop);
-        }
-        
-        // ペットタイプを保存
-        const petTypeMatch = data.image.match(/^pet(\d+)\//);
-        if (petTypeMatch) {
-          localStorage.setItem('lastScrolledSection', petTypeMatch[1]);
-        }
-        
-        // ★重要: 少し待機してからモーダル表示（データベース同期を保証）
-        await new Promise(resolve => setTimeout(resolve, 300));
-        
-        // ★重要: 画像のキャッシュを回避するためタイムスタンプ付きで取得
-        const timestamp = Date.now();
-        const imageWithCache = `${data.image}?t=${timestamp}`;
-        
-        // ★修正: start_levelを正しく使用
-        showLevelUpModal({
-          oldLevel: data.start_level,  // ★修正: これが開始レベル
-          newLevel: data.level,         // これが最終レベル
-          petImage: imageWithCache,
-          petType: petType,
-          evolution: isFinalEvolution ? data.evolution : undefined,
-          levelsGained: data.levels_gained
-        });
-      } else {
-        alert(data.message || '餌やりに失敗しました');
-        selectedFoodDisplay.disabled = false;
-        selectedFoodDisplay.style.opacity = '1';
-      }
-    } catch (err) {
-      console.error('エラー:', err);
-      alert('餌やりに失敗しました');
+  let leveledUp = false;
+  try {
+    const res = await fetch('/feed', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ foods })
+    });
+    
+    const data = await res.json();
+    
+    if (!res.ok) {
+      alert(data.error || data.message || '餌やりに失敗しました');
+      return;
+    }
+    
+    // ★重要: レベルアップしていない場合は通常のUI更新
+    if (!data.levels_gained) {
+      updatePetUI(data);
+      return;
+    }
+    
+    // ★重要: レベルアップした場合（モーダルを閉じるとページを読み直す）
+    leveledUp = true;
+    pendingFoods = {};
+    const petType = data.pet_type || 1;
+    const isFinalEvolution = (petType === 1 && data.level === 10) || (petType !== 1 && data.level === 5);
+    
+    // 新しく発見したペットを記録（レベルアップ時のみ）
+    if (data.image) {
+      localStorage.setItem('lastDiscoveredPet', data.image);
+    }
+    
+    // スクロール位置を保存
+    const pokedexSections = q('.pokedex-sections');
+    if (pokedexSections) {
+      localStorage.setItem('pokedexScrollPosition', pokedexSections.scrollTop);
+    }
+    
+    // ペットタイプを保存
+    const petTypeMatch = data.image.match(/^pet(\d+)\//);
+    if (petTypeMatch) {
+      localStorage.setItem('lastScrolledSection', petTypeMatch[1]);
+    }
+    
+    // ★重要: 画像のキャッシュを回避するためタイムスタンプ付きで取得
+    const timestamp = Date.now();
+    
+    // 通過したレベルを1段階ずつ見せる
+    showLevelUpModal({
+      oldLevel: data.start_level,
+      newLevel: data.level,
+      petImage: `${data.image}?t=${timestamp}`,
+      petType: petType,
+      evolution: isFinalEvolution ? data.evolution : undefined,
+      levelsGained: data.levels_gained,
+      passedLevels: (data.passed_levels || []).map(step => ({ ...step, image: `${step.image}?t=${timestamp}` }))
+    });
+  } catch (err) {
+    console.error('エラー:', err);
+    alert('餌やりに失敗しました');
+  } finally {
+    feedInFlight = false;
+    updatePendingFeedDisplay();
+    if (!leveledUp) {
       selectedFoodDisplay.disabled = false;
       selectedFoodDisplay.style.opacity = '1';
+      // 送信中にクリックされた分を続けて送る
+      if (countPendingFoods() > 0) {
+        feedTimer = setTimeout(flushFeed, FEED_BATCH_DELAY_MS);
+      }
     }
-  });
+  }
+}
+
+function initFeedButton() {
+  const selectedFoodDisplay = q('#selectedFoodDisplay');
+  if (!selectedFoodDisplay) return;
+  
+  selectedFoodDisplay.addEventListener('click', () => queueFeed(selectedFood.name));
 }
 
 // =============================================================================
@@ -722,7 +777,38 @@ function calculateRarity(petType, evolutionType) {
   return 1;
 }
 
-function showLevelUpModal({ oldLevel, newLevel, petImage, petType, evolution, levelsGained = 1 }) {
+// 通過したレベルを1段階ずつ見せる間隔
+const LEVEL_STEP_MS = 700;
+let levelStepTimer = null;
+
+// 要素のCSSアニメーションを最初から再生し直す
+function replayAnimation(el) {
+  el.style.animation = 'none';
+  void el.offsetWidth;
+  el.style.animation = '';
+}
+
+// passedLevels（[{ level, image }]）の各段階のレベルと画像を順に表示し、最後の段階でonDoneを呼ぶ
+function playPassedLevels(passedLevels, levelTo, petImg, onDone) {
+  clearTimeout(levelStepTimer);
+  let index = 0;
+  const step = () => {
+    const passed = passedLevels[index];
+    levelTo.textContent = `Lv.${passed.level}`;
+    petImg.src = `/static/images/${passed.image}`;
+    replayAnimation(levelTo);
+    replayAnimation(petImg);
+    index += 1;
+    if (index < passedLevels.length) {
+      levelStepTimer = setTimeout(step, LEVEL_STEP_MS);
+    } else if (onDone) {
+      onDone();
+    }
+  };
+  step();
+}
+
+function showLevelUpModal({ oldLevel, newLevel, petImage, petType, evolution, levelsGained = 1, passedLevels = [] }) {
   const modal = q('#levelupModal');
   const content = q('#levelupContent');
   const levelFrom = q('#levelupLevelFrom');
@@ -740,6 +826,17 @@ function showLevelUpModal({ oldLevel, newLevel, petImage, petType, evolution, le
   
   petImg.src = `/static/images/${petImage}`;
   
+  // 複数レベル上がったときは途中の段階も順に見せ、進化の表示は最後の段階で出す
+  const stepping = passedLevels.length > 1;
+  evolutionTypeDiv.style.visibility = stepping ? 'hidden' : '';
+  rarityDiv.style.visibility = stepping ? 'hidden' : '';
+  if (stepping) {
+    playPassedLevels(passedLevels, levelTo, petImg, () => {
+      evolutionTypeDiv.style.visibility = '';
+      rarityDiv.style.visibility = '';
+    });
+  }
+  
   const isFinalEvolution = (petType === 1 && newLevel === 10) || (petType !== 1 && newLevel === 5);
   
   if (isFinalEvolution) {
@@ -804,6 +901,7 @@ function showLevelUpModal({ oldLevel, newLevel, petImage, petType, evolution, le
 }
 
 function closeLevelUpModal() {
+  clearTimeout(levelStepTimer);
   const modal = q('#levelupModal');
   if (modal) {
     modal.classList.remove('active');
@@ -263,44 +263,90 @@ function initBuyButtons() {
 // 餌やり処理
 // =============================================================================
 
+// 続けてクリックした分はまとめて1回の/feedで送る（この時間内のクリックを合算）
+const FEED_BATCH_DELAY_MS = 400;
+
+// 送信待ちの餌 { 餌の名前: 個数 }
+let pendingFoods = {};
+let feedTimer = null;
+let feedInFlight = false;
+
+function countPendingFoods() {
+  return Object.values(pendingFoods).reduce((sum, n) => sum + n, 0);
+}
+
+function queueFeed(foodName) {
+  // 所持数を超えるクリックは送らない（所持数が分からない場合はサーバーの判定に任せる）
+  const countEl = document.querySelector(`.food-count[data-food="${foodName}"]`);
+  const owned = countEl ? parseInt(countEl.textContent) : NaN;
+  const pending = pendingFoods[foodName] || 0;
+  if (!isNaN(owned) && pending >= owned) {
+    q('#pet-message').textContent = owned > 0
+      ? `${foodName}が足りません!(所持数: ${owned})`
+      : `${foodName}がありません!`;
+    return;
+  }
+  
+  pendingFoods[foodName] = pending + 1;
+  q('#pet-message').textContent = `${foodName} ×${pendingFoods[foodName]}`;
+  clearTimeout(feedTimer);
+  feedTimer = setTimeout(flushFeed, FEED_BATCH_DELAY_MS);
+}
+
+async function flushFeed() {
+  if (feedInFlight || countPendingFoods() === 0) return;
+  
+  const foods = pendingFoods;
+  pendingFoods = {};
+  feedInFlight = true;
+  
+  try {
+    const res = await fetch('/feed', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ foods })
+    });
+    
+    const data = await res.json();
+    
+    if (!res.ok) {
+      alert(data.error || data.message || '餌やりに失敗しました');
+      return;
+    }
+    
+    if (data.levels_gained !== undefined && data.levels_gained > 0) {
+      if (data.image) {
+        localStorage.setItem('lastDiscoveredPet', data.image);
+      }
+      
+      // 通過したレベルを1段階ずつ見せる
+      showLevelUpModal({
+        oldLevel: data.start_level,
+        newLevel: data.level,
+        petImage: data.image,
+        petType: data.pet_type || 1,
+        evolution: data.evolution || 1,
+        levelsGained: data.levels_gained,
+        passedLevels: data.passed_levels || []
+      });
+    } else {
+      updateUI(data);
+    }
+  } catch (err) {
+    console.error('エラー:', err);
+    alert('餌やりに失敗しました');
+  } finally {
+    feedInFlight = false;
+    // 送信中にクリックされた分を続けて送る
+    if (countPendingFoods() > 0) {
+      feedTimer = setTimeout(flushFeed, FEED_BATCH_DELAY_MS);
+    }
+  }
+}
+
 function initFeedButtons() {
   qa('.feed-btn').forEach(btn => {
-    btn.addEventListener('click', async () => {
-      const foodName = btn.dataset.food;
-      const levelLabel = q('#level-label');
-      const currentLevel = levelLabel ? parseInt(levelLabel.textContent.replace('Lv.', '')) : 0;
-      
-      try {
-        const res = await fetch('/feed', {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({ food_name: foodName })
-        });
-        
-        const data = await res.json();
-        
-        if (data.levels_gained !== undefined && data.levels_gained > 0) {
-          if (data.image) {
-            localStorage.setItem('lastDiscoveredPet', data.image);
-          }
-          
-          // ★修正: start_levelを使用
-          showLevelUpModal({
-            oldLevel: data.start_level,  // ★修正: これが開始レベル
-            newLevel: data.level,
-            petImage: data.image,
-            petType: data.pet_type || 1,
-            evolution: data.evolution || 1,
-            levelsGained: data.levels_gained
-          });
-        } else {
-          updateUI(data);
-        }
-      } catch (err) {
-        console.error('エラー:', err);
-        alert('餌やりに失敗しました');
-      }
-    });
+    btn.addEventListener('click', () => queueFeed(btn.dataset.food));
   });
 }
 
@@ -331,7 +377,38 @@ function calculateRarity(petType, evolutionType) {
   return 1;
 }
 
-function showLevelUpModal({ oldLevel, newLevel, petImage, petType, evolution, levelsGained = 1 }) {
+// 通過したレベルを1段階ずつ見せる間隔
+const LEVEL_STEP_MS = 700;
+let levelStepTimer = null;
+
+// 要素のCSSアニメーションを最初から再生し直す
+function replayAnimation(el) {
+  el.style.animation = 'none';
+  void el.offsetWidth;
+  el.style.animation = '';
+}
+
+// passedLevels（[{ level, image }]）の各段階のレベルと画像を順に表示し、最後の段階でonDoneを呼ぶ
+function playPassedLevels(passedLevels, levelTo, petImg, onDone) {
+  clearTimeout(levelStepTimer);
+  let index = 0;
+  const step = () => {
+    const passed = passedLevels[index];
+    levelTo.textContent = `Lv.${passed.level}`;
+    petImg.src = `/static/images/${passed.image}`;
+    replayAnimation(levelTo);
+    replayAnimation(petImg);
+    index += 1;
+    if (index < passedLevels.length) {
+      levelStepTimer = setTimeout(step, LEVEL_STEP_MS);
+    } else if (onDone) {
+      onDone();
+    }
+  };
+  step();
+}
+
+function showLevelUpModal({ oldLevel, newLevel, petImage, petType, evolution, levelsGained = 1, passedLevels = [] }) {
   const modal = q('#levelupModal');
   const content = q('#levelupContent');
   const levelFrom = q('#levelupLevelFrom');
@@ -348,6 +425,17 @@ function showLevelUpModal({ oldLevel, newLevel, petImage, petType, evolution, le
   levelTo.textContent = `Lv.${newLevel}`;
   petImg.src = `/static/images/${petImage}`;
   
+  // 複数レベル上がったときは途中の段階も順に見せ、進化の表示は最後の段階で出す
+  const stepping = passedLevels.length > 1;
+  evolutionTypeDiv.style.visibility = stepping ? 'hidden' : '';
+  rarityDiv.style.visibility = stepping ? 'hidden' : '';
+  if (stepping) {
+    playPassedLevels(passedLevels, levelTo, petImg, () => {
+      evolutionTypeDiv.style.visibility = '';
+      rarityDiv.style.visibility = '';
+    });
+  }
+  
   const isFinalEvolution = (petType === 1 && newLevel === 10) || (petType !== 1 && newLevel === 5);
   
   if (isFinalEvolution) {
@@ -412,6 +500,7 @@ function showLevelUpModal({ oldLevel, newLevel, petImage, petType, evolution, le
 }
 
 function closeLevelUpModal() {
+  clearTimeout(levelStepTimer);
   const modal = q('#levelupModal');
   if (modal) {
     modal.classList.remove('active');
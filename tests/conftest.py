@@ -0,0 +1,249 @@
+"""テスト用の共通設定
+
+app.pyはimport時にMongoClientを作るので、importより前にpymongo.MongoClientを
+mongomockのクライアントに差し替える。mongomockに足りない部分はここで補う。
+- コマンドの開始をpymongoと同じようにevent_listenersへ通知する（MongoRoundTripCounter用）
+- 1つの操作（とトランザクション全体）をロックで直列に実行する（サーバー側の原子性の代わり）
+- start_session / with_transaction（レプリカセット相当。失敗時は開始前の状態に戻す）
+- $bit演算子、複数キーでの$push + $sort、find_one_and_updateで条件のフィールドを書き換えた場合の戻り値
+"""
+import copy
+import os
+import sys
+import threading
+from types import SimpleNamespace
+
+import mongomock
+import mongomock.collection
+import pymongo
+import pytest
+
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017")
+os.environ.setdefault("AUCTION_SCHEDULER_ENABLED", "0")
+# 天気APIへは接続しない（天気のテストはスタブサーバーのURLに差し替える）
+os.environ.setdefault("WEATHER_API_URL", "http://127.0.0.1:9/weather")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 1つの操作・トランザクションを直列にするロック（同じスレッドからの入れ子の呼び出しは素通り）
+operation_lock = threading.RLock()
+operation_depth = threading.local()
+
+COMMAND_NAMES = {
+    "find": "find",
+    "find_one": "find",
+    "count_documents": "aggregate",
+    "distinct": "distinct",
+    "aggregate": "aggregate",
+    "insert_one": "insert",
+    "insert_many": "insert",
+    "update_one": "update",
+    "update_many": "update",
+    "replace_one": "update",
+    "delete_one": "delete",
+    "delete_many": "delete",
+    "find_one_and_update": "findAndModify",
+    "find_one_and_replace": "findAndModify",
+    "find_one_and_delete": "findAndModify",
+    "create_index": "createIndexes",
+}
+
+BULK_COMMAND_NAMES = {
+    "InsertOne": "insert",
+    "UpdateOne": "update",
+    "UpdateMany": "update",
+    "ReplaceOne": "update",
+    "DeleteOne": "delete",
+    "DeleteMany": "delete",
+}
+
+
+class ReplicaSetSession:
+    """mongomockの上で動くトランザクション（開始前のデータを控えておき、失敗したら書き戻す）"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def with_transaction(self, callback):
+        with operation_lock:
+            snapshot = {
+                (db_name, name): copy.deepcopy(list(self.client[db_name][name].find({})))
+                for db_name in self.client.list_database_names()
+                for name in self.client[db_name].list_collection_names()
+            }
+            try:
+                return callback(self)
+            except BaseException:
+                for db_name in self.client.list_database_names():
+                    for name in self.client[db_name].list_collection_names():
+                        collection = self.client[db_name][name]
+                        collection.delete_many({})
+                        docs = snapshot.get((db_name, name))
+                        if docs:
+                            collection.insert_many(docs)
+                raise
+
+
+class MockMongoClient(mongomock.MongoClient):
+    """event_listenersを受け取り、replica_set=Trueのときだけトランザクションを使えるクライアント"""
+
+    def __init__(self, *args, event_listeners=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.event_listeners = list(event_listeners or [])
+        self.replica_set = False
+
+    def start_session(self, *args, **kwargs):
+        if not self.replica_set:
+            return super().start_session(*args, **kwargs)
+        return ReplicaSetSession(self)
+
+
+def notify_command(collection, command_name):
+    """pymongoのCommandListener.startedと同じ形でコマンドの開始を通知する"""
+    client = collection.database.client
+    event = SimpleNamespace(
+        command_name=command_name,
+        command={command_name: collection.name},
+        database_name=collection.database.name,
+    )
+    for listener in getattr(client, "event_listeners", []):
+        listener.started(event)
+
+
+def instrument(method_name, original):
+    def wrapper(self, *args, **kwargs):
+        if isinstance(kwargs.get("session"), ReplicaSetSession):
+            kwargs.pop("session")
+        depth = getattr(operation_depth, "value", 0)
+        if depth == 0:
+            if method_name == "bulk_write":
+                names = {BULK_COMMAND_NAMES.get(type(op).__name__, "update") for op in args[0]}
+                for name in sorted(names):
+                    notify_command(self, name)
+            else:
+                notify_command(self, COMMAND_NAMES[method_name])
+        operation_depth.value = depth + 1
+        try:
+            with operation_lock:
+                return original(self, *args, **kwargs)
+        finally:
+            operation_depth.value = depth
+    return wrapper
+
+
+# --- mongomockに無い$bit演算子（or / and / xor）と、複数キーでの$push + $sort ---
+_original_apply_update = mongomock.collection.Collection._apply_update_document
+
+
+def _read_path(doc, path):
+    for part in path.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return 0
+        doc = doc[part]
+    return doc
+
+
+def _apply_update_with_bit(self, existing_document, spec, document, *args, **kwargs):
+    if "$bit" in document:
+        document = dict(document)
+        sets = dict(document.get("$set", {}))
+        for path, ops in document.pop("$bit").items():
+            value = int(_read_path(existing_document, path))
+            for op, operand in ops.items():
+                if op == "or":
+                    value |= int(operand)
+                elif op == "and":
+                    value &= int(operand)
+                else:
+                    value ^= int(operand)
+            sets[path] = value
+        document["$set"] = sets
+    pushes = document.get("$push", {})
+    multi_key = [path for path, value in pushes.items()
+                 if isinstance(value, dict) and isinstance(value.get("$sort"), dict) and len(value["$sort"]) > 1]
+    if multi_key:
+        # mongomockの$push + $sortは最初の1キーでしか並べないので、並べた配列を$setで書き込む
+        document = dict(document, **{"$push": dict(pushes), "$set": dict(document.get("$set", {}))})
+        for path in multi_key:
+            value = document["$push"].pop(path)
+            items = list(_read_path(existing_document, path) or []) + list(value["$each"])
+            for key, direction in reversed(list(value["$sort"].items())):
+                items.sort(key=lambda item: _read_path(item, key), reverse=direction < 0)
+            document["$set"][path] = items
+        if not document["$push"]:
+            del document["$push"]
+    return _original_apply_update(self, existing_document, spec, document, *args, **kwargs)
+
+
+mongomock.collection.Collection._apply_update_document = _apply_update_with_bit
+
+
+# --- mongomockは更新後にもう一度条件（と射影で残した_id）で探すため、条件のフィールドを書き換えたり
+#     _idを射影で除いたりするとNoneを返す。_idで探し直し、射影は戻り値に後から当てる ---
+_original_find_one_and_update = mongomock.collection.Collection.find_one_and_update
+
+
+def _find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False, **kwargs):
+    with operation_lock:
+        found = self.find_one(filter, {"_id": 1}, sort=sort)
+        if found is not None:
+            filter = {"_id": found["_id"]}
+        elif not upsert:
+            return None
+        doc = _original_find_one_and_update(self, filter, update, sort=sort, upsert=upsert, **kwargs)
+        if doc is None or projection is None:
+            return doc
+        return self._copy_only_fields(doc, dict(projection), dict)
+
+
+mongomock.collection.Collection.find_one_and_update = _find_one_and_update
+
+for _name in list(COMMAND_NAMES) + ["bulk_write"]:
+    setattr(mongomock.collection.Collection, _name,
+            instrument(_name, getattr(mongomock.collection.Collection, _name)))
+
+pymongo.MongoClient = MockMongoClient
+
+import app as app_module  # noqa: E402
+
+
+@pytest.fixture
+def furlife():
+    """空のデータベースで初期化したappモジュール"""
+    app_module.client.drop_database(app_module.db.name)
+    app_module.client.replica_set = False
+    app_module.auction_settlement_state["transactions"] = None
+    app_module.leaderboard_state["snapshot"] = None
+    app_module.app.config["TESTING"] = True
+    app_module.init_db()
+    yield app_module
+    app_module.client.drop_database(app_module.db.name)
+
+
+@pytest.fixture
+def make_user(furlife):
+    """ペットを育成中のユーザーを作り、ログイン済みのテストクライアントを返す"""
+    def make(username, coins=1000, inventory=None, **pet_fields):
+        pet = {
+            "alive": True, "started": True, "level": 12, "exp": 0, "pet_type": 2, "evolution": 1,
+            "coins": coins, "inventory": dict(inventory or {}), "message": "",
+        }
+        pet.update(pet_fields)
+        furlife.users_collection.insert_one({
+            "username": username,
+            "password": "x",
+            "layout_version": furlife.USER_LAYOUT_VERSION,
+            "events": {"collection": furlife.event_days_collection.name},
+            "pet": pet,
+        })
+        client = furlife.app.test_client()
+        with client.session_transaction() as sess:
+            sess["username"] = username
+        return client
+    return make
@@ -0,0 +1,147 @@
+"""オークションの決済（トランザクション / ジャーナル）のテスト"""
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo.errors import OperationFailure
+
+
+@pytest.fixture
+def auctions(furlife, make_user):
+    """3人の出品者と2人の入札者で、入札あり2件・入札なし1件のオークションを作って終了させる"""
+    sellers = [make_user(f"seller{i}") for i in range(3)]
+    alice = make_user("alice")
+    bob = make_user("bob")
+    ids = []
+    for seller in sellers:
+        response = seller.post("/api/auction/create", json={"starting_price": 100, "duration": "24h"})
+        ids.append(response.get_json()["auction_id"])
+    assert alice.post("/api/auction/bid", json={"auction_id": ids[0], "amount": 150}).get_json()["success"]
+    assert bob.post("/api/auction/bid", json={"auction_id": ids[0], "amount": 200}).get_json()["success"]
+    assert alice.post("/api/auction/bid", json={"auction_id": ids[1], "amount": 120}).get_json()["success"]
+    assert alice.post("/api/auction/bid", json={"auction_id": ids[1], "amount": 130}).get_json()["success"]
+    furlife.auctions_collection.update_many(
+        {}, {"$set": {"end_time": datetime.now(furlife.JST) - timedelta(seconds=1)}}
+    )
+    return ids
+
+
+def coins(furlife):
+    return {doc["username"]: doc["pet"]["coins"] for doc in furlife.users_collection.find({}, {"username": 1, "pet.coins": 1})}
+
+
+def assert_settled(furlife, ids, before):
+    """落札額が出品者へ移り、落札できなかった入札は全額戻っていること"""
+    results = {str(doc["_id"]): doc for doc in furlife.auctions_collection.find({})}
+    assert [results[i]["status"] for i in ids] == ["sold", "sold", "unsold"]
+    assert (results[ids[0]]["winner"], results[ids[0]]["final_price"]) == ("bob", 200)
+    assert (results[ids[1]]["winner"], results[ids[1]]["final_price"]) == ("alice", 130)
+    after = coins(furlife)
+    assert after["seller0"] == before["seller0"] + 200
+    assert after["seller1"] == before["seller1"] + 130
+    assert after["seller2"] == before["seller2"]
+    assert after["alice"] == before["alice"] + 150  # ids[0]で預けた150だけ戻る
+    assert after["bob"] == before["bob"]
+    assert sum(after.values()) == sum(before.values()) + 150 + 200 + 130
+    assert furlife.users_collection.count_documents({"settlement_marks.0": {"$exists": True}}) == 0
+    pets = {doc["username"]: doc["pet"] for doc in furlife.users_collection.find({})}
+    assert pets["bob"]["message"].startswith("オークションでseller0さんのペットを落札しました")
+    assert pets["seller2"]["alive"] is True
+
+
+def test_transaction_path_settles_batch(furlife, auctions):
+    furlife.client.replica_set = True
+    before = coins(furlife)
+
+    assert furlife.finalize_due_auctions(auctions) == 3
+
+    assert furlife.auction_settlement_state["transactions"] is True
+    assert furlife.auctions_collection.count_documents({"settlement": {"$exists": True}}) == 0
+    assert_settled(furlife, auctions, before)
+
+
+def test_transaction_conflict_rolls_back_and_retries_one_by_one(furlife, auctions):
+    furlife.client.replica_set = True
+    before = coins(furlife)
+    claimed = furlife.claim_expired_auctions(auctions)
+    # 取り直した別のワーカーがいるので、1件目はこのワーカーのトークンでは確定できない
+    furlife.auctions_collection.update_one({"_id": claimed[0]["_id"]}, {"$set": {"settlement_token": "other"}})
+
+    assert furlife.settle_auction_batch(claimed) == 2
+
+    first = furlife.auctions_collection.find_one({"_id": claimed[0]["_id"]})
+    assert first["status"] == "finalizing"
+    after = coins(furlife)
+    # 1回目のまとめた書き込みは取り消され、2件目・3件目の分だけが1回ずつ反映される
+    assert after["seller0"] == before["seller0"]
+    assert after["seller1"] == before["seller1"] + 130
+    assert after["alice"] == before["alice"]
+    assert after["bob"] == before["bob"]
+
+
+def test_standalone_falls_back_to_journal(furlife, auctions):
+    before = coins(furlife)
+
+    assert furlife.finalize_due_auctions(auctions) == 3
+
+    assert furlife.auction_settlement_state["transactions"] is False
+    assert furlife.auctions_collection.count_documents({"settlement": {"$exists": True}}) == 3
+    assert_settled(furlife, auctions, before)
+
+
+def test_transaction_unsupported_detection(furlife):
+    assert furlife.is_transaction_unsupported(NotImplementedError())
+    assert furlife.is_transaction_unsupported(OperationFailure("IllegalOperation", code=20))
+    assert furlife.is_transaction_unsupported(
+        OperationFailure("Transaction numbers are only allowed on a replica set member or mongos")
+    )
+    assert not furlife.is_transaction_unsupported(OperationFailure("WriteConflict", code=112))
+    assert not furlife.is_transaction_unsupported(ValueError())
+
+
+def test_journal_replay_after_crash_applies_each_update_once(furlife, auctions, monkeypatch):
+    before = coins(furlife)
+    original_bulk_write = furlife.users_collection.bulk_write
+
+    def crash_after_some_users(requests, *args, **kwargs):
+        # 一部のユーザーにだけ反映したところでプロセスが止まった
+        original_bulk_write(requests[:3], *args, **kwargs)
+        raise RuntimeError("crash")
+
+    monkeypatch.setattr(furlife.users_collection, "bulk_write", crash_after_some_users)
+    with pytest.raises(RuntimeError):
+        furlife.finalize_due_auctions(auctions)
+    monkeypatch.setattr(furlife.users_collection, "bulk_write", original_bulk_write)
+
+    assert furlife.auctions_collection.count_documents({"status": "finalizing"}) == 3
+    assert furlife.users_collection.count_documents({"settlement_marks.0": {"$exists": True}}) > 0
+    # 止まったままの決済は時間が経つと取り直され、保存済みのジャーナルどおりにやり直される
+    assert furlife.claim_stale_settlements() == []
+    stale = datetime.now(furlife.JST) - timedelta(seconds=furlife.AUCTION_SETTLEMENT_TIMEOUT_SECONDS + 1)
+    furlife.auctions_collection.update_many({}, {"$set": {"finalizing_at": stale}})
+
+    assert furlife.settle_auction_batch(furlife.claim_stale_settlements()) == 3
+
+    assert_settled(furlife, auctions, before)
+
+
+def test_journal_keeps_marks_of_auctions_reclaimed_by_another_worker(furlife, auctions):
+    before = coins(furlife)
+    claimed = furlife.claim_expired_auctions(auctions)
+    # このワーカーが止まったと見なされ、1件目を別のワーカーが取り直した
+    furlife.auctions_collection.update_one({"_id": claimed[0]["_id"]}, {"$set": {"settlement_token": "other"}})
+
+    assert furlife.settle_auction_batch(claimed) == 2
+
+    assert furlife.auctions_collection.find_one({"_id": claimed[0]["_id"]})["status"] == "finalizing"
+    mark = f"{claimed[0]['_id']}:0"
+    assert furlife.users_collection.count_documents({"settlement_marks": mark}) == 1
+    discovered = furlife.users_collection.find_one({"username": "bob"}).get("pokedex", {}).get("discovered", [])
+    assert furlife.get_pet_image(claimed[0]["pet_data"]) not in discovered
+
+    # 取り直したワーカーが保存済みのジャーナルをやり直しても、反映済みの更新は繰り返さない
+    reclaimed = list(furlife.auctions_collection.find({"settlement_token": "other"}))
+    assert furlife.settle_auction_batch(reclaimed) == 1
+
+    assert_settled(furlife, auctions, before)
+    discovered = furlife.users_collection.find_one({"username": "bob"}).get("pokedex", {}).get("discovered", [])
+    assert furlife.get_pet_image(claimed[0]["pet_data"]) in discovered
@@ -0,0 +1,79 @@
+"""コイン・在庫の更新（debit_coins / move_inventory）を同時に呼んだ場合のテスト"""
+import threading
+
+BUYERS = 40
+FOOD_PRICES = {"基本の餌": 10, "おいしい餌": 30, "プレミアム餌": 100}
+
+
+def hammer(clients, payloads):
+    """各クライアントから同時に/buy_foodを呼び、レスポンスを返す"""
+    start = threading.Barrier(len(clients))
+    responses = [None] * len(clients)
+
+    def buy(index):
+        start.wait()
+        response = clients[index].post("/buy_food", json=payloads[index])
+        responses[index] = (response.status_code, response.get_json())
+
+    threads = [threading.Thread(target=buy, args=(index,)) for index in range(len(clients))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return responses
+
+
+def stored_pet(furlife, username):
+    return furlife.users_collection.find_one({"username": username})["pet"]
+
+
+def test_concurrent_purchases_never_overdraw(furlife, make_user):
+    make_user("alice", coins=1000)
+    clients = [furlife.app.test_client() for _ in range(BUYERS)]
+    for client in clients:
+        with client.session_transaction() as sess:
+            sess["username"] = "alice"
+
+    responses = hammer(clients, [{"food_name": "基本の餌", "quantity": 3}] * BUYERS)
+
+    succeeded = [body for status, body in responses if status == 200]
+    rejected = [body for status, body in responses if status == 400]
+    assert len(succeeded) + len(rejected) == BUYERS
+    assert len(succeeded) == 1000 // 30
+    assert all(body["coins"] >= 0 for body in succeeded)
+    assert all(body["error"] == "コインが足りません" for body in rejected)
+
+    pet = stored_pet(furlife, "alice")
+    assert pet["coins"] == 1000 - 30 * len(succeeded)
+    assert pet["inventory"]["基本の餌"] == 3 * len(succeeded)
+
+
+def test_concurrent_mixed_purchases_conserve_value(furlife, make_user):
+    make_user("bob", coins=2000, inventory={"おいしい餌": 2})
+    payloads = [{"food_name": name, "quantity": quantity}
+                for name, quantity in [("基本の餌", 5), ("おいしい餌", 2), ("プレミアム餌", 1)] * 15]
+    clients = [furlife.app.test_client() for _ in payloads]
+    for client in clients:
+        with client.session_transaction() as sess:
+            sess["username"] = "bob"
+
+    responses = hammer(clients, payloads)
+
+    pet = stored_pet(furlife, "bob")
+    assert pet["coins"] >= 0
+    spent = sum(FOOD_PRICES[payload["food_name"]] * payload["quantity"]
+                for payload, (status, _) in zip(payloads, responses) if status == 200)
+    bought = {name: 0 for name in FOOD_PRICES}
+    for payload, (status, _) in zip(payloads, responses):
+        if status == 200:
+            bought[payload["food_name"]] += payload["quantity"]
+    # コイン + 在庫の価値は購入の前後で変わらない
+    inventory = pet["inventory"]
+    assert pet["coins"] == 2000 - spent
+    assert inventory.get("基本の餌", 0) == bought["基本の餌"]
+    assert inventory.get("おいしい餌", 0) == 2 + bought["おいしい餌"]
+    assert inventory.get("プレミアム餌", 0) == bought["プレミアム餌"]
+    assert pet["coins"] + sum(FOOD_PRICES[name] * count for name, count in bought.items()) == 2000
+    # 断られるのは残高が足りなくなってからだけ
+    rejected = [payload for payload, (status, _) in zip(payloads, responses) if status != 200]
+    assert all(FOOD_PRICES[p["food_name"]] * p["quantity"] > pet["coins"] for p in rejected)
@@ -0,0 +1,61 @@
+"""1日分の予定の保存順（開始順）と、それを使った重なりの検出のテスト"""
+from datetime import date, timedelta
+
+DAY = (date.today() + timedelta(days=1)).isoformat()
+
+
+def stored_order(furlife, username):
+    doc = furlife.event_days_collection.find_one({"username": username, "date": DAY})
+    return [(ev["start_min"], ev["end_min"]) for ev in doc["events"]]
+
+
+def create(client, start_time, end_time, **extra):
+    return client.post("/api/events/create", json={
+        "date": DAY, "start_time": start_time, "end_time": end_time, "event": "予定", **extra
+    })
+
+
+def test_events_are_stored_in_start_order(furlife, make_user):
+    client = make_user("alice")
+    for start_time, end_time in [("15:00", "16:00"), ("09:00", "10:00"), ("12:00", "13:00"), ("09:00", "09:30")]:
+        assert create(client, start_time, end_time).status_code == 200
+    assert stored_order(furlife, "alice") == [(540, 570), (540, 600), (720, 780), (900, 960)]
+
+    event_id = furlife.event_days_collection.find_one({"username": "alice"})["events"][3]["id"]
+    response = client.post("/api/events/update", json={
+        "date": DAY, "id": event_id, "start_time": "08:00", "end_time": "08:30", "event": "早朝"
+    })
+    assert response.status_code == 200
+    assert stored_order(furlife, "alice") == [(480, 510), (540, 570), (540, 600), (720, 780)]
+    assert [ev["start_time"] for ev in response.get_json()["events"]] == ["08:00", "09:00", "09:00", "12:00"]
+
+
+def test_stored_order_is_used_without_sorting(furlife):
+    events = [{"id": i, "start_min": start, "end_min": end} for i, (start, end) in enumerate([(0, 600), (60, 120), (700, 800)])]
+    day = furlife.build_day_intervals(events)
+    assert [iv.id for iv in day.intervals] == [0, 1, 2]
+    assert day.max_ends == [600, 600, 800]
+    # 長い予定の後ろに短い予定が続いても、終了の最大値でさかのぼって見つける
+    assert furlife.find_overlap(day, 300, 400).id == 0
+    assert furlife.find_overlap(day, 600, 700) is None
+    assert furlife.find_overlap(day, 0, 600, ignore_id=0).id == 1
+
+    # 順序の崩れた古いデータは並べ直して扱う
+    unsorted = furlife.build_day_intervals(list(reversed(events)))
+    assert [iv.id for iv in unsorted.intervals] == [0, 1, 2]
+
+
+def test_recurring_occurrences_take_part_in_overlap_check(furlife, make_user):
+    client = make_user("bob")
+    client.post("/api/events/settings", json={"reject_overlaps": True})
+    assert create(client, "10:00", "11:00", repeat="daily", count=3).status_code == 200
+    assert create(client, "12:00", "13:00").status_code == 200
+
+    occurrence = next(ev for ev in client.get(f"/api/events?start={DAY}&end={DAY}").get_json()["events"][DAY]
+                      if ev.get("recurrence"))
+    assert (occurrence["start_min"], occurrence["end_min"]) == (600, 660)
+
+    response = create(client, "10:30", "11:30")
+    assert response.status_code == 400
+    assert "10:00〜11:00" in response.get_json()["error"]
+    assert create(client, "11:00", "12:00").status_code == 200
@@ -0,0 +1,54 @@
+"""ランキングAPIの自分の周辺（around=me）のテスト"""
+
+SCORES = {"u1": 9, "u2": 7, "u3": 7, "u4": 7, "me": 5, "u5": 5, "u6": 3, "u7": 1}
+
+
+def set_score(furlife, username, score):
+    furlife.users_collection.update_one(
+        {"username": username},
+        {"$set": {"pokedex": {"discovered": [], "discovery_count": score, "total_stars": score}}}
+    )
+
+
+def test_around_me_uses_one_source_for_position_and_ranks(furlife, make_user):
+    clients = {username: make_user(username) for username in SCORES}
+    for username, score in SCORES.items():
+        set_score(furlife, username, score)
+    furlife.refresh_leaderboard_snapshot()
+    # スナップショットを作った後で順位が入れ替わる
+    set_score(furlife, "u6", 8)
+    set_score(furlife, "u1", 2)
+    set_score(furlife, "u7", 6)
+
+    body = clients["me"].get("/api/ranking/leaderboard?around=me&k=2").get_json()
+
+    rows = body["rows"]
+    # 最新の並び: u6(8), u2(7), u3(7), u4(7), u7(6), me(5), u5(5), u1(2)
+    assert body["my_position"] == 6
+    assert body["my_rank"] == 6
+    mine = next(row for row in rows if row["is_me"])
+    assert (mine["position"], mine["rank"]) == (body["my_position"], body["my_rank"])
+    assert [(row["username"], row["position"], row["rank"]) for row in rows] == [
+        ("u4", 4, 2), ("u7", 5, 5), ("me", 6, 6), ("u5", 7, 6), ("u1", 8, 8),
+    ]
+
+
+def test_around_me_without_stored_scores_returns_no_position(furlife, make_user):
+    for username, score in SCORES.items():
+        if username != "me":
+            make_user(username)
+            set_score(furlife, username, score)
+    client = make_user("me")  # 図鑑のスコアがまだ保存されていない
+
+    body = client.get("/api/ranking/leaderboard?around=me&k=2").get_json()
+
+    assert body["my_position"] is None and body["my_rank"] is None
+    rows = body["rows"]
+    assert not any(row["is_me"] for row in rows)
+    # 通し番号・順位はランキングの一覧（自分を含まない）と同じ
+    listing = client.get("/api/ranking/leaderboard?limit=20").get_json()["rows"]
+    by_name = {row["username"]: (row["position"], row["rank"]) for row in listing}
+    assert [(row["username"], row["position"], row["rank"]) for row in rows] == [
+        (row["username"], *by_name[row["username"]]) for row in rows
+    ]
+    assert [row["username"] for row in rows] == ["u6", "u7"]
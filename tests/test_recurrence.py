@@ -0,0 +1,33 @@
+"""繰り返し予定の指定（間隔・回数）の読み取りと検証のテスト"""
+from datetime import date, timedelta
+
+import pytest
+
+DAY = (date.today() + timedelta(days=1)).isoformat()
+
+
+def create_weekly(client, **fields):
+    return client.post("/api/events/create", json={
+        "date": DAY, "start_time": "10:00", "end_time": "11:00", "event": "定例", "repeat": "weekly", **fields
+    })
+
+
+@pytest.mark.parametrize("interval", [0, -1, "0", "abc"])
+def test_invalid_interval_is_rejected(furlife, make_user, interval):
+    client = make_user("alice")
+
+    response = create_weekly(client, interval=interval)
+
+    assert response.status_code == 400
+    assert "繰り返しの間隔" in response.get_json()["error"]
+    assert furlife.recurring_events_collection.count_documents({}) == 0
+
+
+@pytest.mark.parametrize("fields", [{}, {"interval": None}, {"interval": ""}])
+def test_missing_interval_defaults_to_one(furlife, make_user, fields):
+    client = make_user("alice")
+
+    response = create_weekly(client, **fields)
+
+    assert response.status_code == 200
+    assert response.get_json()["rule"]["interval"] == 1
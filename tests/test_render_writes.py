@@ -0,0 +1,37 @@
+"""ページの表示でペット・図鑑への書き込みが起きないことのテスト"""
+import pytest
+from flask import g, request_finished
+
+WRITE_COMMANDS = {"insert", "update", "delete", "findAndModify"}
+
+
+@pytest.fixture
+def mongo_commands(furlife):
+    """リクエストごとにMongoRoundTripCounterが記録したコマンド（レスポンス前の書き込みを含む）"""
+    recorded = []
+
+    def capture(sender, response, **extra):
+        recorded.append(list(g.get("mongo_commands", [])))
+
+    request_finished.connect(capture, furlife.app)
+    yield recorded
+    request_finished.disconnect(capture, furlife.app)
+
+
+@pytest.mark.parametrize("path", ["/shop", "/pet"])
+def test_rendering_page_writes_nothing_to_users(furlife, make_user, mongo_commands, path):
+    client = make_user("alice", level=35, evolution=2)
+    # 以前はペット画像を決めるたびに図鑑へ発見を書き込んでいた
+    furlife.users_collection.update_one({"username": "alice"}, {"$set": {"pokedex": {"discovered": []}}})
+
+    for _ in range(2):
+        response = client.get(path)
+        assert response.status_code == 200
+
+    assert len(mongo_commands) == 2
+    for commands in mongo_commands:
+        assert commands, "MongoRoundTripCounterにコマンドが記録されていない"
+        writes = [(name, collection) for name, collection in commands
+                  if name in WRITE_COMMANDS and collection == furlife.users_collection.name]
+        assert writes == []
+    assert furlife.users_collection.find_one({"username": "alice"})["pokedex"] == {"discovered": []}
@@ -0,0 +1,171 @@
+"""天気情報のキャッシュ（TTL / 古い値を返しながらの取り直し / 同時取得の共有）とサーキットブレーカーのテスト
+
+WEATHER_API_URLをローカルのスタブサーバーに向け、正常・遅延・エラーの応答を切り替えて確かめる。
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+
+class StubWeatherHandler(BaseHTTPRequestHandler):
+    """OpenWeatherMapと同じ形の応答を返す（server.behaviorで応答を切り替える）"""
+
+    def do_GET(self):
+        behavior = self.server.behavior
+        with self.server.lock:
+            self.server.requests.append(parse_qs(urlparse(self.path).query)["q"][0])
+        if behavior["delay"]:
+            time.sleep(behavior["delay"])
+        if behavior["status"] != 200:
+            self.send_response(behavior["status"])
+            self.end_headers()
+            return
+        location = parse_qs(urlparse(self.path).query)["q"][0]
+        body = json.dumps({
+            "name": location,
+            "main": {"temp": behavior["temp"], "humidity": 40},
+            "weather": [{"description": "晴れ", "icon": "01d"}],
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def weather_server(furlife, monkeypatch):
+    """スタブの天気APIサーバーを起動し、キャッシュとブレーカーを空にしてから向け先を差し替える"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubWeatherHandler)
+    server.behavior = {"status": 200, "delay": 0, "temp": 20.0}
+    server.requests = []
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(furlife, "WEATHER_API_URL", f"http://127.0.0.1:{server.server_address[1]}/weather")
+    monkeypatch.setattr(furlife, "WEATHER_BREAKER_COOLDOWN_SECONDS", 0.2)
+    furlife.weather_cache.clear()
+    furlife.weather_inflight.clear()
+    for key in furlife.weather_stats:
+        furlife.weather_stats[key] = 0.0 if key == "open_until" else 0
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def wait_until(condition, timeout=3):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "待っている状態にならなかった"
+        time.sleep(0.01)
+
+
+def test_fresh_cache_is_served_without_calling_api(furlife, weather_server):
+    first = furlife.get_weather_data("Tokyo")
+    second = furlife.get_weather_data("Tokyo")
+
+    assert first == second
+    assert first["location"] == "Tokyo" and first["temp"] == 20.0
+    assert weather_server.requests == ["Tokyo"]
+    assert furlife.weather_stats["misses"] == 1
+    assert furlife.weather_stats["hits"] == 1
+
+
+def test_stale_entry_is_returned_while_refreshing_in_background(furlife, weather_server, monkeypatch):
+    furlife.get_weather_data("Osaka")
+    monkeypatch.setattr(furlife, "WEATHER_CACHE_TTL_SECONDS", 0)
+    weather_server.behavior.update(delay=0.2, temp=25.0)
+
+    started = time.monotonic()
+    stale = furlife.get_weather_data("Osaka")
+
+    assert time.monotonic() - started < 0.15  # 取り直しを待たずに返る
+    assert stale["temp"] == 20.0
+    assert furlife.weather_stats["stale_hits"] == 1
+    wait_until(lambda: furlife.weather_cache["Osaka"]["data"]["temp"] == 25.0)
+    assert weather_server.requests == ["Osaka", "Osaka"]
+
+
+def test_stale_entry_is_not_used_after_stale_window(furlife, weather_server, monkeypatch):
+    furlife.get_weather_data("Sapporo")
+    monkeypatch.setattr(furlife, "WEATHER_CACHE_TTL_SECONDS", 0)
+    monkeypatch.setattr(furlife, "WEATHER_STALE_SECONDS", 0)
+    weather_server.behavior["status"] = 500
+
+    assert furlife.get_weather_data("Sapporo") is None
+    assert furlife.weather_stats["misses"] == 2
+
+
+def test_concurrent_misses_share_one_upstream_call(furlife, weather_server):
+    weather_server.behavior["delay"] = 0.3
+    start = threading.Barrier(10)
+    results = []
+
+    def request_weather():
+        start.wait()
+        results.append(furlife.get_weather_data("Nagoya"))
+
+    threads = [threading.Thread(target=request_weather) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert weather_server.requests == ["Nagoya"]
+    assert len(results) == 10 and all(result and result["location"] == "Nagoya" for result in results)
+    assert furlife.weather_inflight == {}
+
+
+def test_no_wait_returns_none_and_fetches_in_background(furlife, weather_server):
+    assert furlife.get_weather_data("Fukuoka", wait=False) is None
+    wait_until(lambda: "Fukuoka" in furlife.weather_cache)
+    assert furlife.get_weather_data("Fukuoka", wait=False)["location"] == "Fukuoka"
+
+
+def test_breaker_opens_after_consecutive_failures(furlife, weather_server, make_user):
+    weather_server.behavior["status"] = 500
+    for location in ("A", "B", "C"):
+        assert furlife.get_weather_data(location) is None
+    assert len(weather_server.requests) == furlife.WEATHER_BREAKER_THRESHOLD
+
+    # 開いている間はAPIを呼ばずにすぐ諦める
+    assert furlife.get_weather_data("D") is None
+    assert len(weather_server.requests) == furlife.WEATHER_BREAKER_THRESHOLD
+    assert furlife.weather_stats["short_circuits"] == 1
+
+    client = make_user("alice")
+    response = client.get("/api/weather?location=E")
+    assert response.status_code == 503
+    status = client.get("/api/weather/status").get_json()
+    assert status["circuit_open"] is True
+    assert status["upstream_failures"] == furlife.WEATHER_BREAKER_THRESHOLD
+
+
+def test_breaker_half_open_probe_reopens_on_failure_and_closes_on_success(furlife, weather_server):
+    weather_server.behavior["status"] = 503
+    for location in ("A", "B", "C"):
+        furlife.get_weather_data(location)
+    calls = len(weather_server.requests)
+
+    # 待ち時間が過ぎたら1回だけ試し、失敗すればすぐにまた開く
+    time.sleep(furlife.WEATHER_BREAKER_COOLDOWN_SECONDS + 0.05)
+    assert furlife.get_weather_data("Kobe") is None
+    assert len(weather_server.requests) == calls + 1
+    assert furlife.get_weather_data("Kyoto") is None
+    assert len(weather_server.requests) == calls + 1
+
+    # 次の試行が成功すれば閉じて、以降は普通に呼ぶ
+    time.sleep(furlife.WEATHER_BREAKER_COOLDOWN_SECONDS + 0.05)
+    weather_server.behavior["status"] = 200
+    assert furlife.get_weather_data("Kobe")["location"] == "Kobe"
+    assert furlife.weather_stats["consecutive_failures"] == 0
+    assert furlife.get_weather_data("Kyoto")["location"] == "Kyoto"
+    assert len(weather_server.requests) == calls + 3